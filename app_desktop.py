@@ -23,10 +23,62 @@ import pandas as pd
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 import cgi
 
+# Motor de mapeo a Libro2 compartido con la versión web (PyInstaller incluye app_web al compilar)
+from app_web import PaginaPrecomprimida, compilar_mapeo_libro2, construir_libro2
+
 # Variable global para el servidor
 server_instance = None
 server_thread = None
 
+# Mapeo a Libro2 de la versión escritorio (mismos kernels que MAPEOS_LIBRO2 de app_web).
+# Esta versión no relaciona direcciones, ciudades ni teléfonos: usa las columnas de ofimatic tal cual.
+MAPEOS_LIBRO2_ESCRITORIO = {
+    'medellin': {
+        'Nombre Vehiculo': {'kernel': 'normalizar', 'columna': 'NomMensajero', 'normalizacion': 'texto', 'defecto': ''},
+        'Título de la Visita': {
+            'kernel': 'concatenar', 'separador': ' - ', 'respaldo': 'disponibles',
+            'partes': [{'columna': 'NOMBRE', 'normalizacion': 'espacios'}, {'columna': 'nit', 'normalizacion': 'texto'}]
+        },
+        'Dirección': {'kernel': 'columna', 'columna': 'DIRECCION', 'defecto': ''},
+        'ID Referencia': {'kernel': 'columna', 'columna': 'Nrodcto_relacionado'},
+        'Notas': {'kernel': 'columna', 'columna': 'TipoVta', 'defecto': ''},
+        'Teléfono': {'kernel': 'columna', 'columna': 'TEL1'},
+    },
+    'bogota': {
+        'Nombre Vehiculo': {'kernel': 'columna', 'columna': 'NomMensajero', 'defecto': ''},
+        'Título de la Visita': {'kernel': 'columna', 'columna': 'NOMBRE', 'defecto': ''},
+        'Dirección': {'kernel': 'columna', 'columna': 'DIRECCION', 'defecto': ''},
+        'ID Referencia': {'kernel': 'columna', 'columna': 'Nrodcto_relacionado'},
+        'Notas': {'kernel': 'columna', 'columna': 'TipoVta', 'defecto': ''},
+        'Teléfono': {'kernel': 'columna', 'columna': 'TEL1'},
+    },
+    'distrifarma': {
+        'Nombre Vehiculo': {'kernel': 'normalizar', 'columna': 'Nombre Vehiculo', 'normalizacion': 'texto',
+                            'defecto': ''},
+        'Título de la Visita': {'kernel': 'alternativas', 'defecto': '', 'reglas': [
+            {'kernel': 'concatenar', 'separador': ' - ', 'respaldo': 'primera',
+             'partes': ['Persona de Contacto', 'CEDULA']},
+            {'kernel': 'columna', 'columna': 'Persona de Contacto'},
+        ]},
+        'Dirección': {'kernel': 'columna', 'columna': 'Dirección', 'defecto': ''},
+        'Latitud': {'kernel': 'columna', 'columna': 'Latitud'},
+        'Longitud': {'kernel': 'columna', 'columna': 'Longitud'},
+        'ID Referencia': {'kernel': 'prefijo', 'columna': 'ID Referencia', 'prefijo': 'Diswifarma',
+                          'defecto': 'Diswifarma'},
+        'Notas': {'kernel': 'alternativas', 'defecto': '', 'reglas': [
+            {'kernel': 'columna', 'columna': 'INTEGRADOS'},
+            {'kernel': 'columna', 'columna': 'Notas'},
+        ]},
+        'Persona de Contacto': {'kernel': 'columna', 'columna': 'Persona de Contacto'},
+        'Teléfono': {'kernel': 'columna', 'columna': 'Teléfono'},
+        'Emails': {'kernel': 'columna', 'columna': 'Emails'},
+    },
+}
+
+MAPEOS_LIBRO2_ESCRITORIO_COMPILADOS = {
+    fuente: compilar_mapeo_libro2(especificacion) for fuente, especificacion in MAPEOS_LIBRO2_ESCRITORIO.items()
+}
+
 def find_free_port():
     """Encuentra un puerto libre disponible"""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
@@ -68,12 +120,18 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
         """Silenciar logs HTTP"""
         pass
     
+    # Página principal (bytes y variantes comprimidas), construida una sola vez
+    pagina_principal = None
+    
+    @classmethod
+    def obtener_pagina_principal(cls):
+        if cls.pagina_principal is None:
+            cls.pagina_principal = PaginaPrecomprimida(cls.get_html_content())
+        return cls.pagina_principal
+    
     def do_GET(self):
         if self.path == '/' or self.path == '/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(self.get_html_content().encode('utf-8'))
+            self.obtener_pagina_principal().enviar(self)
         else:
             self.send_error(404)
     
@@ -85,7 +143,8 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
         else:
             self.send_error(404)
     
-    def get_html_content(self):
+    @staticmethod
+    def get_html_content():
         """Retorna el HTML de la interfaz"""
         return '''<!DOCTYPE html>
 <html lang="es">
@@ -667,30 +726,8 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
                 axis=1
             )
             
-            # Limpiar NomMensajero
-            if 'NomMensajero' in df_ofimatic.columns:
-                df_ofimatic['NomMensajero'] = df_ofimatic['NomMensajero'].astype(str).str.strip()
-            
             # Crear DataFrame Libro2
-            df_libro2 = pd.DataFrame()
-            df_libro2['Nombre Vehiculo'] = df_ofimatic['NomMensajero'] if 'NomMensajero' in df_ofimatic.columns else ''
-            
-            # Título de la Visita
-            def crear_titulo(row):
-                nombre = str(row.get('NOMBRE', '')).strip() if pd.notna(row.get('NOMBRE')) else ''
-                nombre = ' '.join(nombre.split())
-                nit = str(row['nit']).replace('.0', '') if str(row['nit']).endswith('.0') else str(row['nit'])
-                return f"{nombre} - {nit}" if nombre and nit else (nombre or nit)
-            
-            df_libro2['Título de la Visita'] = df_ofimatic.apply(crear_titulo, axis=1)
-            df_libro2['Dirección'] = df_ofimatic['DIRECCION'] if 'DIRECCION' in df_ofimatic.columns else ''
-            df_libro2['Latitud'] = None
-            df_libro2['Longitud'] = None
-            df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
-            df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
-            df_libro2['Persona de Contacto'] = None
-            df_libro2['Teléfono'] = df_ofimatic['TEL1'] if 'TEL1' in df_ofimatic.columns else None
-            df_libro2['Emails'] = None
+            df_libro2 = construir_libro2(df_ofimatic, MAPEOS_LIBRO2_ESCRITORIO_COMPILADOS['medellin'])
             
             # Generar Excel
             excel_buffer = BytesIO()
@@ -734,17 +771,7 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
             )
             
             # Crear Libro2
-            df_libro2 = pd.DataFrame()
-            df_libro2['Nombre Vehiculo'] = df_ofimatic['NomMensajero'] if 'NomMensajero' in df_ofimatic.columns else ''
-            df_libro2['Título de la Visita'] = df_ofimatic['NOMBRE'] if 'NOMBRE' in df_ofimatic.columns else ''
-            df_libro2['Dirección'] = df_ofimatic['DIRECCION'] if 'DIRECCION' in df_ofimatic.columns else ''
-            df_libro2['Latitud'] = None
-            df_libro2['Longitud'] = None
-            df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
-            df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
-            df_libro2['Persona de Contacto'] = None
-            df_libro2['Teléfono'] = df_ofimatic['TEL1'] if 'TEL1' in df_ofimatic.columns else None
-            df_libro2['Emails'] = None
+            df_libro2 = construir_libro2(df_ofimatic, MAPEOS_LIBRO2_ESCRITORIO_COMPILADOS['bogota'])
             
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -811,35 +838,7 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
                     df.columns = cols[:len(df.columns)]
             
             # Crear Libro2
-            df_libro2 = pd.DataFrame()
-            df_libro2['Nombre Vehiculo'] = df['Nombre Vehiculo'].astype(str).str.strip() if 'Nombre Vehiculo' in df.columns else ''
-            
-            # Título
-            if 'CEDULA' in df.columns and 'Persona de Contacto' in df.columns:
-                df_libro2['Título de la Visita'] = df.apply(
-                    lambda r: f"{r['Persona de Contacto']} - {r['CEDULA']}" if pd.notna(r['Persona de Contacto']) and pd.notna(r['CEDULA']) else str(r.get('Persona de Contacto', '')),
-                    axis=1
-                )
-            else:
-                df_libro2['Título de la Visita'] = df['Persona de Contacto'] if 'Persona de Contacto' in df.columns else ''
-            
-            df_libro2['Dirección'] = df['Dirección'] if 'Dirección' in df.columns else ''
-            df_libro2['Latitud'] = df['Latitud'] if 'Latitud' in df.columns else None
-            df_libro2['Longitud'] = df['Longitud'] if 'Longitud' in df.columns else None
-            
-            # ID Referencia
-            def proc_id(x):
-                if pd.isna(x): return 'Diswifarma'
-                s = str(x).strip()
-                if any(c.isalpha() for c in s) and any(c.isdigit() for c in s):
-                    return s
-                return f"Diswifarma-{s}"
-            
-            df_libro2['ID Referencia'] = df['ID Referencia'].apply(proc_id) if 'ID Referencia' in df.columns else 'Diswifarma'
-            df_libro2['Notas'] = df.get('INTEGRADOS', df.get('Notas', ''))
-            df_libro2['Persona de Contacto'] = df['Persona de Contacto'] if 'Persona de Contacto' in df.columns else None
-            df_libro2['Teléfono'] = df['Teléfono'] if 'Teléfono' in df.columns else None
-            df_libro2['Emails'] = df['Emails'] if 'Emails' in df.columns else None
+            df_libro2 = construir_libro2(df, MAPEOS_LIBRO2_ESCRITORIO_COMPILADOS['distrifarma'])
             
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -873,6 +872,7 @@ class MailboxDesktopHandler(SimpleHTTPRequestHandler):
 def start_server(port):
     """Inicia el servidor HTTP"""
     global server_instance
+    MailboxDesktopHandler.obtener_pagina_principal()
     server_instance = HTTPServer(('127.0.0.1', port), MailboxDesktopHandler)
     server_instance.serve_forever()
 
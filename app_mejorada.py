@@ -222,87 +222,67 @@ def relacionar_por_nit_bogota(df_inicial, df_pedidos):
     Intenta dos métodos de relación:
     1. Por NIT (nit == IDENTIFICACION)
     2. Por documento (Nrodcto normalizado == DOCUMENTO ASOCIADO normalizado)
+    
+    Ambos métodos se aplican sobre columnas completas (map + coalesce), sin recorrer filas.
     """
     # Convertir nit a string para comparación
     df_inicial['nit'] = df_inicial['nit'].astype(str).str.strip()
     
-    def normalizar_documento(doc):
-        """Normaliza un documento quitando guiones y convirtiendo a mayúsculas"""
-        if pd.isna(doc):
-            return ''
-        doc_str = str(doc).strip().upper()
-        # Quitar guiones y espacios
-        doc_str = doc_str.replace('-', '').replace(' ', '')
-        return doc_str
-    
-    # Crear diccionarios de mapeo
-    # 1. Diccionario NIT -> NUMERO DE PEDIDO
-    pedidos_por_nit = {}
-    # 2. Diccionario DOCUMENTO NORMALIZADO -> NUMERO DE PEDIDO
-    pedidos_por_doc = {}
-    
-    for _, row in df_pedidos.iterrows():
-        # Convertir NUMERO DE PEDIDO a string sin decimales
-        num_pedido = row['NUMERO DE PEDIDO']
-        if pd.notna(num_pedido):
-            try:
-                num_pedido = str(int(float(num_pedido)))
-            except:
-                num_pedido = str(num_pedido).strip()
-        else:
-            num_pedido = ''
-        
-        # Mapeo por NIT
-        nit = str(row['IDENTIFICACION']).strip()
-        pedidos_por_nit[nit] = num_pedido
-        
-        # Mapeo por DOCUMENTO ASOCIADO
-        if 'DOCUMENTO ASOCIADO' in row and pd.notna(row['DOCUMENTO ASOCIADO']):
-            doc_normalizado = normalizar_documento(row['DOCUMENTO ASOCIADO'])
-            if doc_normalizado:
-                pedidos_por_doc[doc_normalizado] = num_pedido
+    def normalizar_documentos(docs):
+        """Normaliza documentos quitando guiones y espacios y convirtiendo a mayúsculas"""
+        return (docs.astype(str).str.strip().str.upper()
+                .str.replace('-', '', regex=False).str.replace(' ', '', regex=False))
+    
+    # Convertir NUMERO DE PEDIDO a string sin decimales (vacío si no hay pedido)
+    num_pedido = df_pedidos['NUMERO DE PEDIDO']
+    num_pedido_float = pd.to_numeric(num_pedido, errors='coerce')
+    es_entero = num_pedido_float.abs() < 2**63
+    es_texto = num_pedido.notna() & ~es_entero
+    num_pedido_texto = pd.Series('', index=num_pedido.index, dtype=object)
+    num_pedido_texto[es_entero] = num_pedido_float[es_entero].astype('int64').astype(str)
+    num_pedido_texto[es_texto] = num_pedido[es_texto].astype(str).str.strip()
+    
+    # Crear mapeos (si un NIT o documento se repite, gana la última fila)
+    # 1. NIT -> NUMERO DE PEDIDO
+    pedidos_por_nit = pd.Series(num_pedido_texto.values,
+                                index=df_pedidos['IDENTIFICACION'].astype(str).str.strip().values)
+    pedidos_por_nit = pedidos_por_nit[~pedidos_por_nit.index.duplicated(keep='last')]
+    
+    # 2. DOCUMENTO NORMALIZADO -> NUMERO DE PEDIDO
+    pedidos_por_doc = pd.Series(dtype=object)
+    if 'DOCUMENTO ASOCIADO' in df_pedidos.columns:
+        docs = df_pedidos['DOCUMENTO ASOCIADO']
+        docs_normalizados = normalizar_documentos(docs)
+        con_doc = docs.notna() & (docs_normalizados != '')
+        pedidos_por_doc = pd.Series(num_pedido_texto[con_doc].values, index=docs_normalizados[con_doc].values)
+        pedidos_por_doc = pedidos_por_doc[~pedidos_por_doc.index.duplicated(keep='last')]
     
     print(f"Total de NITs en pedidos: {len(pedidos_por_nit)}")
     print(f"Total de DOCUMENTOS en pedidos: {len(pedidos_por_doc)}")
     print(f"Total de registros en planilla inicial: {len(df_inicial)}")
     
-    # Actualizar el campo Nrodcto
-    registros_actualizados_nit = 0
-    registros_actualizados_doc = 0
-    registros_no_encontrados = []
+    nrodcto_actual = df_inicial['Nrodcto'].astype(str)
     
-    for idx, row in df_inicial.iterrows():
-        nit = str(row['nit']).strip()
-        nrodcto_actual = str(row['Nrodcto'])
-        nrodcto_normalizado = normalizar_documento(nrodcto_actual)
-        
-        num_pedido = None
-        metodo = None
-        
-        # Método 1: Intentar por NIT
-        if nit in pedidos_por_nit and pedidos_por_nit[nit]:
-            num_pedido = pedidos_por_nit[nit]
-            metodo = 'NIT'
-            registros_actualizados_nit += 1
-        # Método 2: Si no encontró por NIT, intentar por DOCUMENTO
-        elif nrodcto_normalizado in pedidos_por_doc and pedidos_por_doc[nrodcto_normalizado]:
-            num_pedido = pedidos_por_doc[nrodcto_normalizado]
-            metodo = 'DOCUMENTO'
-            registros_actualizados_doc += 1
-        
-        # Si encontró el pedido por algún método, actualizar
-        if num_pedido and metodo:
-            # Crear el nuevo formato: Nrodcto-NUMERO_DE_PEDIDO
-            nuevo_nrodcto = f"{nrodcto_actual}-{num_pedido}"
-            df_inicial.at[idx, 'Nrodcto'] = nuevo_nrodcto
-        else:
-            registros_no_encontrados.append(f"{nit}|{nrodcto_actual}")
+    # Método 1: por NIT. Método 2: por DOCUMENTO, solo donde no hubo NIT
+    pedido_por_nit = df_inicial['nit'].map(pedidos_por_nit)
+    pedido_por_nit = pedido_por_nit.mask(pedido_por_nit == '')
+    pedido_por_doc = normalizar_documentos(nrodcto_actual).map(pedidos_por_doc)
+    pedido_por_doc = pedido_por_doc.mask(pedido_por_doc == '')
+    num_pedido_final = pedido_por_nit.fillna(pedido_por_doc)
+    
+    encontrados = num_pedido_final.notna()
+    registros_actualizados_nit = int(pedido_por_nit.notna().sum())
+    registros_actualizados_doc = int(encontrados.sum()) - registros_actualizados_nit
+    registros_no_encontrados = int((~encontrados).sum())
+    
+    # Crear el nuevo formato: Nrodcto-NUMERO_DE_PEDIDO
+    df_inicial['Nrodcto'] = (nrodcto_actual + '-' + num_pedido_final).where(encontrados, df_inicial['Nrodcto'])
     
     total_actualizados = registros_actualizados_nit + registros_actualizados_doc
     print(f"\nRegistros actualizados por NIT: {registros_actualizados_nit}")
     print(f"Registros actualizados por DOCUMENTO: {registros_actualizados_doc}")
     print(f"Total actualizados: {total_actualizados}")
-    print(f"Registros sin coincidencia: {len(registros_no_encontrados)}")
+    print(f"Registros sin coincidencia: {registros_no_encontrados}")
     
     return df_inicial
 
@@ -310,30 +290,39 @@ def relacionar_por_nit_bogota(df_inicial, df_pedidos):
 def guardar_con_formato_bogota(df_datos, filas_encabezado, ruta_guardado):
     """
     Guarda el DataFrame manteniendo el formato original de la planilla inicial.
+    Escribe en modo write-only (fila por fila, sin mantener las celdas en memoria).
     """
     from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.styles import Font, Alignment, PatternFill
     from openpyxl.utils.dataframe import dataframe_to_rows
     
-    # Crear un nuevo workbook
-    wb = Workbook()
-    ws = wb.active
+    # Crear un workbook en modo write-only
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    
+    fuente_titulo = Font(bold=True, size=12)
+    relleno_encabezado = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+    fuente_encabezado = Font(bold=True)
+    alineacion_encabezado = Alignment(horizontal='center', vertical='center')
     
     # Escribir las primeras 4 filas de encabezado originales
     for r_idx, row in enumerate(filas_encabezado.values, start=1):
-        for c_idx, value in enumerate(row, start=1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=value)
+        celdas = []
+        for value in row:
+            cell = WriteOnlyCell(ws, value=value)
             if r_idx == 1:  # Título
-                cell.font = Font(bold=True, size=12)
+                cell.font = fuente_titulo
             elif r_idx == 4:  # Encabezados de columnas
-                cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal='center', vertical='center')
+                cell.fill = relleno_encabezado
+                cell.font = fuente_encabezado
+                cell.alignment = alineacion_encabezado
+            celdas.append(cell)
+        ws.append(celdas)
     
     # Escribir los datos actualizados a partir de la fila 5
-    for r_idx, row in enumerate(dataframe_to_rows(df_datos, index=False, header=False), start=5):
-        for c_idx, value in enumerate(row, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=value)
+    for row in dataframe_to_rows(df_datos, index=False, header=False):
+        ws.append(row)
     
     # Guardar el archivo
     wb.save(ruta_guardado)
@@ -5,7 +5,9 @@ Una aplicación web local para procesar planillas CSV y Excel sin problemas de T
 """
 
 import os
+import re
 import sys
+import tempfile
 import webbrowser
 import threading
 import time
@@ -13,106 +15,514 @@ from http.server import HTTPServer, SimpleHTTPRequestHandler
 import urllib.parse
 import json
 import pandas as pd
+import numpy as np
 from io import StringIO, BytesIO
 import base64
+import contextlib
+import functools
 import openpyxl
 
-def leer_excel_inteligente_desde_contenido(contenido):
+# Columnas que identifican la fila de encabezados en las planillas conocidas
+COLUMNAS_ENCABEZADO_CONOCIDAS = [
+    'idOrder', 'authorizationNumber', 'typeOrder', 'identificationPatient',  # Medellín
+    'nit', 'Nrodcto',  # Ofimatic
+    'IDENTIFICACION', 'NUMERO DE PEDIDO', 'DIRECCION DE ENTREGA', 'CELULAR', 'DOCUMENTO ASOCIADO'  # Ehlpharma
+]
+
+# Filas en las que se buscan los encabezados (igual que la búsqueda anterior con openpyxl)
+FILAS_BUSQUEDA_ENCABEZADOS = 20
+
+# Columnas que usa cada modo de cada planilla: al leer se descarta el resto.
+# Las planillas que se escriben de vuelta completas (ofimatic en 'normal', planilla inicial
+# de Bogotá, Distrifarma) no aparecen aquí y se leen con todas sus columnas.
+# 'texto': identificadores (NIT, pedidos, teléfonos) que se leen como texto ("123", no 123.0)
+OFIMATIC_LIBRO2 = {
+    'requeridas': ['nit', 'Nrodcto'],
+    'opcionales': ['NomMensajero', 'NOMBRE', 'DIRECCION', 'TEL1', 'TEL2', 'TipoVta', 'Destino'],
+    'texto': ['nit', 'TEL1', 'TEL2']
+}
+COLUMNAS_POR_MODO = {
+    'normal': {
+        'madre': {
+            'requeridas': ['identificationPatient', 'idOrder'],
+            'opcionales': [],
+            'texto': ['identificationPatient', 'idOrder']
+        },
+        # El resultado es el ofimatic completo: sin 'opcionales' se leen todas sus columnas.
+        # nit va como texto igual que los IDs de la madre (un nit vacío no vuelve float la columna)
+        'ofimatic': {'requeridas': ['nit', 'Nrodcto'], 'texto': ['nit']}
+    },
+    'bogota': {
+        'pedidos': {'requeridas': ['IDENTIFICACION', 'NUMERO DE PEDIDO'], 'opcionales': ['DOCUMENTO ASOCIADO']}
+    },
+    'medellin_libro2': {
+        'madre': {
+            'requeridas': ['identificationPatient', 'idOrder'],
+            'opcionales': ['addressPatient', 'mobilePhonePatient', 'cityNameOrder'],
+            'texto': ['identificationPatient', 'idOrder', 'mobilePhonePatient']
+        },
+        'ofimatic': OFIMATIC_LIBRO2
+    },
+    'bogota_libro2': {
+        'ehlpharma': {
+            'requeridas': ['IDENTIFICACION', 'NUMERO DE PEDIDO', 'DOCUMENTO ASOCIADO'],
+            'opcionales': ['DIRECCION DE ENTREGA', 'CELULAR', 'CIUDAD DE ENTREGA'],
+            'texto': ['IDENTIFICACION', 'NUMERO DE PEDIDO', 'CELULAR']
+        },
+        'ofimatic': OFIMATIC_LIBRO2
+    },
+    'farmabogota': {
+        'farmabogota': {
+            'requeridas': ['NUMERO DE PEDIDO', 'PACIENTE', 'IDENTIFICACION', 'CIUDAD DE ENTREGA',
+                           'DIRECCION DE ENTREGA', 'CELULAR', 'DOCUMENTO ASOCIADO'],
+            'opcionales': [],
+            'texto': ['NUMERO DE PEDIDO', 'CELULAR']
+        }
+    }
+}
+
+
+def columnas_de_planilla(modo, planilla):
+    """Columnas (requeridas + opcionales) que el modo lee de la planilla, o None si se leen todas"""
+    declaracion = COLUMNAS_POR_MODO.get(modo, {}).get(planilla)
+    if declaracion is None or 'opcionales' not in declaracion:
+        return None
+    return declaracion['requeridas'] + declaracion['opcionales']
+
+
+def columnas_texto_de_planilla(modo, planilla):
+    """Columnas de identificadores que el modo lee como texto, o None si no declara ninguna"""
+    return COLUMNAS_POR_MODO.get(modo, {}).get(planilla, {}).get('texto')
+
+
+# Caché de planillas ya leídas (la misma madre se sube varias veces al día con distintos ofimatic)
+MAX_BYTES_CACHE_PLANILLAS = int(os.environ.get('MAX_BYTES_CACHE_PLANILLAS', 128 * 1024 * 1024))
+TTL_CACHE_PLANILLAS_SEGUNDOS = int(os.environ.get('TTL_CACHE_PLANILLAS_SEGUNDOS', 1800))
+
+
+class CachePlanillas:
     """
-    Lee un archivo Excel desde contenido binario detectando automáticamente dónde comienzan los datos reales
+    Caché LRU en memoria de DataFrames leídos, indexada por el SHA-256 del contenido subido
+    más la variante de lectura (lector, columnas, fila de encabezados, columnas de texto).
+    Respeta un presupuesto de bytes y un TTL; cada acierto entrega una copia del DataFrame.
     """
-    # Primero intentar leer normalmente
+    
+    def __init__(self, max_bytes=MAX_BYTES_CACHE_PLANILLAS, ttl_segundos=TTL_CACHE_PLANILLAS_SEGUNDOS):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.ttl_segundos = ttl_segundos
+        self._entradas = OrderedDict()  # clave -> (df, bytes, creado)
+        self._bloqueo = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.bytes_en_uso = 0
+    
+    @staticmethod
+    def clave(contenido, *variante):
+        import hashlib
+        return (hashlib.sha256(contenido).hexdigest(),) + tuple(
+            tuple(parte) if isinstance(parte, (list, set)) else parte for parte in variante
+        )
+    
+    def obtener(self, clave):
+        with self._bloqueo:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and time.time() - entrada[2] > self.ttl_segundos:
+                self._quitar(clave)
+                entrada = None
+            if entrada is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            df = entrada[0]
+        return df.copy()
+    
+    def guardar(self, clave, df):
+        tamano = int(df.memory_usage(index=True, deep=True).sum())
+        if self.max_bytes <= 0 or tamano > self.max_bytes:
+            return
+        with self._bloqueo:
+            if clave in self._entradas:
+                self._quitar(clave)
+            self._entradas[clave] = (df.copy(), tamano, time.time())
+            self.bytes_en_uso += tamano
+            while self.bytes_en_uso > self.max_bytes:
+                self._quitar(next(iter(self._entradas)))
+                self.expulsiones += 1
+    
+    def _quitar(self, clave):
+        _, tamano, _ = self._entradas.pop(clave)
+        self.bytes_en_uso -= tamano
+    
+    def estadisticas(self):
+        with self._bloqueo:
+            consultas = self.aciertos + self.fallos
+            return {
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / consultas, 4) if consultas else 0.0,
+                'expulsiones': self.expulsiones,
+                'entradas': len(self._entradas),
+                'bytes_en_uso': self.bytes_en_uso,
+                'max_bytes': self.max_bytes
+            }
+
+
+cache_planillas = CachePlanillas()
+
+
+def leer_con_cache(lector, contenido, *variante, **opciones):
+    """
+    Llama a lector(contenido, **opciones) solo si la planilla no está en cache_planillas.
+    En un acierto df.attrs['lectura']['cache'] es True y no se vuelve a leer el archivo.
+    """
+    clave = CachePlanillas.clave(contenido, lector.__name__, *variante)
+    df = cache_planillas.obtener(clave)
+    traza = getattr(_contexto_trabajo, 'traza', None)
+    if traza is not None:
+        traza['cache_aciertos' if df is not None else 'cache_fallos'] += 1
+    if df is not None:
+        df.attrs['lectura'] = dict(df.attrs.get('lectura') or {}, cache=True)
+        print(f"♻️ Planilla tomada de la caché ({len(df)} filas)")
+        return df
+    
+    df = lector(contenido, **opciones)
+    df.attrs['lectura'] = dict(df.attrs.get('lectura') or {}, cache=False)
+    cache_planillas.guardar(clave, df)
+    return df
+
+
+def _convertir_celda_excel(celda):
+    """
+    Convierte una celda de openpyxl al mismo valor que usa pandas.read_excel
+    (vacío → "", error → NaN, números enteros → int)
+    """
+    from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+    
+    valor = celda.value
+    if valor is None:
+        return ''
+    if celda.data_type == TYPE_ERROR:
+        return float('nan')
+    if celda.data_type == TYPE_NUMERIC:
+        entero = int(valor)
+        return entero if entero == valor else float(valor)
+    return valor
+
+
+def leer_excel_inteligente_desde_contenido(contenido, columnas=None, fila_encabezados=None, columnas_texto=None):
+    """Lee un Excel con _leer_excel_inteligente, reutilizando la lectura si el archivo ya se subió"""
+    return leer_con_cache(
+        _leer_excel_inteligente, contenido, columnas or (), fila_encabezados, columnas_texto or (),
+        columnas=columnas, fila_encabezados=fila_encabezados, columnas_texto=columnas_texto
+    )
+
+
+def _leer_excel_inteligente(contenido, columnas=None, fila_encabezados=None, columnas_texto=None):
+    """
+    Lee un archivo Excel desde contenido binario detectando automáticamente dónde comienzan los datos reales.
+    
+    El libro se abre una sola vez en modo streaming (read_only): las primeras filas se usan
+    para localizar los encabezados y el DataFrame se construye con las mismas filas leídas.
+    La fila detectada y el tiempo de lectura quedan en df.attrs['lectura'].
+    
+    columnas: si se indica, solo se convierten las celdas de esas columnas (el resto se descarta al leer).
+    fila_encabezados: fila (desde 0) de los encabezados cuando se conoce de antemano (ej. 3 en ofimatic).
+    columnas_texto: columnas que llegan como texto sin pasar por float (NIT 123 → "123", vacío → NaN);
+    a los textos "123.0" se les quita el ".0".
+    """
+    from pandas.io.parsers import TextParser
+    
+    inicio = time.perf_counter()
+    encabezados_dados = fila_encabezados is not None
+    tipos = {columna: str for columna in columnas_texto} if columnas_texto else None
+    
+    try:
+        wb = openpyxl.load_workbook(BytesIO(contenido), read_only=True, data_only=True, keep_links=False)
+    except Exception:
+        # Formatos que openpyxl no abre (ej. .xls): dejar que pandas elija el motor
+        df = pd.read_excel(
+            BytesIO(contenido),
+            header=fila_encabezados if encabezados_dados else 0,
+            usecols=(lambda columna: columna in columnas) if columnas else None,
+            dtype=tipos
+        )
+        return limpiar_columnas_texto(df, columnas_texto)
+    
+    columnas = set(columnas) if columnas else None
+    indices = None  # Posiciones de las columnas que se conservan (None = todas)
+    columnas_en_archivo = 0
+    
     try:
-        df = pd.read_excel(BytesIO(contenido))
-        # Verificar si tiene columnas conocidas (madre, ofimatic, o ehlpharma)
-        columnas_madre = ['idOrder', 'authorizationNumber', 'typeOrder', 'identificationPatient']
-        columnas_ofimatic = ['nit', 'Nrodcto']
-        columnas_ehlpharma = ['IDENTIFICACION', 'NUMERO DE PEDIDO', 'DIRECCION DE ENTREGA', 'CELULAR', 'DOCUMENTO ASOCIADO']
+        ws = wb.active
+        ws.reset_dimensions()
         
-        if any(col in df.columns for col in columnas_madre + columnas_ofimatic + columnas_ehlpharma):
-            return df
-    except:
-        pass
+        filas = []
+        ultima_fila_con_datos = -1
+        
+        for numero_fila, fila in enumerate(ws.rows):
+            if indices is None:
+                valores = [_convertir_celda_excel(celda) for celda in fila]
+                while valores and valores[-1] == '':
+                    valores.pop()
+                tiene_datos = bool(valores)
+            else:
+                # Solo se convierten las celdas de las columnas que usa el modo
+                valores = [_convertir_celda_excel(fila[i]) if i < len(fila) else '' for i in indices]
+                tiene_datos = any(celda.value is not None and celda.value != '' for celda in fila)
+            if tiene_datos:
+                ultima_fila_con_datos = numero_fila
+            filas.append(valores)
+            
+            # Buscar los encabezados en las primeras filas mientras se lee
+            if fila_encabezados is None and numero_fila < FILAS_BUSQUEDA_ENCABEZADOS:
+                valores_fila = {str(valor).strip() for valor in valores if valor != ''}
+                if any(col in valores_fila for col in COLUMNAS_ENCABEZADO_CONOCIDAS):
+                    fila_encabezados = numero_fila
+            
+            # Con los encabezados ya ubicados, decidir qué columnas se conservan
+            if columnas is not None and indices is None and numero_fila == fila_encabezados:
+                indices = [i for i, valor in enumerate(valores) if valor in columnas]
+                columnas_en_archivo = len(valores)
+                filas[-1] = [valores[i] for i in indices]
+    finally:
+        wb.close()
     
-    # Si falla, buscar los encabezados usando openpyxl
-    wb = openpyxl.load_workbook(BytesIO(contenido), data_only=True)
-    ws = wb.active
-    
-    # Buscar la fila que contiene los encabezados
-    fila_encabezados = None
-    columnas_objetivo = [
-        'idOrder', 'authorizationNumber', 'identificationPatient',  # Medellín
-        'nit', 'Nrodcto',  # Ofimatic
-        'IDENTIFICACION', 'NUMERO DE PEDIDO', 'DIRECCION DE ENTREGA', 'CELULAR', 'DOCUMENTO ASOCIADO'  # Ehlpharma
-    ]
-    
-    for fila in range(1, min(20, ws.max_row + 1)):  # Buscar en las primeras 20 filas
-        valores_fila = []
-        for columna in range(1, min(50, ws.max_column + 1)):  # Buscar en las primeras 50 columnas
-            celda = ws.cell(row=fila, column=columna)
-            if celda.value:
-                valores_fila.append(str(celda.value).strip())
-        
-        # Verificar si esta fila contiene al menos 1 de las columnas objetivo
-        coincidencias = sum(1 for col in columnas_objetivo if col in valores_fila)
-        if coincidencias >= 1:
-            fila_encabezados = fila - 1  # -1 porque skiprows cuenta desde 0
-            print(f"✅ Encabezados encontrados en fila {fila}")
-            break
+    filas = filas[:ultima_fila_con_datos + 1]
+    
+    # La lectura anterior hacía read_excel + load_workbook completo + read_excel(skiprows)
+    # cuando los encabezados no estaban en la primera fila
+    lecturas_evitadas = 0 if encabezados_dados or fila_encabezados == 0 else 2
     
-    wb.close()
+    if fila_encabezados is None:
+        # Si no encontramos encabezados, usar el desplazamiento común de 4 filas
+        fila_encabezados = 4 if len(filas) > 4 else 0
+        print("⚠️ No se encontraron encabezados conocidos, usando fila", fila_encabezados + 1)
+    elif fila_encabezados > 0 and not encabezados_dados:
+        print(f"✅ Encabezados encontrados en fila {fila_encabezados + 1}")
     
-    # Leer el archivo con skiprows si encontramos los encabezados
-    if fila_encabezados is not None and fila_encabezados > 0:
-        df = pd.read_excel(BytesIO(contenido), skiprows=fila_encabezados)
+    filas = filas[fila_encabezados:]
+    if columnas is not None and indices is None and filas:
+        # Encabezados ubicados al final (valor por defecto): recortar las filas ya leídas
+        indices = [i for i, valor in enumerate(filas[0]) if valor in columnas]
+        columnas_en_archivo = len(filas[0])
+        filas = [[fila[i] if i < len(fila) else '' for i in indices] for fila in filas]
+    
+    if filas:
+        # Extender las filas al mismo ancho (igual que pandas)
+        ancho = max(len(fila) for fila in filas)
+        filas = [fila + [''] * (ancho - len(fila)) for fila in filas]
+        # skip_blank_lines=False: igual que pd.read_excel, las filas vacías intermedias se conservan
+        # Las columnas de texto no pasan por la inferencia numérica: los enteros llegan como "123"
+        df = limpiar_columnas_texto(TextParser(filas, header=0, skip_blank_lines=False, dtype=tipos).read(),
+                                    columnas_texto)
     else:
-        # Si no encontramos encabezados, intentar con skiprows común
+        df = pd.DataFrame()
+    
+    segundos = time.perf_counter() - inicio
+    df.attrs['lectura'] = {
+        'fila_encabezados': fila_encabezados + 1,
+        'segundos': round(segundos, 4),
+        'lecturas_evitadas': lecturas_evitadas,
+        'columnas_descartadas': columnas_en_archivo - len(indices) if indices is not None else 0
+    }
+    
+    return df
+
+# Parámetros de la detección de formato para CSV
+BYTES_MUESTRA_CSV = 64 * 1024
+FILAS_BUSQUEDA_ENCABEZADOS_CSV = 10
+DELIMITADORES_CSV = [';', ',', '\t']
+# Identificadores exportados como float en CSV ("1234.0" → "1234")
+PATRON_ENTERO_CON_DECIMALES = r'^(-?\d+)\.0*$'
+
+
+def limpiar_columnas_texto(df, columnas_texto):
+    """
+    Quita espacios y el ".0" de los identificadores leídos como texto: las celdas de texto "123.0"
+    (columnas float exportadas) llegan así tanto en CSV como en Excel
+    """
+    for columna in columnas_texto or []:
+        if columna in df.columns:
+            df[columna] = df[columna].str.strip().str.replace(PATRON_ENTERO_CON_DECIMALES, r'\1', regex=True)
+    return df
+
+
+def _detectar_codificacion_csv(muestra):
+    """
+    Detecta la codificación de un CSV a partir de sus primeros bytes.
+    Retorna (codificacion, confianza)
+    """
+    if muestra.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig', 1.0
+    
+    try:
+        # final=False tolera un carácter multibyte cortado al final de la muestra
+        import codecs
+        codecs.getincrementaldecoder('utf-8')().decode(muestra, final=False)
+        # Si todo es ASCII cualquier codificación sirve; UTF-8 es la más probable
+        return 'utf-8', (1.0 if any(b > 127 for b in muestra) else 0.9)
+    except UnicodeDecodeError:
+        pass
+    
+    # Bytes 0x80-0x9F son caracteres imprimibles en cp1252 y de control en latin-1
+    if any(0x80 <= b <= 0x9f for b in muestra):
         try:
-            df = pd.read_excel(BytesIO(contenido), skiprows=4)
-        except:
-            df = pd.read_excel(BytesIO(contenido))
+            muestra.decode('cp1252')
+            return 'cp1252', 0.8
+        except UnicodeDecodeError:
+            pass
+    return 'latin-1', 0.7
+
+
+def detectar_formato_csv(contenido, columnas_requeridas=None):
+    """
+    Detecta codificación, delimitador y fila de encabezados de un CSV usando solo los primeros KB.
+    
+    Si se indican columnas_requeridas, la fila de encabezados es la primera (de las primeras 10)
+    que las contiene todas con algún delimitador. Si no, se elige el delimitador que aparece un
+    número constante de veces en las primeras líneas.
+    
+    Retorna un diccionario de diagnóstico con la suposición hecha y su confianza (0 a 1).
+    """
+    import csv
+    
+    muestra = contenido[:BYTES_MUESTRA_CSV]
+    codificacion, confianza_codificacion = _detectar_codificacion_csv(muestra)
+    
+    lineas = muestra.decode(codificacion, errors='ignore').splitlines()
+    if len(contenido) > BYTES_MUESTRA_CSV and len(lineas) > 1:
+        lineas = lineas[:-1]  # La última línea de la muestra puede estar cortada
+    lineas_busqueda = lineas[:FILAS_BUSQUEDA_ENCABEZADOS_CSV]
+    
+    diagnostico = {
+        'codificacion': codificacion,
+        'delimitador': None,
+        'fila_encabezados': None,
+        'confianza': 0.0,
+        'metodo': None
+    }
+    
+    # Método 1: buscar la fila que contiene las columnas requeridas
+    if columnas_requeridas:
+        for numero_linea, linea in enumerate(lineas_busqueda):
+            for delimitador in DELIMITADORES_CSV:
+                if delimitador not in linea:
+                    continue
+                campos = {campo.strip() for campo in next(csv.reader([linea], delimiter=delimitador), [])}
+                if all(col in campos for col in columnas_requeridas):
+                    diagnostico.update({
+                        'delimitador': delimitador,
+                        'fila_encabezados': numero_linea + 1,
+                        'confianza': round(confianza_codificacion, 2),
+                        'metodo': 'columnas requeridas'
+                    })
+                    return diagnostico
+    
+    # Método 2: delimitador con conteo constante en las primeras líneas
+    lineas_con_datos = [linea for linea in lineas_busqueda if linea.strip()]
+    mejor = None
+    for delimitador in DELIMITADORES_CSV:
+        # Contar separadores con csv.reader para no contar los que están entre comillas
+        conteos = [len(campos) - 1 for campos in csv.reader(lineas_con_datos, delimiter=delimitador)]
+        if not conteos or max(conteos) == 0:
+            continue
+        conteo_comun = max(set(conteos), key=conteos.count)
+        if conteo_comun == 0:
+            continue
+        consistencia = conteos.count(conteo_comun) / len(conteos)
+        if mejor is None or consistencia > mejor[1]:
+            mejor = (delimitador, consistencia, conteos.index(conteo_comun))
+    
+    if mejor is not None:
+        delimitador, consistencia, primera_linea = mejor
+        # Saltar las líneas en blanco iniciales hasta la primera línea con el conteo común
+        numero_linea = lineas.index(lineas_con_datos[primera_linea])
+        diagnostico.update({
+            'delimitador': delimitador,
+            'fila_encabezados': numero_linea + 1,
+            'confianza': round(confianza_codificacion * consistencia * 0.8, 2),
+            'metodo': 'conteo de delimitadores'
+        })
+    else:
+        diagnostico.update({
+            'delimitador': ',',
+            'fila_encabezados': 1,
+            'confianza': round(confianza_codificacion * 0.3, 2),
+            'metodo': 'valores por defecto'
+        })
+    
+    return diagnostico
+
+
+def leer_csv_desde_contenido(contenido, columnas_requeridas=None, columnas=None, columnas_texto=None):
+    """Lee un CSV con _leer_csv, reutilizando la lectura si el archivo ya se subió"""
+    return leer_con_cache(
+        _leer_csv, contenido, columnas_requeridas or (), columnas or (), columnas_texto or (),
+        columnas_requeridas=columnas_requeridas, columnas=columnas, columnas_texto=columnas_texto
+    )
+
+
+def _leer_csv(contenido, columnas_requeridas=None, columnas=None, columnas_texto=None):
+    """
+    Lee un CSV desde contenido binario con una sola pasada de pd.read_csv.
+    El formato se detecta con detectar_formato_csv y el diagnóstico queda en df.attrs['lectura'].
+    Lanza ValueError si se indican columnas_requeridas y no se encuentran.
+    Si se indican columnas, las demás se descartan al parsear (usecols).
+    Las columnas_texto se leen como texto; el ".0" de los números exportados como float se quita.
+    """
+    inicio = time.perf_counter()
+    diagnostico = detectar_formato_csv(contenido, columnas_requeridas)
+    
+    if columnas_requeridas and diagnostico['metodo'] != 'columnas requeridas':
+        raise ValueError(
+            f"No se encontraron las columnas {columnas_requeridas} en las primeras "
+            f"{FILAS_BUSQUEDA_ENCABEZADOS_CSV} filas (codificación detectada: {diagnostico['codificacion']})"
+        )
+    
+    opciones = {
+        'sep': diagnostico['delimitador'],
+        'skiprows': diagnostico['fila_encabezados'] - 1
+    }
+    if columnas:
+        columnas = set(columnas)
+        opciones['usecols'] = lambda columna: columna in columnas
+    if columnas_texto:
+        opciones['dtype'] = {columna: str for columna in columnas_texto}
+    try:
+        df = pd.read_csv(BytesIO(contenido), encoding=diagnostico['codificacion'], **opciones)
+    except UnicodeDecodeError:
+        # Bytes no UTF-8 después de la muestra: latin-1 decodifica cualquier byte
+        diagnostico['codificacion'] = 'latin-1'
+        diagnostico['confianza'] = round(diagnostico['confianza'] * 0.7, 2)
+        df = pd.read_csv(BytesIO(contenido), encoding='latin-1', **opciones)
+    
+    limpiar_columnas_texto(df, columnas_texto)
+    
+    diagnostico['segundos'] = round(time.perf_counter() - inicio, 4)
+    print(f"✅ CSV leído: codificación={diagnostico['codificacion']}, delimitador={diagnostico['delimitador']!r}, "
+          f"encabezados en fila {diagnostico['fila_encabezados']} (confianza {diagnostico['confianza']})")
+    df.attrs['lectura'] = diagnostico
     
     return df
 
-def leer_archivo_ofimatic_desde_contenido(contenido, nombre_archivo):
+def leer_archivo_ofimatic_desde_contenido(contenido, nombre_archivo, columnas_texto=None):
     """
-    Lee contenido de archivo ofimatic (CSV o Excel) detectando automáticamente los headers
+    Lee contenido de archivo ofimatic (CSV o Excel) detectando automáticamente los headers.
+    columnas_texto: columnas que se leen como texto (ver leer_excel_inteligente_desde_contenido)
     """
     try:
         extension = os.path.splitext(nombre_archivo)[1].lower()
         
         if extension == '.csv':
-            # Para CSV, decodificar y buscar headers
-            codificaciones = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
-            
-            for encoding in codificaciones:
-                try:
-                    texto = contenido.decode(encoding)
-                    lines = texto.strip().split('\n')
-                    
-                    # Buscar la fila que contiene 'nit' y 'Nrodcto'
-                    for skip_rows in range(min(10, len(lines))):
-                        try:
-                            contenido_procesado = '\n'.join(lines[skip_rows:])
-                            df_test = pd.read_csv(StringIO(contenido_procesado), delimiter=';')
-                            if 'nit' in df_test.columns and 'Nrodcto' in df_test.columns:
-                                print(f"✅ Headers encontrados en fila {skip_rows + 1} con codificación {encoding}")
-                                return df_test
-                        except:
-                            try:
-                                contenido_procesado = '\n'.join(lines[skip_rows:])
-                                df_test = pd.read_csv(StringIO(contenido_procesado), delimiter=',')
-                                if 'nit' in df_test.columns and 'Nrodcto' in df_test.columns:
-                                    print(f"✅ Headers encontrados en fila {skip_rows + 1} con codificación {encoding}")
-                                    return df_test
-                            except:
-                                continue
-                except:
-                    continue
+            # Para CSV, detectar formato con los primeros KB y leer una sola vez
+            return leer_csv_desde_contenido(contenido, ['nit', 'Nrodcto'], columnas_texto=columnas_texto)
                     
         elif extension in ['.xlsx', '.xls']:
             # Usar la función inteligente para Excel
-            df = leer_excel_inteligente_desde_contenido(contenido)
+            df = leer_excel_inteligente_desde_contenido(contenido, columnas_texto=columnas_texto)
             
             # Verificar que tenga las columnas necesarias para ofimatic
             if 'nit' not in df.columns or 'Nrodcto' not in df.columns:
@@ -191,204 +601,1748 @@ def leer_archivo_desde_contenido(contenido, nombre_archivo, es_ofimatic=False):
         raise Exception(f"Error al leer el archivo {nombre_archivo}: {str(e)}")
 
 
-def leer_planilla_inicial_bogota(contenido):
+def leer_planilla_inicial_bogota(contenido):
+    """
+    Lee la planilla inicial de Bogotá manteniendo el formato original.
+    La planilla tiene 3 filas de encabezado antes de los datos.
+    """
+    # Leer todo el archivo sin procesar
+    df_completo = pd.read_excel(BytesIO(contenido), header=None)
+    
+    # Los encabezados están en la fila 3 (índice 3)
+    encabezados = df_completo.iloc[3].tolist()
+    
+    # Los datos comienzan desde la fila 4 (índice 4)
+    df_datos = pd.read_excel(BytesIO(contenido), skiprows=4)
+    df_datos.columns = encabezados
+    
+    # Guardar las primeras 4 filas para mantener el formato original
+    filas_encabezado = df_completo.iloc[0:4]
+    
+    return df_datos, filas_encabezado, encabezados
+
+
+def leer_planilla_pedidos_bogota(contenido):
+    """
+    Lee la planilla de pedidos con la estructura actual (solo las columnas que usa el modo Bogotá).
+    """
+    df = leer_excel_inteligente_desde_contenido(
+        contenido, columnas=columnas_de_planilla('bogota', 'pedidos'), fila_encabezados=0
+    )
+    
+    # Convertir IDENTIFICACION a string para facilitar la comparación
+    if 'IDENTIFICACION' in df.columns:
+        df['IDENTIFICACION'] = df['IDENTIFICACION'].astype(str).str.strip()
+    
+    return df
+
+
+def relacionar_por_nit_bogota(df_inicial, df_pedidos):
+    """
+    Relaciona las planillas por NIT o por DOCUMENTO ASOCIADO.
+    Actualiza el campo Nrodcto con el formato: Nrodcto-NUMERO_DE_PEDIDO
+    
+    Intenta dos métodos de relación:
+    1. Por NIT (nit == IDENTIFICACION)
+    2. Por documento (Nrodcto normalizado == DOCUMENTO ASOCIADO normalizado)
+    
+    Ambos métodos se aplican sobre columnas completas (map + coalesce), sin recorrer filas.
+    Los conteos quedan en df_inicial.attrs['relacion'] (por_nit, por_documento, sin_coincidencia).
+    """
+    # Convertir nit a string para comparación
+    df_inicial['nit'] = df_inicial['nit'].astype(str).str.strip()
+    
+    def normalizar_documentos(docs):
+        """Normaliza documentos quitando guiones y espacios y convirtiendo a mayúsculas"""
+        return (docs.astype(str).str.strip().str.upper()
+                .str.replace('-', '', regex=False).str.replace(' ', '', regex=False))
+    
+    # Convertir NUMERO DE PEDIDO a string sin decimales (vacío si no hay pedido)
+    num_pedido = df_pedidos['NUMERO DE PEDIDO']
+    num_pedido_float = pd.to_numeric(num_pedido, errors='coerce')
+    es_entero = num_pedido_float.abs() < 2**63
+    es_texto = num_pedido.notna() & ~es_entero
+    num_pedido_texto = pd.Series('', index=num_pedido.index, dtype=object)
+    num_pedido_texto[es_entero] = num_pedido_float[es_entero].astype('int64').astype(str)
+    num_pedido_texto[es_texto] = num_pedido[es_texto].astype(str).str.strip()
+    
+    # Crear mapeos (si un NIT o documento se repite, gana la última fila)
+    # 1. NIT -> NUMERO DE PEDIDO
+    pedidos_por_nit = pd.Series(num_pedido_texto.values,
+                                index=df_pedidos['IDENTIFICACION'].astype(str).str.strip().values)
+    pedidos_por_nit = pedidos_por_nit[~pedidos_por_nit.index.duplicated(keep='last')]
+    
+    # 2. DOCUMENTO NORMALIZADO -> NUMERO DE PEDIDO
+    pedidos_por_doc = pd.Series(dtype=object)
+    if 'DOCUMENTO ASOCIADO' in df_pedidos.columns:
+        docs = df_pedidos['DOCUMENTO ASOCIADO']
+        docs_normalizados = normalizar_documentos(docs)
+        con_doc = docs.notna() & (docs_normalizados != '')
+        pedidos_por_doc = pd.Series(num_pedido_texto[con_doc].values, index=docs_normalizados[con_doc].values)
+        pedidos_por_doc = pedidos_por_doc[~pedidos_por_doc.index.duplicated(keep='last')]
+    
+    print(f"Total de NITs en pedidos: {len(pedidos_por_nit)}")
+    print(f"Total de DOCUMENTOS en pedidos: {len(pedidos_por_doc)}")
+    print(f"Total de registros en planilla inicial: {len(df_inicial)}")
+    
+    nrodcto_actual = df_inicial['Nrodcto'].astype(str)
+    
+    # Método 1: por NIT. Método 2: por DOCUMENTO, solo donde no hubo NIT
+    pedido_por_nit = df_inicial['nit'].map(pedidos_por_nit)
+    pedido_por_nit = pedido_por_nit.mask(pedido_por_nit == '')
+    pedido_por_doc = normalizar_documentos(nrodcto_actual).map(pedidos_por_doc)
+    pedido_por_doc = pedido_por_doc.mask(pedido_por_doc == '')
+    num_pedido_final = pedido_por_nit.fillna(pedido_por_doc)
+    
+    encontrados = num_pedido_final.notna()
+    registros_actualizados_nit = int(pedido_por_nit.notna().sum())
+    registros_actualizados_doc = int(encontrados.sum()) - registros_actualizados_nit
+    registros_no_encontrados = int((~encontrados).sum())
+    
+    # Crear el nuevo formato: Nrodcto-NUMERO_DE_PEDIDO
+    df_inicial['Nrodcto'] = (nrodcto_actual + '-' + num_pedido_final).where(encontrados, df_inicial['Nrodcto'])
+    
+    total_actualizados = registros_actualizados_nit + registros_actualizados_doc
+    df_inicial.attrs['relacion'] = {
+        'por_nit': registros_actualizados_nit,
+        'por_documento': registros_actualizados_doc,
+        'sin_coincidencia': registros_no_encontrados
+    }
+    print(f"\nRegistros actualizados por NIT: {registros_actualizados_nit}")
+    print(f"Registros actualizados por DOCUMENTO: {registros_actualizados_doc}")
+    print(f"Total actualizados: {total_actualizados}")
+    print(f"Registros sin coincidencia: {registros_no_encontrados}")
+    
+    if registros_no_encontrados and registros_no_encontrados <= 5:
+        ejemplos = (df_inicial['nit'] + '|' + nrodcto_actual)[~encontrados].tolist()
+        print(f"Ejemplos de registros no encontrados: {ejemplos}")
+    
+    return df_inicial
+
+
+def guardar_con_formato_bogota(df_datos, filas_encabezado):
+    """
+    Guarda el DataFrame manteniendo el formato original de la planilla inicial.
+    Escribe en modo write-only (fila por fila, sin mantener las celdas en memoria).
+    Retorna el BytesIO con el Excel generado.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment, PatternFill
+    from openpyxl.utils.dataframe import dataframe_to_rows
+    
+    # Crear un workbook en modo write-only
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    
+    fuente_titulo = Font(bold=True, size=12)
+    relleno_encabezado = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
+    fuente_encabezado = Font(bold=True)
+    alineacion_encabezado = Alignment(horizontal='center', vertical='center')
+    
+    # Escribir las primeras 4 filas de encabezado originales
+    for r_idx, row in enumerate(filas_encabezado.values, start=1):
+        celdas = []
+        for value in row:
+            cell = WriteOnlyCell(ws, value=value)
+            if r_idx == 1:  # Título
+                cell.font = fuente_titulo
+            elif r_idx == 4:  # Encabezados de columnas
+                cell.fill = relleno_encabezado
+                cell.font = fuente_encabezado
+                cell.alignment = alineacion_encabezado
+            celdas.append(cell)
+        ws.append(celdas)
+    
+    # Escribir los datos actualizados a partir de la fila 5
+    for row in dataframe_to_rows(df_datos, index=False, header=False):
+        ws.append(row)
+    
+    # Guardar en BytesIO
+    excel_buffer = BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+    
+    return excel_buffer
+
+
+def aplicar_por_valor_unico(serie, funcion):
+    """
+    Aplica funcion una sola vez por cada valor distinto de la serie y reparte el resultado
+    a todas las filas (las columnas de ciudades tienen pocas decenas de valores distintos).
+    Los vacíos (NaN/None) se resuelven con funcion(None).
+    """
+    codigos, unicos = pd.factorize(serie, use_na_sentinel=True)
+    resultados = np.empty(len(unicos) + 1, dtype=object)
+    resultados[:len(unicos)] = [funcion(valor) for valor in unicos]
+    resultados[-1] = funcion(None)
+    return pd.Series(resultados[codigos], index=serie.index)
+
+
+@functools.lru_cache(maxsize=4096)
+def _quitar_tildes_mayusculas(texto):
+    import unicodedata
+    descompuesto = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c)).upper()
+
+
+def normalizar_ciudad(ciudad):
+    """
+    Normaliza el nombre de la ciudad:
+    - Elimina tildes y diacríticos (cualquier letra Unicode: "Medellín" → "MEDELLIN", "Ñ" → "N")
+    - Convierte a MAYÚSCULAS
+    """
+    if not ciudad or pd.isna(ciudad):
+        return ''
+    return _quitar_tildes_mayusculas(str(ciudad).strip())
+
+
+def normalizar_ciudades(serie):
+    """normalizar_ciudad sobre una columna completa, calculada una vez por ciudad distinta"""
+    return aplicar_por_valor_unico(serie, normalizar_ciudad)
+
+
+def limpiar_telefono(telefono):
+    """
+    Limpia y valida un teléfono: quita el .0 de los números leídos como float y descarta
+    vacíos, 'nan', 'none' y números de solo ceros (000). Retorna el texto o None.
+    """
+    if pd.isna(telefono):
+        return None
+    
+    telefono_str = str(telefono).strip()
+    
+    # Eliminar .0 al final si existe
+    if telefono_str.endswith('.0'):
+        telefono_str = telefono_str[:-2]
+    
+    # Convertir a int y luego a str si es un número flotante
+    try:
+        if '.' in str(telefono):
+            telefono_str = str(int(float(telefono)))
+    except:
+        pass
+    
+    # Validar que no sea vacío, nan, none, o inválido
+    if not telefono_str or telefono_str.lower() in ['nan', 'none', '']:
+        return None
+    
+    # Validar que no sea solo ceros (000, 0000, etc.)
+    if telefono_str.replace('0', '') == '':
+        return None
+    
+    return telefono_str
+
+
+def limpiar_telefonos(serie):
+    """
+    limpiar_telefono sobre una columna completa con operaciones vectorizadas de numpy.
+    Los casos comunes (texto de solo dígitos, enteros y floats enteros) se resuelven en bloque;
+    el resto (decimales, letras, etc.) pasa por limpiar_telefono, así el resultado es idéntico.
+    """
+    if serie.dtype.kind in 'iub':
+        serie = serie.astype(str)
+    valores = serie.to_numpy(dtype=object)
+    resultado = np.full(len(valores), None, dtype=object)
+    en_bloque = np.zeros(len(valores), dtype=bool)
+    
+    if serie.dtype.kind == 'f':
+        # Floats enteros por debajo de 1e16 (str() los escribe sin exponente): 3001234567.0 → "3001234567"
+        numeros = serie.to_numpy(dtype='float64')
+        en_bloque = np.isfinite(numeros) & (np.abs(numeros) < 1e16) & (numeros == np.floor(numeros))
+        texto = numeros[en_bloque].astype('int64').astype(str)
+    else:
+        # Texto de solo dígitos ASCII (después de quitar espacios)
+        es_texto = np.fromiter((type(valor) is str for valor in valores), dtype=bool, count=len(valores))
+        texto = np.char.strip(valores[es_texto].astype(str))
+        codigos = texto.view(np.uint32).reshape(len(texto), texto.itemsize // 4)
+        digitos = np.char.isdigit(texto) & (codigos < 128).all(axis=1)
+        en_bloque[np.flatnonzero(es_texto)[digitos]] = True
+        texto = texto[digitos]
+    
+    # Descartar los números de solo ceros (000, 0000, etc.)
+    validos = np.char.strip(texto, '0') != ''
+    posiciones = np.flatnonzero(en_bloque)
+    resultado[posiciones[validos]] = texto[validos].astype(object)
+    
+    restantes = ~en_bloque & pd.notna(valores)
+    if restantes.any():
+        resultado[restantes] = [limpiar_telefono(valor) for valor in valores[restantes]]
+    
+    return pd.Series(resultado, index=serie.index)
+
+
+def construir_direcciones(direcciones_base, ciudades, departamento):
+    """
+    Construye la columna de direcciones "direccion, CIUDAD, Departamento" a partir de la dirección
+    base y la ciudad ya normalizada ('' cuando no hay). Mismas reglas que la versión por fila:
+    - A la dirección no vacía se le agrega una coma al final si no la tiene
+    - Sin ciudad: "direccion, Departamento"; sin dirección: "CIUDAD, Departamento"; sin ninguna: "Departamento"
+    """
+    base = direcciones_base.to_numpy(dtype=object)
+    ciudad = ciudades.to_numpy(dtype=object)
+    con_base = base != ''
+    con_ciudad = ciudad != ''
+    
+    sin_coma = con_base & ~direcciones_base.str.endswith(',').to_numpy(dtype=bool)
+    base = np.where(sin_coma, base + ',', base)
+    
+    parte_base = np.where(con_base, base + ' ', '')
+    parte_ciudad = np.where(con_ciudad, ciudad + ', ', '')
+    return pd.Series(parte_base + parte_ciudad + departamento, index=direcciones_base.index, dtype=object)
+
+
+def _texto_sin_espacios(serie):
+    """str(valor).strip() de cada valor de la columna"""
+    return serie.astype(str).str.strip()
+
+
+# ============================================================================
+# Motor de mapeo a Libro2
+# Cada fuente declara de qué columna(s) sale cada columna de Libro2 y con qué kernel.
+# Las especificaciones se compilan una vez (al importar) a funciones vectorizadas sobre
+# el DataFrame ya relacionado; una fuente nueva solo necesita su especificación.
+# ============================================================================
+
+LIBRO2_COLUMNAS = ['Nombre Vehiculo', 'Título de la Visita', 'Dirección', 'Latitud', 'Longitud',
+                   'ID Referencia', 'Notas', 'Persona de Contacto', 'Teléfono', 'Emails']
+
+
+def _municipio_desde_titulo(serie):
+    """
+    Municipio del campo "Titulo de la Visita" de Distrifarma (lo que va antes del primer guion):
+    "La Estrella-Antioquia-Colombia" → "La Estrella". Los vacíos quedan en ''.
+    """
+    municipio = _texto_sin_espacios(serie).str.split('-', n=1).str[0].str.strip()
+    return municipio.where(serie.notna(), '')
+
+
+def _texto_con_espacios_simples(serie):
+    """Texto sin espacios al inicio/final y con los espacios repetidos reducidos a uno; vacíos → ''"""
+    texto = _texto_sin_espacios(serie).str.replace(r'\s+', ' ', regex=True)
+    return texto.where(serie.notna(), '')
+
+
+def _telefonos_limpios(serie):
+    """limpiar_telefonos saltando los valores vacíos ('' y 0 de los mapeos sin coincidencia)"""
+    con_valor = serie.to_numpy(dtype=object).astype(bool)
+    return limpiar_telefonos(serie.where(con_valor, np.nan))
+
+
+# Normalizaciones disponibles para las columnas de origen (kernel 'normalizar' y partes de 'concatenar')
+NORMALIZACIONES_LIBRO2 = {
+    'texto': _texto_sin_espacios,
+    'espacios': _texto_con_espacios_simples,
+    'municipio': _municipio_desde_titulo,
+    'telefono': _telefonos_limpios,
+}
+
+# Especificación por fuente. Kernels:
+# - columna:      valor de la columna tal cual ('defecto' si no existe)
+# - constante:    el mismo valor en todas las filas
+# - normalizar:   columna pasada por una de NORMALIZACIONES_LIBRO2
+# - concatenar:   une 'partes' con 'separador'. Una parte es un nombre de columna (disponible si no es
+#                 vacía) o {'columna', 'normalizacion'} (disponible si no queda en ''). Con 'respaldo':
+#                 None une siempre; 'disponibles' une solo las partes disponibles; 'primera' deja la
+#                 primera parte (o '') si falta alguna; 'valor' deja el valor original de la primera columna
+# - coalescer:    primer valor no vacío (ni None/NaN ni '') entre 'columnas', normalizadas con
+#                 'normalizacion' si se indica (con 'telefono' los números inválidos quedan vacíos)
+# - prefijo:      IDs con letras y números se dejan igual; al resto se antepone "<prefijo>-"; vacíos → prefijo
+# - direccion:    construir_direcciones(base, ciudad, departamento)
+# - alternativas: la primera regla cuyas columnas existan en la planilla
+# Las columnas de Libro2 que no aparecen quedan vacías (None).
+MAPEOS_LIBRO2 = {
+    'medellin': {
+        'Nombre Vehiculo': {'kernel': 'normalizar', 'columna': 'NomMensajero', 'normalizacion': 'texto', 'defecto': ''},
+        'Título de la Visita': {
+            'kernel': 'concatenar', 'separador': ' - ', 'respaldo': 'disponibles',
+            'partes': [{'columna': 'NOMBRE', 'normalizacion': 'espacios'}, {'columna': 'nit', 'normalizacion': 'texto'}]
+        },
+        'Dirección': {'kernel': 'direccion', 'base': 'direccion_base', 'ciudad': 'ciudad_normalizada',
+                      'departamento': 'Antioquia'},
+        'ID Referencia': {'kernel': 'columna', 'columna': 'Nrodcto_relacionado'},
+        'Notas': {'kernel': 'columna', 'columna': 'TipoVta', 'defecto': ''},
+        'Teléfono': {'kernel': 'coalescer', 'columnas': ['phonePatient_madre', 'TEL1', 'TEL2'],
+                     'normalizacion': 'telefono'},
+    },
+    'bogota': {
+        'Nombre Vehiculo': {'kernel': 'columna', 'columna': 'NomMensajero', 'defecto': ''},
+        'Título de la Visita': {'kernel': 'columna', 'columna': 'NOMBRE', 'defecto': ''},
+        'Dirección': {'kernel': 'direccion', 'base': 'direccion_base', 'ciudad': 'ciudad_normalizada',
+                      'departamento': 'Cundinamarca'},
+        'ID Referencia': {'kernel': 'columna', 'columna': 'Nrodcto_relacionado'},
+        'Notas': {'kernel': 'columna', 'columna': 'TipoVta', 'defecto': ''},
+        'Teléfono': {'kernel': 'coalescer', 'columnas': ['phone_ehlpharma', 'TEL1', 'TEL2'],
+                     'normalizacion': 'telefono'},
+    },
+    'farmabogota': {
+        'Nombre Vehiculo': {'kernel': 'constante', 'valor': ''},
+        'Título de la Visita': {'kernel': 'columna', 'columna': 'PACIENTE'},
+        'Dirección': {'kernel': 'concatenar', 'separador': ', ', 'respaldo': None,
+                      'partes': ['DIRECCION DE ENTREGA', 'CIUDAD DE ENTREGA']},
+        'ID Referencia': {'kernel': 'concatenar', 'separador': '-', 'respaldo': 'valor',
+                          'partes': ['DOCUMENTO ASOCIADO', 'NUMERO DE PEDIDO']},
+        'Notas': {'kernel': 'constante', 'valor': ''},
+        # Los números de solo ceros quedan vacíos, también el float 0.0 (la versión anterior dejaba "0")
+        'Teléfono': {'kernel': 'coalescer', 'columnas': ['CELULAR'], 'normalizacion': 'telefono'},
+    },
+    'distrifarma': {
+        'Nombre Vehiculo': {'kernel': 'normalizar', 'columna': 'Nombre Vehiculo', 'normalizacion': 'texto',
+                            'defecto': ''},
+        # Formato antiguo: Persona de Contacto - CEDULA; formato Carmen: Persona de Contacto - Teléfono
+        'Título de la Visita': {'kernel': 'alternativas', 'defecto': '', 'reglas': [
+            {'kernel': 'concatenar', 'separador': ' - ', 'respaldo': 'primera',
+             'partes': ['Persona de Contacto', 'CEDULA']},
+            {'kernel': 'concatenar', 'separador': ' - ', 'respaldo': 'primera',
+             'partes': ['Persona de Contacto', 'Teléfono']},
+            {'kernel': 'columna', 'columna': 'Persona de Contacto'},
+        ]},
+        # Dirección + ", " + municipio extraído del "Titulo de la Visita" original
+        'Dirección': {'kernel': 'alternativas', 'reglas': [
+            {'kernel': 'concatenar', 'separador': ', ', 'respaldo': 'primera',
+             'partes': ['Dirección', {'columna': 'Titulo de la Visita', 'normalizacion': 'municipio'}]},
+            {'kernel': 'columna', 'columna': 'Dirección'},
+        ]},
+        'Latitud': {'kernel': 'columna', 'columna': 'Latitud'},
+        'Longitud': {'kernel': 'columna', 'columna': 'Longitud'},
+        'ID Referencia': {'kernel': 'prefijo', 'columna': 'ID Referencia', 'prefijo': 'Diswifarma'},
+        'Notas': {'kernel': 'alternativas', 'defecto': '', 'reglas': [
+            {'kernel': 'columna', 'columna': 'INTEGRADOS'},
+            {'kernel': 'columna', 'columna': 'Notas'},
+        ]},
+        'Persona de Contacto': {'kernel': 'columna', 'columna': 'Persona de Contacto'},
+        'Teléfono': {'kernel': 'columna', 'columna': 'Teléfono'},
+        'Emails': {'kernel': 'columna', 'columna': 'Emails'},
+    },
+}
+
+
+def _compilar_parte(parte):
+    """Compila una parte de 'concatenar' a (columna, función df → (texto, disponible))"""
+    if isinstance(parte, str):
+        def valor(df, columna=parte):
+            serie = df[columna]
+            return serie.astype(str).to_numpy(dtype=object), serie.notna().to_numpy()
+        return parte, valor
+    
+    normalizar = NORMALIZACIONES_LIBRO2[parte['normalizacion']]
+    
+    def valor(df, columna=parte['columna']):
+        texto = normalizar(df[columna]).to_numpy(dtype=object)
+        return texto, texto != ''
+    return parte['columna'], valor
+
+
+def _compilar_concatenar(regla):
+    columnas, partes = zip(*[_compilar_parte(parte) for parte in regla['partes']])
+    separador = regla['separador']
+    respaldo = regla.get('respaldo')
+    if respaldo not in (None, 'disponibles', 'primera', 'valor'):
+        raise ValueError(f"Respaldo desconocido en concatenar: {respaldo}")
+    
+    def concatenar(df):
+        valores = [parte(df) for parte in partes]
+        if respaldo == 'disponibles':
+            resultado = np.full(len(df), '', dtype=object)
+            for texto, disponible in valores:
+                con_previo = resultado != ''
+                resultado = np.where(disponible, np.where(con_previo, resultado + separador + texto, texto), resultado)
+            return pd.Series(resultado, index=df.index, dtype=object)
+        
+        unido = valores[0][0]
+        for texto, _ in valores[1:]:
+            unido = unido + separador + texto
+        if respaldo is None:
+            return pd.Series(unido, index=df.index, dtype=object)
+        
+        completas = np.logical_and.reduce([disponible for _, disponible in valores])
+        if respaldo == 'primera':
+            primera, con_primera = valores[0]
+            alterno = np.where(con_primera, primera, '')
+        else:
+            alterno = df[columnas[0]].to_numpy(dtype=object)
+        return pd.Series(np.where(completas, unido, alterno), index=df.index, dtype=object)
+    return list(columnas), concatenar
+
+
+def _compilar_coalescer(regla):
+    normalizar = NORMALIZACIONES_LIBRO2[regla['normalizacion']] if regla.get('normalizacion') else None
+    
+    def coalescer(df):
+        columnas = [df[columna] for columna in regla['columnas'] if columna in df.columns]
+        if not columnas:
+            return pd.Series(None, index=df.index, dtype=object)
+        if normalizar is not None:
+            columnas = [normalizar(columna) for columna in columnas]
+        resultado = columnas[0].to_numpy(dtype=object).copy()
+        for columna in columnas[1:]:
+            vacios = pd.isna(resultado) | (resultado == '')
+            resultado[vacios] = columna.to_numpy(dtype=object)[vacios]
+        return pd.Series(resultado, index=df.index, dtype=object)
+    # Las columnas ausentes se saltan: la regla aplica siempre
+    return [], coalescer
+
+
+def _compilar_prefijo(regla):
+    prefijo = regla['prefijo']
+    
+    def agregar_prefijo(df):
+        serie = df[regla['columna']]
+        texto = _texto_sin_espacios(serie)
+        # Letras (cualquier alfabeto, sin dígitos ni '_') y dígitos en el mismo ID
+        tiene_letras_y_numeros = (texto.str.contains(r'[^\W\d_]', regex=True)
+                                  & texto.str.contains(r'\d', regex=True)).to_numpy(dtype=bool)
+        con_prefijo = prefijo + '-' + texto.to_numpy(dtype=object)
+        resultado = np.where(tiene_letras_y_numeros, texto.to_numpy(dtype=object), con_prefijo)
+        resultado = np.where(serie.notna().to_numpy(), resultado, prefijo)
+        return pd.Series(resultado, index=df.index, dtype=object)
+    return [regla['columna']], agregar_prefijo
+
+
+def _compilar_alternativas(regla):
+    alternativas = [compilar_regla_libro2(alternativa) for alternativa in regla['reglas']]
+    defecto = regla.get('defecto')
+    
+    def primera_aplicable(df):
+        for columnas, funcion in alternativas:
+            if all(columna in df.columns for columna in columnas):
+                return funcion(df)
+        return defecto
+    return [], primera_aplicable
+
+
+def compilar_regla_libro2(regla):
+    """
+    Compila una regla de MAPEOS_LIBRO2 a (columnas requeridas, función df → Series o escalar).
+    Los errores de la especificación (kernel o normalización desconocidos) se detectan aquí.
+    """
+    kernel = regla['kernel']
+    if kernel == 'constante':
+        return [], lambda df: regla['valor']
+    if kernel == 'columna':
+        return [regla['columna']], lambda df: df[regla['columna']]
+    if kernel == 'normalizar':
+        normalizar = NORMALIZACIONES_LIBRO2[regla['normalizacion']]
+        return [regla['columna']], lambda df: normalizar(df[regla['columna']])
+    if kernel == 'concatenar':
+        return _compilar_concatenar(regla)
+    if kernel == 'coalescer':
+        return _compilar_coalescer(regla)
+    if kernel == 'prefijo':
+        return _compilar_prefijo(regla)
+    if kernel == 'direccion':
+        return [regla['base'], regla['ciudad']], lambda df: construir_direcciones(
+            df[regla['base']], df[regla['ciudad']], regla['departamento']
+        )
+    if kernel == 'alternativas':
+        return _compilar_alternativas(regla)
+    raise ValueError(f"Kernel de mapeo Libro2 desconocido: {kernel}")
+
+
+def compilar_mapeo_libro2(especificacion):
+    """
+    Compila la especificación de una fuente a [(columna Libro2, columnas requeridas, función, defecto)]
+    en el orden de LIBRO2_COLUMNAS
+    """
+    compilado = []
+    for columna in LIBRO2_COLUMNAS:
+        regla = especificacion.get(columna, {'kernel': 'constante', 'valor': None})
+        requeridas, funcion = compilar_regla_libro2(regla)
+        compilado.append((columna, requeridas, funcion, regla.get('defecto')))
+    return compilado
+
+
+MAPEOS_LIBRO2_COMPILADOS = {
+    fuente: compilar_mapeo_libro2(especificacion) for fuente, especificacion in MAPEOS_LIBRO2.items()
+}
+
+
+def construir_libro2(df, mapeo):
+    """
+    Construye el DataFrame Libro2 a partir de la planilla ya relacionada.
+    mapeo es el nombre de una fuente de MAPEOS_LIBRO2 o una especificación ya compilada.
+    Las columnas requeridas que falten en la planilla dejan el valor 'defecto' de la regla.
+    """
+    if isinstance(mapeo, str):
+        mapeo = MAPEOS_LIBRO2_COMPILADOS[mapeo]
+    
+    datos = {}
+    for columna, requeridas, funcion, defecto in mapeo:
+        if all(requerida in df.columns for requerida in requeridas):
+            datos[columna] = funcion(df)
+        else:
+            datos[columna] = defecto
+    return pd.DataFrame(datos, index=df.index)
+
+
+# Ancho de columnas en los Excel generados: texto más largo + 2, con un máximo de 50.
+# En tablas muy grandes se mide una muestra fija de filas en lugar de todas.
+ANCHO_MAXIMO_COLUMNA = 50
+FILAS_MUESTRA_ANCHOS = 200000
+
+
+def calcular_anchos_columnas(df, ancho_maximo=ANCHO_MAXIMO_COLUMNA, filas_muestra=FILAS_MUESTRA_ANCHOS):
+    """
+    Calcula el ancho de cada columna a partir del DataFrame (no de las celdas de openpyxl):
+    largo del texto más largo entre el encabezado y los valores no vacíos, + 2.
+    Retorna una lista con un ancho por columna.
+    """
+    if len(df) > filas_muestra:
+        df = df.sample(n=filas_muestra, random_state=0)
+
+    anchos = []
+    for posicion, nombre in enumerate(df.columns):
+        serie = df.iloc[:, posicion]
+        # Vacíos, 0 y False no cuentan (igual que el ajuste anterior celda por celda)
+        valores = serie.to_numpy()
+        if serie.dtype == object:
+            valores = valores[pd.notna(valores)]
+            valores = valores[valores.astype(bool)]
+        elif pd.api.types.is_datetime64_any_dtype(serie):
+            valores = np.array([str(valor) for valor in serie.dropna().unique()], dtype=object)
+        elif pd.api.types.is_numeric_dtype(serie) or pd.api.types.is_bool_dtype(serie):
+            # Como objetos de Python para que el texto sea el mismo que str(valor)
+            valores = pd.unique(valores[pd.notna(valores) & (valores != 0)]).astype(object)
+
+        # Como objetos (no texto de ancho fijo de numpy, que reserva el largo máximo en cada fila)
+        largo_valores = int(pd.Series(valores, dtype=object).astype(str).str.len().max()) if len(valores) else 0
+        largo_maximo = max(len(str(nombre)), largo_valores)
+        anchos.append(min(largo_maximo + 2, ancho_maximo))
+    return anchos
+
+
+def ajustar_anchos_columnas(worksheet, df):
+    """Aplica a la hoja los anchos calculados desde el DataFrame, sin recorrer las celdas"""
+    from openpyxl.utils import get_column_letter
+
+    for indice, ancho in enumerate(calcular_anchos_columnas(df), start=1):
+        worksheet.column_dimensions[get_column_letter(indice)].width = ancho
+
+
+class PaginaPrecomprimida:
+    """
+    Página servida desde bytes construidos una sola vez: versión sin comprimir, gzip y
+    brotli (si el paquete está instalado), cada una con su ETag fuerte para responder 304
+    """
+    def __init__(self, contenido, tipo_contenido='text/html; charset=utf-8'):
+        import gzip
+        import hashlib
+
+        datos = contenido.encode('utf-8')
+        self.tipo_contenido = tipo_contenido
+        self.variantes = {'identity': datos, 'gzip': gzip.compress(datos, compresslevel=9, mtime=0)}
+        try:
+            import brotli
+            self.variantes['br'] = brotli.compress(datos)
+        except ImportError:
+            pass
+
+        huella = hashlib.sha256(datos).hexdigest()[:32]
+        self.etags = {
+            codificacion: f'"{huella}"' if codificacion == 'identity' else f'"{huella}-{codificacion}"'
+            for codificacion in self.variantes
+        }
+
+    def elegir_codificacion(self, accept_encoding):
+        """Elige la mejor variante aceptada por el cliente (respeta q=0)"""
+        aceptadas = {}
+        for parte in (accept_encoding or '').split(','):
+            nombre, _, parametros = parte.partition(';')
+            nombre = nombre.strip().lower()
+            calidad = 1.0
+            parametros = parametros.strip()
+            if parametros.startswith('q='):
+                try:
+                    calidad = float(parametros[2:])
+                except ValueError:
+                    calidad = 0.0
+            if nombre:
+                aceptadas[nombre] = calidad
+
+        for codificacion in ('br', 'gzip'):
+            if codificacion in self.variantes and aceptadas.get(codificacion, aceptadas.get('*', 0)) > 0:
+                return codificacion
+        return 'identity'
+
+    def coincide_etag(self, if_none_match):
+        """Compara If-None-Match con las ETags de la página (comparación débil, como pide HTTP)"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        recibidas = {etag.strip().removeprefix('W/') for etag in if_none_match.split(',')}
+        return not recibidas.isdisjoint(self.etags.values())
+
+    def enviar(self, handler):
+        """Responde la petición del handler con la variante adecuada, o 304 si no cambió"""
+        codificacion = self.elegir_codificacion(handler.headers.get('Accept-Encoding'))
+
+        if self.coincide_etag(handler.headers.get('If-None-Match')):
+            handler.send_response(304)
+            handler.send_header('ETag', self.etags[codificacion])
+            handler.send_header('Vary', 'Accept-Encoding')
+            handler.send_header('Cache-Control', 'no-cache')
+            handler.end_headers()
+            return
+
+        datos = self.variantes[codificacion]
+        handler.send_response(200)
+        handler.send_header('Content-type', self.tipo_contenido)
+        if codificacion != 'identity':
+            handler.send_header('Content-Encoding', codificacion)
+        handler.send_header('Content-length', len(datos))
+        handler.send_header('ETag', self.etags[codificacion])
+        handler.send_header('Vary', 'Accept-Encoding')
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        handler.wfile.write(datos)
+
+
+# Archivos generados: se guardan en disco (compartido entre hilos y procesos del servidor)
+# y se descargan con GET /result/<id> en lugar de viajar en base64 dentro del JSON
+DIRECTORIO_RESULTADOS = os.environ.get(
+    'DIRECTORIO_RESULTADOS', os.path.join(tempfile.gettempdir(), 'mailbox_resultados')
+)
+TTL_RESULTADOS_SEGUNDOS = int(os.environ.get('TTL_RESULTADOS_SEGUNDOS', 3600))
+TIPO_CONTENIDO_XLSX = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _limpiar_vencidos(directorio):
+    """Elimina los archivos del directorio más antiguos que TTL_RESULTADOS_SEGUNDOS"""
+    limite = time.time() - TTL_RESULTADOS_SEGUNDOS
+    try:
+        entradas = list(os.scandir(directorio))
+    except FileNotFoundError:
+        return
+    for entrada in entradas:
+        try:
+            if entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+        except OSError:
+            pass
+
+
+def guardar_resultado(contenido, nombre_archivo):
+    """
+    Guarda el archivo generado y retorna su ID de descarga.
+    El archivo se escribe primero con un nombre temporal para que nunca se sirva a medias.
+    """
+    import uuid
+
+    os.makedirs(DIRECTORIO_RESULTADOS, exist_ok=True)
+    _limpiar_vencidos(DIRECTORIO_RESULTADOS)
+
+    resultado_id = uuid.uuid4().hex
+    ruta_base = os.path.join(DIRECTORIO_RESULTADOS, resultado_id)
+
+    with open(ruta_base + '.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'filename': nombre_archivo, 'bytes': len(contenido)}, f, ensure_ascii=False)
+    with open(ruta_base + '.xlsx.tmp', 'wb') as f:
+        f.write(contenido)
+    os.replace(ruta_base + '.json.tmp', ruta_base + '.json')
+    os.replace(ruta_base + '.xlsx.tmp', ruta_base + '.xlsx')
+
+    return resultado_id
+
+
+def obtener_resultado(resultado_id):
+    """Retorna (ruta, nombre_archivo) del resultado, o None si no existe o ya venció"""
+    if not re.fullmatch(r'[0-9a-f]{32}', resultado_id or ''):
+        return None
+
+    ruta_base = os.path.join(DIRECTORIO_RESULTADOS, resultado_id)
+    try:
+        if os.path.getmtime(ruta_base + '.xlsx') < time.time() - TTL_RESULTADOS_SEGUNDOS:
+            return None
+        with open(ruta_base + '.json', encoding='utf-8') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    return ruta_base + '.xlsx', info.get('filename', f'{resultado_id}.xlsx')
+
+
+# Índice persistente de planillas madre (POST /madre): NIT → idOrder, dirección, teléfono y ciudad
+# en un SQLite por versión, para relacionar nuevos ofimatic sin volver a subir ni leer la madre.
+# Cada versión se identifica por su fecha de carga; se conservan las más recientes.
+DIRECTORIO_MADRES = os.environ.get(
+    'DIRECTORIO_MADRES', os.path.join(tempfile.gettempdir(), 'mailbox_madres')
+)
+MAX_MADRES_GUARDADAS = int(os.environ.get('MAX_MADRES_GUARDADAS', 5))
+TTL_MADRES_SEGUNDOS = int(os.environ.get('TTL_MADRES_SEGUNDOS', 7 * 24 * 3600))
+COLUMNAS_INDICE_MADRE = ['idOrder', 'addressPatient', 'mobilePhonePatient', 'cityNameOrder']
+MADRE_MAS_RECIENTE = 'ultima'
+
+
+def _ruta_madre(madre_id):
+    return os.path.join(DIRECTORIO_MADRES, f'{madre_id}.sqlite')
+
+
+def _ids_madres():
+    """IDs de las versiones guardadas, de la más reciente a la más antigua"""
+    try:
+        nombres = os.listdir(DIRECTORIO_MADRES)
+    except FileNotFoundError:
+        return []
+    return sorted((n[:-len('.sqlite')] for n in nombres
+                   if re.fullmatch(r'\d{14}_[0-9a-f]{8}\.sqlite', n)), reverse=True)
+
+
+def _expulsar_madres_antiguas():
+    """Elimina las versiones que exceden MAX_MADRES_GUARDADAS o son más antiguas que TTL_MADRES_SEGUNDOS"""
+    limite = time.time() - TTL_MADRES_SEGUNDOS
+    for posicion, madre_id in enumerate(_ids_madres()):
+        ruta = _ruta_madre(madre_id)
+        try:
+            if posicion >= MAX_MADRES_GUARDADAS or os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+                print(f"🗑️ Versión de planilla madre expulsada: {madre_id}")
+        except OSError:
+            pass
+
+
+def registrar_madre(df_madre, nombre_archivo):
+    """
+    Construye el índice de una planilla madre ya leída (con identificationPatient normalizado)
+    y retorna su información. Si un NIT se repite gana la última fila, igual que con to_dict().
+    """
+    import sqlite3
+    import uuid
+    from datetime import datetime
+
+    os.makedirs(DIRECTORIO_MADRES, exist_ok=True)
+
+    fecha = datetime.now()
+    madre_id = f"{fecha.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    columnas = [col for col in COLUMNAS_INDICE_MADRE if col in df_madre.columns]
+
+    df_indice = df_madre.drop_duplicates('identificationPatient', keep='last')
+    df_indice = df_indice[['identificationPatient'] + columnas].astype(object)
+    df_indice = df_indice.where(df_indice.notna(), None)
+    info = {
+        'madre_id': madre_id,
+        'archivo': nombre_archivo,
+        'fecha': fecha.isoformat(timespec='seconds'),
+        'filas': len(df_madre),
+        'nits': len(df_indice),
+        'columnas': columnas
+    }
+
+    ruta = _ruta_madre(madre_id)
+    conexion = sqlite3.connect(ruta + '.tmp')
+    try:
+        # Columnas sin tipo: SQLite conserva texto y números tal como llegaron
+        conexion.execute(
+            f"CREATE TABLE madre (nit TEXT PRIMARY KEY, {', '.join(f'c{i}' for i in range(len(columnas))) or 'vacia'})"
+        )
+        conexion.execute("CREATE TABLE info (datos TEXT)")
+        conexion.execute("INSERT INTO info VALUES (?)", (json.dumps(info, ensure_ascii=False),))
+        marcadores = ', '.join('?' * (len(columnas) + 1)) if columnas else '?, NULL'
+        conexion.executemany(f"INSERT INTO madre VALUES ({marcadores})", df_indice.itertuples(index=False, name=None))
+        conexion.commit()
+    finally:
+        conexion.close()
+    os.replace(ruta + '.tmp', ruta)
+
+    _expulsar_madres_antiguas()
+    return info
+
+
+def _abrir_madre(madre_id):
+    """Abre la versión indicada ('ultima' = la más reciente) en solo lectura, o None si no existe"""
+    import sqlite3
+
+    if madre_id == MADRE_MAS_RECIENTE:
+        ids = _ids_madres()
+        madre_id = ids[0] if ids else ''
+    if not re.fullmatch(r'\d{14}_[0-9a-f]{8}', madre_id or ''):
+        return None
+    ruta = _ruta_madre(madre_id)
+    if not os.path.exists(ruta):
+        return None
+    return sqlite3.connect(f'file:{ruta}?mode=ro', uri=True)
+
+
+def listar_madres():
+    """Información de las versiones guardadas, de la más reciente a la más antigua"""
+    versiones = []
+    for madre_id in _ids_madres():
+        conexion = _abrir_madre(madre_id)
+        if conexion is None:
+            continue
+        try:
+            versiones.append(json.loads(conexion.execute("SELECT datos FROM info").fetchone()[0]))
+        except Exception:
+            pass
+        finally:
+            conexion.close()
+    return versiones
+
+
+def mapeos_desde_madre(madre_id, nits):
+    """
+    Busca en el índice solo los NITs indicados y retorna (info, mapeos), donde mapeos tiene un
+    diccionario NIT → valor por cada columna de COLUMNAS_INDICE_MADRE (vacío si la madre no la tenía).
+    Retorna None si la versión no existe.
+    """
+    conexion = _abrir_madre(madre_id)
+    if conexion is None:
+        return None
+    try:
+        info = json.loads(conexion.execute("SELECT datos FROM info").fetchone()[0])
+        columnas = info['columnas']
+        conexion.execute("CREATE TEMP TABLE buscados (nit TEXT PRIMARY KEY)")
+        conexion.executemany("INSERT OR IGNORE INTO buscados VALUES (?)", ((nit,) for nit in nits))
+        filas = conexion.execute("SELECT madre.* FROM madre JOIN buscados USING (nit)").fetchall()
+    finally:
+        conexion.close()
+
+    mapeos = {columna: {} for columna in COLUMNAS_INDICE_MADRE}
+    for posicion, columna in enumerate(columnas, start=1):
+        # NULL vuelve como NaN, igual que en el DataFrame original
+        mapeos[columna] = {fila[0]: (np.nan if fila[posicion] is None else fila[posicion]) for fila in filas}
+    return info, mapeos
+
+
+# Lectura de formularios multipart por bloques: cada parte va a un archivo temporal que
+# se mantiene en memoria hasta UMBRAL_PARTE_EN_MEMORIA y luego pasa a disco
+TAMANO_BLOQUE_LECTURA = 64 * 1024
+UMBRAL_PARTE_EN_MEMORIA = int(os.environ.get('UMBRAL_PARTE_EN_MEMORIA', 1024 * 1024))
+MAX_BYTES_ENCABEZADOS_PARTE = 16 * 1024
+
+
+class CampoFormulario:
+    """
+    Parte de un formulario multipart (misma interfaz básica que cgi.FieldStorage):
+    name, filename, file (objeto tipo archivo posicionado al inicio) y value
+    """
+    def __init__(self, name, filename, file):
+        self.name = name
+        self.filename = filename
+        self.file = file
+
+    @property
+    def value(self):
+        self.file.seek(0)
+        contenido = self.file.read()
+        self.file.seek(0)
+        return contenido if self.filename is not None else contenido.decode('utf-8', errors='replace')
+
+    def close(self):
+        self.file.close()
+
+
+def cerrar_formulario(campos):
+    """Cierra los archivos temporales de todas las partes de un formulario"""
+    for campo in (campos or {}).values():
+        campo.close()
+
+
+def _extraer_boundary(content_type):
+    """Obtiene el boundary del Content-Type (con o sin comillas)"""
+    from email.message import Message
+
+    mensaje = Message()
+    mensaje['content-type'] = content_type or ''
+    if mensaje.get_content_type() != 'multipart/form-data':
+        raise ValueError('Tipo de contenido no válido: se esperaba multipart/form-data')
+    boundary = mensaje.get_param('boundary')
+    if not boundary or len(boundary) > 200:
+        raise ValueError('El formulario no indica un boundary válido')
+    return boundary.encode('latin-1')
+
+
+def _parsear_encabezados_parte(encabezados):
+    """Retorna (name, filename) a partir de los encabezados de una parte"""
+    from email.parser import HeaderParser
+
+    mensaje = HeaderParser().parsestr(encabezados.decode('utf-8', errors='replace'))
+    nombre = mensaje.get_param('name', header='content-disposition')
+    nombre_archivo = mensaje.get_filename()
+    if isinstance(nombre, tuple):
+        nombre = nombre[2]
+    return nombre, nombre_archivo
+
+
+def leer_formulario_multipart(rfile, headers):
+    """
+    Lee un cuerpo multipart/form-data desde rfile por bloques, sin armar el cuerpo completo
+    en memoria. Retorna un dict nombre → CampoFormulario (si un nombre se repite, gana el
+    último); quien lo recibe debe cerrarlo con cerrar_formulario. Si el cuerpo es inválido
+    se cierran las partes ya leídas antes de lanzar ValueError.
+    """
+    boundary = _extraer_boundary(headers.get('Content-Type'))
+    try:
+        restante = int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        raise ValueError('La petición no indica Content-Length')
+
+    delimitador = b'\r\n--' + boundary
+    # El primer delimitador no lleva CRLF previo; se antepone para tratarlos a todos igual
+    buffer = b'\r\n'
+    campos = {}
+
+    def leer_mas():
+        nonlocal restante, buffer
+        if restante <= 0:
+            return False
+        bloque = rfile.read(min(TAMANO_BLOQUE_LECTURA, restante))
+        if not bloque:
+            restante = 0
+            return False
+        restante -= len(bloque)
+        buffer += bloque
+        return True
+
+    archivo = None
+    try:
+        # Descartar el preámbulo hasta el primer delimitador
+        while True:
+            posicion = buffer.find(delimitador)
+            if posicion != -1:
+                buffer = buffer[posicion + len(delimitador):]
+                break
+            buffer = buffer[-(len(delimitador) - 1):]
+            if not leer_mas():
+                raise ValueError('El formulario no contiene partes')
+
+        while True:
+            # Después del delimitador: '--' indica el final; si no, espacios opcionales y CRLF
+            while len(buffer) < 2 and leer_mas():
+                pass
+            if buffer.startswith(b'--'):
+                break
+            while b'\r\n' not in buffer:
+                if len(buffer) > MAX_BYTES_ENCABEZADOS_PARTE or not leer_mas():
+                    raise ValueError('Formulario multipart incompleto')
+            linea, buffer = buffer.split(b'\r\n', 1)
+            if linea.strip(b' \t'):
+                raise ValueError('Delimitador multipart inválido')
+
+            # Encabezados de la parte
+            while True:
+                posicion = buffer.find(b'\r\n\r\n')
+                if posicion != -1:
+                    break
+                if len(buffer) > MAX_BYTES_ENCABEZADOS_PARTE or not leer_mas():
+                    raise ValueError('Encabezados de parte multipart incompletos')
+            nombre, nombre_archivo = _parsear_encabezados_parte(buffer[:posicion])
+            buffer = buffer[posicion + 4:]
+
+            # Contenido de la parte, escrito por bloques hasta el siguiente delimitador
+            archivo = tempfile.SpooledTemporaryFile(max_size=UMBRAL_PARTE_EN_MEMORIA)
+            while True:
+                posicion = buffer.find(delimitador)
+                if posicion != -1:
+                    archivo.write(buffer[:posicion])
+                    buffer = buffer[posicion + len(delimitador):]
+                    break
+                seguro = len(buffer) - (len(delimitador) - 1)
+                if seguro > 0:
+                    archivo.write(buffer[:seguro])
+                    buffer = buffer[seguro:]
+                if not leer_mas():
+                    raise ValueError('Formulario multipart incompleto')
+
+            archivo.seek(0)
+            if nombre is not None:
+                if nombre in campos:
+                    campos[nombre].close()
+                campos[nombre] = CampoFormulario(nombre, nombre_archivo, archivo)
+            else:
+                archivo.close()
+            archivo = None
+
+        # Consumir lo que quede (epílogo) para no dejar datos en el socket
+        while restante > 0:
+            bloque = rfile.read(min(TAMANO_BLOQUE_LECTURA, restante))
+            if not bloque:
+                break
+            restante -= len(bloque)
+    except BaseException:
+        if archivo is not None:
+            archivo.close()
+        cerrar_formulario(campos)
+        raise
+
+    return campos
+
+
+
+def publicar_resultado(data):
+    """Guarda el Excel del resultado (si lo hay) y lo reemplaza por su ID y URL de descarga"""
+    excel_bytes = data.pop('excel_bytes', None)
+    if data.get('success') and excel_bytes is not None:
+        resultado_id = guardar_resultado(excel_bytes, data.get('filename', 'resultado.xlsx'))
+        data['result_id'] = resultado_id
+        data['download_url'] = f'/result/{resultado_id}'
+        data['bytes'] = len(excel_bytes)
+    return data
+
+
+# Trabajos en segundo plano: POST /jobs responde de inmediato con un ID y el procesamiento
+# corre en un pool acotado de hilos. El estado se guarda en disco para que GET /jobs/<id>
+# responda desde cualquier hilo o proceso del servidor.
+DIRECTORIO_TRABAJOS = os.environ.get(
+    'DIRECTORIO_TRABAJOS', os.path.join(tempfile.gettempdir(), 'mailbox_trabajos')
+)
+MAX_TRABAJOS_SIMULTANEOS = int(os.environ.get('MAX_TRABAJOS_SIMULTANEOS', 2))
+MAX_TRABAJOS_EN_COLA = int(os.environ.get('MAX_TRABAJOS_EN_COLA', 20))
+MODOS_TRABAJO = ['normal', 'bogota', 'filtrar_bogota', 'medellin_libro2', 'bogota_libro2',
+                 'farmabogota', 'distrifarma']
+
+_contexto_trabajo = threading.local()
+_bloqueo_trabajos = threading.Lock()
+_pool_trabajos = None
+_trabajos_pendientes = 0
+
+
+def _ruta_trabajo(trabajo_id):
+    return os.path.join(DIRECTORIO_TRABAJOS, trabajo_id + '.json')
+
+
+def _guardar_trabajo(trabajo):
+    """Escribe el estado del trabajo (sin dejar nunca un archivo a medias)"""
+    trabajo['actualizado'] = time.time()
+    ruta = _ruta_trabajo(trabajo['id'])
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(trabajo, f, ensure_ascii=False)
+    os.replace(ruta + '.tmp', ruta)
+
+
+def obtener_trabajo(trabajo_id):
+    """Retorna el estado del trabajo, o None si no existe o ya venció"""
+    if not re.fullmatch(r'[0-9a-f]{32}', trabajo_id or ''):
+        return None
+    try:
+        with open(_ruta_trabajo(trabajo_id), encoding='utf-8') as f:
+            trabajo = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if trabajo.get('actualizado', 0) < time.time() - TTL_RESULTADOS_SEGUNDOS:
+        return None
+    return trabajo
+
+
+def reportar_etapa(etapa, **estadisticas):
+    """
+    Actualiza la etapa actual y las estadísticas parciales del trabajo que corre en este hilo.
+    Fuera de un trabajo (por ejemplo en POST /process) solo avisa al observador, si lo hay.
+    """
+    observador = getattr(_contexto_trabajo, 'observador', None)
+    if observador is not None:
+        observador(etapa, estadisticas)
+    traza = getattr(_contexto_trabajo, 'traza', None)
+    if traza is not None:
+        _cerrar_etapa(traza)
+        traza['actual'] = {'etapa': etapa, 'inicio': time.perf_counter(), **estadisticas}
+    trabajo = getattr(_contexto_trabajo, 'trabajo', None)
+    if trabajo is None:
+        return
+    trabajo['etapa'] = etapa
+    trabajo['estadisticas'].update(estadisticas)
+    _guardar_trabajo(trabajo)
+
+
+@contextlib.contextmanager
+def observar_etapas(observador):
+    """
+    Llama a observador(etapa, estadisticas) en cada reportar_etapa de este hilo mientras dure el bloque
+    (benchmark_modos.py lo usa para medir cada etapa de los process_*)
+    """
+    anterior = getattr(_contexto_trabajo, 'observador', None)
+    _contexto_trabajo.observador = observador
+    try:
+        yield
+    finally:
+        _contexto_trabajo.observador = anterior
+
+
+# Instrumentación: cada process_* deja una traza con la duración, filas y bytes de cada etapa
+# (cada reportar_etapa cierra la etapa anterior y abre la siguiente). Los eventos se escriben
+# como una línea JSON en la salida estándar si su nivel alcanza NIVEL_LOG (debug, info, warning, error);
+# los diagnósticos costosos de los process_* solo se calculan con NIVEL_LOG=debug.
+NIVELES_LOG = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+NIVEL_LOG = os.environ.get('NIVEL_LOG', 'info').lower()
+if NIVEL_LOG not in NIVELES_LOG:
+    print(f"⚠️ NIVEL_LOG desconocido '{NIVEL_LOG}', usando 'info'")
+    NIVEL_LOG = 'info'
+
+
+def log_habilitado(nivel):
+    """True si los eventos de este nivel se escriben (para no calcular diagnósticos que nadie verá)"""
+    return NIVELES_LOG[nivel] >= NIVELES_LOG[NIVEL_LOG]
+
+
+def registrar_evento(nivel, evento, **campos):
+    """Escribe el evento como una línea JSON si su nivel está habilitado"""
+    if not log_habilitado(nivel):
+        return
+    from datetime import datetime
+    registro = {
+        'fecha': datetime.now().isoformat(timespec='milliseconds'),
+        'nivel': nivel,
+        'evento': evento,
+        'pid': os.getpid(),
+        **campos
+    }
+    print(json.dumps(registro, ensure_ascii=False, default=str), flush=True)
+
+
+def _cerrar_etapa(traza):
+    """Cierra la etapa en curso de la traza (si hay una) y la agrega a la lista de etapas"""
+    actual = traza.pop('actual', None)
+    if actual is None:
+        return
+    actual['segundos'] = round(time.perf_counter() - actual.pop('inicio'), 4)
+    if actual['etapa'] == 'lectura':
+        actual['bytes'] = traza['bytes_entrada']
+    elif actual['etapa'] == 'escritura' and traza.get('bytes_salida') is not None:
+        actual['bytes'] = traza['bytes_salida']
+    if traza.get('perfil') is not None:
+        _medir_memoria_etapa(traza['perfil'], actual)
+    traza['etapas'].append(actual)
+    registrar_evento('debug', 'etapa', operacion=traza['operacion'], trabajo=traza['trabajo'], **actual)
+
+
+def ejecutar_con_traza(nombre_metodo, args, perfil_id=None):
+    """
+    Ejecuta MailboxHandler.<nombre_metodo>(*args) registrando la traza de sus etapas.
+    Al terminar escribe un evento 'operacion' con la duración total y el detalle por etapa.
+    Retorna (resultado, resumen); el resumen es el mismo evento y alimenta las métricas.
+    Con perfil_id corre bajo cProfile y tracemalloc y guarda el perfil con ese ID.
+    """
+    trabajo = getattr(_contexto_trabajo, 'trabajo', None)
+    traza = {
+        'operacion': nombre_metodo,
+        'trabajo': trabajo['id'] if trabajo else None,
+        'bytes_entrada': sum(len(arg) for arg in args if isinstance(arg, (bytes, bytearray))),
+        'cache_aciertos': 0,
+        'cache_fallos': 0,
+        'etapas': []
+    }
+    anterior = getattr(_contexto_trabajo, 'traza', None)
+    _contexto_trabajo.traza = traza
+    traza['perfil'] = _iniciar_perfil() if perfil_id else None
+    inicio = time.perf_counter()
+    resultado = None
+    try:
+        resultado = getattr(MailboxHandler.__new__(MailboxHandler), nombre_metodo)(*args)
+    finally:
+        exito = bool(resultado and resultado.get('success'))
+        excel_bytes = resultado.get('excel_bytes') if resultado else None
+        traza['bytes_salida'] = len(excel_bytes) if excel_bytes is not None else None
+        _cerrar_etapa(traza)
+        _contexto_trabajo.traza = anterior
+        try:
+            if traza['perfil'] is None:
+                perfil_id = None
+            else:
+                _terminar_perfil(traza['perfil'], perfil_id, traza, time.perf_counter() - inicio)
+        except Exception as e:
+            # El perfil es opcional: si no se puede guardar, el procesamiento sigue valiendo
+            registrar_evento('error', 'perfil_fallido', perfil_id=perfil_id, error=str(e))
+            perfil_id = None
+        resumen = {
+            'operacion': nombre_metodo,
+            'trabajo': traza['trabajo'],
+            'exito': exito,
+            'error': None if exito or not resultado else resultado.get('error'),
+            'segundos': round(time.perf_counter() - inicio, 4),
+            'bytes_entrada': traza['bytes_entrada'],
+            'bytes_salida': traza['bytes_salida'] or 0,
+            'cache_aciertos': traza['cache_aciertos'],
+            'cache_fallos': traza['cache_fallos'],
+            'perfil_id': perfil_id,
+            'etapas': traza['etapas']
+        }
+        registrar_evento('info' if exito else 'warning', 'operacion', **resumen)
+    return resultado, resumen
+
+
+# Métricas para GET /metrics (formato de texto de Prometheus). Se actualizan una vez por
+# procesamiento con el resumen de su traza, así que no agregan trabajo dentro de las etapas.
+# Cada proceso del servidor lleva sus propias métricas (en MODO_SERVIDOR=procesos, un scrape
+# ve las del proceso que atendió la petición, igual que GET /cache).
+MODO_POR_METODO = {
+    'process_data_files': 'normal',
+    'process_bogota_files': 'bogota',
+    'process_filtrar_bogota': 'filtrar_bogota',
+    'process_medellin_libro2': 'medellin_libro2',
+    'process_bogota_libro2': 'bogota_libro2',
+    'process_farmabogota_libro2': 'farmabogota',
+    'process_distrifarma_libro2': 'distrifarma'
+}
+LIMITES_SEGUNDOS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LIMITES_BYTES = tuple(64 * 1024 * 4 ** i for i in range(7))  # 64 KB … 256 MB
+
+
+def memoria_rss_bytes():
+    """Memoria residente actual de este proceso (en Windows no se reporta)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Sin /proc (macOS) solo está el pico, que ru_maxrss da en bytes
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return pico if sys.platform == 'darwin' else pico * 1024
+
+
+class MetricasServidor:
     """
-    Lee la planilla inicial de Bogotá manteniendo el formato original.
-    La planilla tiene 3 filas de encabezado antes de los datos.
+    Contadores, histogramas y medidores de los procesamientos de este proceso.
+    exposicion() los entrega en el formato de texto de Prometheus.
     """
-    # Leer todo el archivo sin procesar
-    df_completo = pd.read_excel(BytesIO(contenido), header=None)
     
-    # Los encabezados están en la fila 3 (índice 3)
-    encabezados = df_completo.iloc[3].tolist()
+    def __init__(self):
+        from collections import defaultdict
+        self._bloqueo = threading.Lock()
+        self.procesamientos = defaultdict(int)  # (modo, resultado) -> cantidad
+        self.segundos = {}  # modo -> histograma
+        self.bytes_entrada = {}  # modo -> histograma
+        self.segundos_etapa = defaultdict(float)  # (modo, etapa) -> segundos acumulados
+        self.filas_resultado = defaultdict(int)
+        self.filas_relacionadas = defaultdict(int)
+        self.cache = defaultdict(int)  # 'acierto' / 'fallo' -> consultas
+        self.en_curso = 0
     
-    # Los datos comienzan desde la fila 4 (índice 4)
-    df_datos = pd.read_excel(BytesIO(contenido), skiprows=4)
-    df_datos.columns = encabezados
+    @staticmethod
+    def _observar(histogramas, modo, limites, valor):
+        # [conteos acumulados por límite, suma, total]
+        histograma = histogramas.setdefault(modo, [[0] * len(limites), 0.0, 0])
+        for i, limite in enumerate(limites):
+            if valor <= limite:
+                histograma[0][i] += 1
+        histograma[1] += valor
+        histograma[2] += 1
     
-    # Guardar las primeras 4 filas para mantener el formato original
-    filas_encabezado = df_completo.iloc[0:4]
+    def iniciar(self):
+        with self._bloqueo:
+            self.en_curso += 1
     
-    return df_datos, filas_encabezado, encabezados
+    def terminar(self, nombre_metodo, resumen):
+        """
+        Registra un procesamiento terminado con el resumen de ejecutar_con_traza.
+        Sin resumen (excepción o worker caído) solo se cuenta como error.
+        """
+        modo = MODO_POR_METODO.get(nombre_metodo, nombre_metodo)
+        with self._bloqueo:
+            self.en_curso -= 1
+            if resumen is None:
+                self.procesamientos[(modo, 'error')] += 1
+                return
+            self.procesamientos[(modo, 'exito' if resumen['exito'] else 'error')] += 1
+            self._observar(self.segundos, modo, LIMITES_SEGUNDOS, resumen['segundos'])
+            self._observar(self.bytes_entrada, modo, LIMITES_BYTES, resumen['bytes_entrada'])
+            for etapa in resumen['etapas']:
+                self.segundos_etapa[(modo, etapa['etapa'])] += etapa['segundos']
+                self.filas_resultado[modo] += etapa.get('filas_resultado', 0)
+                self.filas_relacionadas[modo] += etapa.get('filas_relacionadas', 0)
+            self.cache['acierto'] += resumen['cache_aciertos']
+            self.cache['fallo'] += resumen['cache_fallos']
+    
+    def exposicion(self):
+        lineas = []
+        # Con MODO_SERVIDOR=procesos cada scrape lo atiende un worker distinto: la etiqueta pid
+        # separa las series de cada worker para que sus contadores no parezcan reiniciarse
+        pid = os.getpid()
+        
+        def metrica(nombre, tipo, ayuda, muestras):
+            lineas.append(f'# HELP {nombre} {ayuda}')
+            lineas.append(f'# TYPE {nombre} {tipo}')
+            for sufijo, etiquetas, valor in muestras:
+                texto = ','.join(f'{clave}="{v}"' for clave, v in {'pid': pid, **etiquetas}.items())
+                lineas.append(f'{nombre}{sufijo}{{{texto}}} {valor}')
+        
+        def histograma(nombre, ayuda, histogramas, limites):
+            muestras = []
+            for modo, (conteos, suma, total) in sorted(histogramas.items()):
+                muestras += [('_bucket', {'modo': modo, 'le': limite}, conteo)
+                             for limite, conteo in zip(limites, conteos)]
+                muestras += [('_bucket', {'modo': modo, 'le': '+Inf'}, total),
+                             ('_sum', {'modo': modo}, round(suma, 4)),
+                             ('_count', {'modo': modo}, total)]
+            metrica(nombre, 'histogram', ayuda, muestras)
+        
+        with self._bloqueo:
+            consultas_cache = self.cache['acierto'] + self.cache['fallo']
+            metrica('mailbox_procesamientos_total', 'counter', 'Procesamientos terminados por modo y resultado',
+                    [('', {'modo': m, 'resultado': r}, n) for (m, r), n in sorted(self.procesamientos.items())])
+            histograma('mailbox_procesamiento_segundos', 'Duración de cada procesamiento',
+                       self.segundos, LIMITES_SEGUNDOS)
+            histograma('mailbox_entrada_bytes', 'Tamaño de los archivos subidos en cada procesamiento',
+                       self.bytes_entrada, LIMITES_BYTES)
+            metrica('mailbox_etapa_segundos_total', 'counter', 'Segundos acumulados en cada etapa',
+                    [('', {'modo': m, 'etapa': e}, round(s, 4)) for (m, e), s in sorted(self.segundos_etapa.items())])
+            metrica('mailbox_filas_resultado_total', 'counter', 'Filas escritas en los resultados',
+                    [('', {'modo': m}, n) for m, n in sorted(self.filas_resultado.items())])
+            metrica('mailbox_filas_relacionadas_total', 'counter',
+                    'Filas del resultado que encontraron su pedido (tasa = relacionadas / resultado)',
+                    [('', {'modo': m}, n) for m, n in sorted(self.filas_relacionadas.items())])
+            metrica('mailbox_cache_planillas_consultas_total', 'counter', 'Consultas a la caché de planillas',
+                    [('', {'resultado': r}, n) for r, n in sorted(self.cache.items())])
+            metrica('mailbox_cache_planillas_tasa_aciertos', 'gauge', 'Aciertos / consultas de la caché de planillas',
+                    [('', {}, round(self.cache['acierto'] / consultas_cache, 4) if consultas_cache else 0.0)])
+            metrica('mailbox_procesamientos_en_curso', 'gauge', 'Procesamientos ejecutándose en este momento',
+                    [('', {}, self.en_curso)])
+        
+        metrica('mailbox_trabajos_pendientes', 'gauge', 'Trabajos en cola o procesándose',
+                [('', {}, _trabajos_pendientes)])
+        metrica('mailbox_cache_planillas_bytes', 'gauge', 'Memoria usada por la caché de planillas de este proceso',
+                [('', {}, cache_planillas.estadisticas()['bytes_en_uso'])])
+        rss = memoria_rss_bytes()
+        if rss is not None:
+            metrica('mailbox_proceso_memoria_rss_bytes', 'gauge', 'Memoria residente del proceso del servidor',
+                    [('', {}, rss)])
+        return '\n'.join(lineas) + '\n'
 
 
-def leer_planilla_pedidos_bogota(contenido):
-    """
-    Lee la planilla de pedidos con la estructura actual.
-    """
-    df = pd.read_excel(BytesIO(contenido))
-    
-    # Convertir IDENTIFICACION a string para facilitar la comparación
-    if 'IDENTIFICACION' in df.columns:
-        df['IDENTIFICACION'] = df['IDENTIFICACION'].astype(str).str.strip()
+metricas = MetricasServidor()
+
+
+# Perfilado a pedido de un procesamiento lento: con la cabecera X-Perfilar igual a TOKEN_PERFILES
+# (sin TOKEN_PERFILES la cabecera se ignora) o con PERFILAR_PROCESAMIENTOS=1 para todos.
+# El process_* corre bajo cProfile y tracemalloc; las funciones con más tiempo propio y las líneas
+# con más memoria asignada se guardan junto al trabajo y se consultan en GET /debug/profile/<id>.
+TOKEN_PERFILES = os.environ.get('TOKEN_PERFILES', '')
+PERFILAR_PROCESAMIENTOS = os.environ.get('PERFILAR_PROCESAMIENTOS', '').lower() in ('1', 'true', 'si')
+PERFIL_TOP = int(os.environ.get('PERFIL_TOP', 25))
+
+# tracemalloc es global al proceso: un solo perfil a la vez
+_bloqueo_perfil = threading.Lock()
+
+
+def _ruta_perfil(perfil_id):
+    return os.path.join(DIRECTORIO_TRABAJOS, perfil_id + '.perfil.json')
+
+
+def _iniciar_perfil():
+    """Activa cProfile (solo este hilo) y tracemalloc; retorna None si ya hay otro perfil en curso"""
+    import cProfile
+    import tracemalloc
     
-    return df
+    if not _bloqueo_perfil.acquire(blocking=False):
+        registrar_evento('warning', 'perfil_omitido', motivo='ya hay otro procesamiento perfilándose')
+        return None
+    perfil = {
+        'detener_tracemalloc': not tracemalloc.is_tracing(),
+        'instantanea': None,
+        'memoria_instantanea': -1
+    }
+    if perfil['detener_tracemalloc']:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    perfil['perfilador'] = cProfile.Profile()
+    perfil['perfilador'].enable()
+    return perfil
 
 
-def relacionar_por_nit_bogota(df_inicial, df_pedidos):
+def _medir_memoria_etapa(perfil, etapa):
     """
-    Relaciona las planillas por NIT o por DOCUMENTO ASOCIADO.
-    Actualiza el campo Nrodcto con el formato: Nrodcto-NUMERO_DE_PEDIDO
-    
-    Intenta dos métodos de relación:
-    1. Por NIT (nit == IDENTIFICACION)
-    2. Por documento (Nrodcto normalizado == DOCUMENTO ASOCIADO normalizado)
+    Anota el pico de memoria de la etapa que se cierra. La instantánea de asignaciones se toma
+    al cierre de la etapa con más memoria en uso (lo más cercano al pico sin recorrer cada asignación).
     """
-    # Convertir nit a string para comparación
-    df_inicial['nit'] = df_inicial['nit'].astype(str).str.strip()
-    
-    def normalizar_documento(doc):
-        """Normaliza un documento quitando guiones y convirtiendo a mayúsculas"""
-        if pd.isna(doc):
-            return ''
-        doc_str = str(doc).strip().upper()
-        # Quitar guiones y espacios
-        doc_str = doc_str.replace('-', '').replace(' ', '')
-        return doc_str
-    
-    # Crear diccionarios de mapeo
-    # 1. Diccionario NIT -> NUMERO DE PEDIDO
-    pedidos_por_nit = {}
-    # 2. Diccionario DOCUMENTO NORMALIZADO -> NUMERO DE PEDIDO
-    pedidos_por_doc = {}
-    
-    for _, row in df_pedidos.iterrows():
-        # Convertir NUMERO DE PEDIDO a string sin decimales
-        num_pedido = row['NUMERO DE PEDIDO']
-        if pd.notna(num_pedido):
-            try:
-                num_pedido = str(int(float(num_pedido)))
-            except:
-                num_pedido = str(num_pedido).strip()
-        else:
-            num_pedido = ''
-        
-        # Mapeo por NIT
-        nit = str(row['IDENTIFICACION']).strip()
-        pedidos_por_nit[nit] = num_pedido
-        
-        # Mapeo por DOCUMENTO ASOCIADO
-        if 'DOCUMENTO ASOCIADO' in row and pd.notna(row['DOCUMENTO ASOCIADO']):
-            doc_normalizado = normalizar_documento(row['DOCUMENTO ASOCIADO'])
-            if doc_normalizado:
-                pedidos_por_doc[doc_normalizado] = num_pedido
-    
-    print(f"Total de NITs en pedidos: {len(pedidos_por_nit)}")
-    print(f"Total de DOCUMENTOS en pedidos: {len(pedidos_por_doc)}")
-    print(f"Total de registros en planilla inicial: {len(df_inicial)}")
-    
-    # Actualizar el campo Nrodcto
-    registros_actualizados_nit = 0
-    registros_actualizados_doc = 0
-    registros_no_encontrados = []
-    
-    for idx, row in df_inicial.iterrows():
-        nit = str(row['nit']).strip()
-        nrodcto_actual = str(row['Nrodcto'])
-        nrodcto_normalizado = normalizar_documento(nrodcto_actual)
-        
-        num_pedido = None
-        metodo = None
-        
-        # Método 1: Intentar por NIT
-        if nit in pedidos_por_nit and pedidos_por_nit[nit]:
-            num_pedido = pedidos_por_nit[nit]
-            metodo = 'NIT'
-            registros_actualizados_nit += 1
-        # Método 2: Si no encontró por NIT, intentar por DOCUMENTO
-        elif nrodcto_normalizado in pedidos_por_doc and pedidos_por_doc[nrodcto_normalizado]:
-            num_pedido = pedidos_por_doc[nrodcto_normalizado]
-            metodo = 'DOCUMENTO'
-            registros_actualizados_doc += 1
-        
-        # Si encontró el pedido por algún método, actualizar
-        if num_pedido and metodo:
-            # Crear el nuevo formato: Nrodcto-NUMERO_DE_PEDIDO
-            nuevo_nrodcto = f"{nrodcto_actual}-{num_pedido}"
-            df_inicial.at[idx, 'Nrodcto'] = nuevo_nrodcto
-        else:
-            registros_no_encontrados.append(f"{nit}|{nrodcto_actual}")
+    import tracemalloc
     
-    total_actualizados = registros_actualizados_nit + registros_actualizados_doc
-    print(f"\nRegistros actualizados por NIT: {registros_actualizados_nit}")
-    print(f"Registros actualizados por DOCUMENTO: {registros_actualizados_doc}")
-    print(f"Total actualizados: {total_actualizados}")
-    print(f"Registros sin coincidencia: {len(registros_no_encontrados)}")
+    en_uso, pico = tracemalloc.get_traced_memory()
+    etapa['memoria_pico_bytes'] = pico
+    if en_uso > perfil['memoria_instantanea']:
+        perfil['instantanea'] = tracemalloc.take_snapshot()
+        perfil['memoria_instantanea'] = en_uso
+    tracemalloc.reset_peak()
+
+
+def _terminar_perfil(perfil, perfil_id, traza, segundos):
+    """Detiene cProfile y tracemalloc y guarda el perfil (las PERFIL_TOP funciones y asignaciones mayores)"""
+    import pstats
+    import tracemalloc
     
-    if registros_no_encontrados and len(registros_no_encontrados) <= 5:
-        print(f"Ejemplos de registros no encontrados: {registros_no_encontrados[:5]}")
+    try:
+        perfil['perfilador'].disable()
+        funciones = pstats.Stats(perfil['perfilador']).get_stats_profile().func_profiles
+        funciones = sorted(funciones.items(), key=lambda item: item[1].tottime, reverse=True)[:PERFIL_TOP]
+        asignaciones = []
+        if perfil['instantanea'] is not None:
+            asignaciones = perfil['instantanea'].statistics('lineno')[:PERFIL_TOP]
+        datos = {
+            'id': perfil_id,
+            'operacion': traza['operacion'],
+            'trabajo': traza['trabajo'],
+            'creado': time.time(),
+            'segundos': round(segundos, 4),
+            'memoria_pico_bytes': max((e.get('memoria_pico_bytes', 0) for e in traza['etapas']), default=0),
+            'memoria_instantanea_bytes': max(perfil['memoria_instantanea'], 0),
+            'etapas': traza['etapas'],
+            'funciones': [{
+                'funcion': nombre,
+                'archivo': f'{funcion.file_name}:{funcion.line_number}',
+                'llamadas': funcion.ncalls,
+                'segundos_propios': round(funcion.tottime, 4),
+                'segundos_acumulados': round(funcion.cumtime, 4)
+            } for nombre, funcion in funciones],
+            'asignaciones': [{
+                'archivo': f'{estadistica.traceback[0].filename}:{estadistica.traceback[0].lineno}',
+                'bytes': estadistica.size,
+                'bloques': estadistica.count
+            } for estadistica in asignaciones]
+        }
+    finally:
+        if perfil['detener_tracemalloc']:
+            tracemalloc.stop()
+        _bloqueo_perfil.release()
     
-    return df_inicial
+    os.makedirs(DIRECTORIO_TRABAJOS, exist_ok=True)
+    _limpiar_vencidos(DIRECTORIO_TRABAJOS)
+    ruta = _ruta_perfil(perfil_id)
+    with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(datos, f, ensure_ascii=False)
+    os.replace(ruta + '.tmp', ruta)
+    registrar_evento('info', 'perfil', perfil_id=perfil_id, operacion=traza['operacion'],
+                     segundos=datos['segundos'], memoria_pico_bytes=datos['memoria_pico_bytes'])
 
 
-def guardar_con_formato_bogota(df_datos, filas_encabezado):
+def obtener_perfil(perfil_id):
+    """Retorna el perfil guardado, o None si no existe o ya venció"""
+    if not re.fullmatch(r'[0-9a-f]{32}', perfil_id or ''):
+        return None
+    try:
+        with open(_ruta_perfil(perfil_id), encoding='utf-8') as f:
+            perfil = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if perfil.get('creado', 0) < time.time() - TTL_RESULTADOS_SEGUNDOS:
+        return None
+    return perfil
+
+
+def _ejecutar_trabajo(trabajo, procesar):
+    """Corre en un hilo del pool: ejecuta el procesamiento y publica el resultado"""
+    global _trabajos_pendientes
+    _contexto_trabajo.trabajo = trabajo
+    try:
+        inicio = time.time()
+        trabajo['estado'] = 'procesando'
+        reportar_etapa('inicio')
+        try:
+            resultado = procesar()
+        except Exception as e:
+            resultado = {
+                'success': False,
+                'error': f'Error inesperado: {str(e)}',
+                'details': 'Verifica que los archivos tengan el formato correcto'
+            }
+        resultado = publicar_resultado(resultado)
+        trabajo['estado'] = 'completado' if resultado.get('success') else 'error'
+        trabajo['etapa'] = 'fin'
+        trabajo['segundos'] = round(time.time() - inicio, 3)
+        trabajo['resultado'] = resultado
+        _guardar_trabajo(trabajo)
+        print(f"📦 Trabajo {trabajo['id']} ({trabajo['modo']}): {trabajo['estado']} en {trabajo['segundos']}s")
+    except Exception as e:
+        print(f"❌ Error en trabajo {trabajo['id']}: {e}")
+    finally:
+        _contexto_trabajo.trabajo = None
+        with _bloqueo_trabajos:
+            _trabajos_pendientes -= 1
+
+
+def encolar_trabajo(modo, procesar):
     """
-    Guarda el DataFrame manteniendo el formato original de la planilla inicial.
-    Retorna el BytesIO con el Excel generado.
+    Registra un trabajo y lo envía al pool; procesar() debe retornar el dict de resultado.
+    Retorna el estado inicial del trabajo, o None si la cola está llena.
     """
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, Alignment, PatternFill
-    from openpyxl.utils.dataframe import dataframe_to_rows
-    
-    # Crear un nuevo workbook
-    wb = Workbook()
-    ws = wb.active
-    
-    # Escribir las primeras 4 filas de encabezado originales
-    for r_idx, row in enumerate(filas_encabezado.values, start=1):
-        for c_idx, value in enumerate(row, start=1):
-            cell = ws.cell(row=r_idx, column=c_idx, value=value)
-            if r_idx == 1:  # Título
-                cell.font = Font(bold=True, size=12)
-            elif r_idx == 4:  # Encabezados de columnas
-                cell.fill = PatternFill(start_color="CCCCCC", end_color="CCCCCC", fill_type="solid")
-                cell.font = Font(bold=True)
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-    
-    # Escribir los datos actualizados a partir de la fila 5
-    for r_idx, row in enumerate(dataframe_to_rows(df_datos, index=False, header=False), start=5):
-        for c_idx, value in enumerate(row, start=1):
-            ws.cell(row=r_idx, column=c_idx, value=value)
-    
-    # Guardar en BytesIO
-    excel_buffer = BytesIO()
-    wb.save(excel_buffer)
-    excel_buffer.seek(0)
-    
-    return excel_buffer
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+    global _pool_trabajos, _trabajos_pendientes
+
+    with _bloqueo_trabajos:
+        if _trabajos_pendientes >= MAX_TRABAJOS_SIMULTANEOS + MAX_TRABAJOS_EN_COLA:
+            return None
+        if _pool_trabajos is None:
+            _pool_trabajos = ThreadPoolExecutor(
+                max_workers=MAX_TRABAJOS_SIMULTANEOS, thread_name_prefix='mailbox-trabajo'
+            )
+        _trabajos_pendientes += 1
+
+    try:
+        os.makedirs(DIRECTORIO_TRABAJOS, exist_ok=True)
+        _limpiar_vencidos(DIRECTORIO_TRABAJOS)
+        trabajo = {
+            'id': uuid.uuid4().hex,
+            'modo': modo,
+            'estado': 'en_cola',
+            'etapa': None,
+            'estadisticas': {},
+            'creado': time.time()
+        }
+        _guardar_trabajo(trabajo)
+        _pool_trabajos.submit(_ejecutar_trabajo, trabajo, procesar)
+    except Exception:
+        with _bloqueo_trabajos:
+            _trabajos_pendientes -= 1
+        raise
+    return dict(trabajo)
+
+
+# Pool de procesos para las transformaciones que usan CPU (pandas/openpyxl no liberan el GIL).
+# Los archivos entran como bytes y el resultado sale con el Excel en bytes.
+# PROCESOS_CPU=0 desactiva el pool y todo corre en el hilo de la petición.
+PROCESOS_CPU = int(os.environ.get(
+    'PROCESOS_CPU', min(os.cpu_count() or 1, 4) if (os.cpu_count() or 1) > 1 else 0
+))
+TAREAS_POR_PROCESO = int(os.environ.get('TAREAS_POR_PROCESO', 20))
+METODOS_EN_PROCESOS = {
+    'process_medellin_libro2',
+    'process_bogota_libro2',
+    'process_bogota_files',  # guardar_con_formato_bogota
+    'process_filtrar_bogota'  # guardar_con_formato_bogota
+}
+
+_bloqueo_pool_procesos = threading.Lock()
+_pool_procesos = None
+
+
+def _inicializar_worker_procesos():
+    """Carga de una vez los módulos que usan las transformaciones"""
+    import openpyxl.styles
+    import openpyxl.utils.dataframe
+    import pandas.io.excel._openpyxl
+    from pandas.io.parsers import TextParser
+
 
+def _tarea_en_worker(nombre_metodo, args, trabajo, perfil_id):
+    """Corre dentro del proceso worker; retorna (resultado, resumen de la traza, etapa, estadísticas parciales)"""
+    _contexto_trabajo.trabajo = trabajo
+    try:
+        resultado, resumen = ejecutar_con_traza(nombre_metodo, args, perfil_id)
+    finally:
+        _contexto_trabajo.trabajo = None
+    if trabajo is None:
+        return resultado, resumen, None, {}
+    return resultado, resumen, trabajo['etapa'], trabajo['estadisticas']
+
+
+def _obtener_pool_procesos():
+    """Crea el pool la primera vez que se usa (después del fork en el modo 'procesos')"""
+    global _pool_procesos
+    if PROCESOS_CPU <= 0:
+        return None
+    with _bloqueo_pool_procesos:
+        if _pool_procesos is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _pool_procesos = ProcessPoolExecutor(
+                max_workers=PROCESOS_CPU,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_inicializar_worker_procesos,
+                max_tasks_per_child=TAREAS_POR_PROCESO or None
+            )
+            print(f"⚙️ Pool de procesos: {PROCESOS_CPU} workers, reciclados cada {TAREAS_POR_PROCESO} tareas")
+        return _pool_procesos
+
+
+def ejecutar_procesamiento(nombre_metodo, *args, perfilar=False):
+    """
+    Ejecuta un método process_* de MailboxHandler. Los de METODOS_EN_PROCESOS van al pool
+    de procesos (si está activo); el resto corre en el hilo actual.
+    Con perfilar (o PERFILAR_PROCESAMIENTOS) el resultado incluye 'perfil_url'; en un trabajo
+    el perfil usa el mismo ID del trabajo.
+    """
+    import uuid
+    global _pool_procesos
+    from concurrent.futures.process import BrokenProcessPool
+
+    pool = _obtener_pool_procesos() if nombre_metodo in METODOS_EN_PROCESOS else None
+    trabajo = getattr(_contexto_trabajo, 'trabajo', None)
+    perfil_id = None
+    if perfilar or PERFILAR_PROCESAMIENTOS:
+        perfil_id = trabajo['id'] if trabajo is not None else uuid.uuid4().hex
+    metricas.iniciar()
+    resumen = None
+    try:
+        if pool is None:
+            resultado, resumen = ejecutar_con_traza(nombre_metodo, args, perfil_id)
+        else:
+            # El worker actualiza el archivo de estado del trabajo; aquí solo se recupera lo reportado
+            try:
+                resultado, resumen, etapa, estadisticas = pool.submit(
+                    _tarea_en_worker, nombre_metodo, args, trabajo, perfil_id
+                ).result()
+            except BrokenProcessPool:
+                # Un worker murió (p. ej. sin memoria): se descarta el pool para crearlo de nuevo
+                with _bloqueo_pool_procesos:
+                    if _pool_procesos is pool:
+                        _pool_procesos = None
+                raise
+            if trabajo is not None:
+                trabajo['etapa'] = etapa
+                trabajo['estadisticas'].update(estadisticas)
+    finally:
+        metricas.terminar(nombre_metodo, resumen)
+    if resumen['perfil_id']:
+        resultado['perfil_url'] = f"/debug/profile/{resumen['perfil_id']}"
+    return resultado
 
 class MailboxHandler(SimpleHTTPRequestHandler):
+    # Formulario multipart de la petición en curso (ver leer_formulario)
+    formulario = None
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.path.dirname(__file__), **kwargs)
     
     def do_GET(self):
         if self.path == '/' or self.path == '/index.html':
             self.send_html_app()
+        elif self.path.startswith('/jobs/'):
+            self.send_job_status(self.path[len('/jobs/'):])
+        elif self.path.startswith('/result/'):
+            self.send_result_file(self.path[len('/result/'):])
+        elif self.path == '/cache':
+            self.send_json_response(cache_planillas.estadisticas())
+        elif self.path == '/metrics':
+            self.send_metrics()
+        elif self.path.startswith('/debug/profile/'):
+            self.send_profile(self.path[len('/debug/profile/'):])
+        elif self.path == '/madre':
+            self.send_json_response({'success': True, 'versiones': listar_madres()})
         else:
             super().do_GET()
     
     def do_POST(self):
-        if self.path == '/process':
-            self.process_files()
-        elif self.path == '/process_farmabogota_libro2':
-            self.process_farmabogota_files()
-        elif self.path == '/process_distrifarma_libro2':
-            self.process_distrifarma_files()
-        else:
-            self.send_response(404)
-            self.end_headers()
+        try:
+            if self.path == '/process':
+                self.process_files()
+            elif self.path == '/process_farmabogota_libro2':
+                self.process_farmabogota_files()
+            elif self.path == '/process_distrifarma_libro2':
+                self.process_distrifarma_files()
+            elif self.path == '/jobs':
+                self.create_job()
+            elif self.path == '/madre':
+                self.register_madre()
+            else:
+                self.send_response(404)
+                self.end_headers()
+        finally:
+            # Los archivos temporales del formulario se cierran al terminar la petición
+            cerrar_formulario(self.formulario)
+            self.formulario = None
+    
+    def leer_formulario(self):
+        """Lee el formulario multipart de la petición; do_POST lo cierra al terminar"""
+        self.formulario = leer_formulario_multipart(self.rfile, self.headers)
+        return self.formulario
 
     def process_distrifarma_files(self):
         """Procesa el archivo de Distrifarma y lo transforma a formato Libro2"""
-        import cgi
         try:
             # Leer el archivo enviado
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST',
-                        'CONTENT_TYPE': self.headers['Content-Type']})
+            form = self.leer_formulario()
             
             # Verificar si se recibió el archivo
             if 'file' not in form:
@@ -411,10 +2365,11 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             file_content = fileitem.file.read()
             
             # Procesar el archivo y generar la respuesta
-            response_data = self.process_distrifarma_libro2(file_content, fileitem.filename)
+            response_data = ejecutar_procesamiento('process_distrifarma_libro2', file_content, fileitem.filename,
+                                                   perfilar=self.perfilado_solicitado())
             
             # Enviar respuesta
-            self.send_json_response(response_data)
+            self.send_result_response(response_data)
             
         except Exception as e:
             self.send_json_response({
@@ -425,14 +2380,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
 
     def process_farmabogota_files(self):
         """Procesa el archivo de FarmaBogota y lo transforma a formato Libro2"""
-        import cgi
         try:
             # Leer el archivo enviado
-            form = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={'REQUEST_METHOD': 'POST',
-                        'CONTENT_TYPE': self.headers['Content-Type']})
+            form = self.leer_formulario()
             
             # Verificar si se recibió el archivo
             if 'file' not in form:
@@ -455,10 +2405,11 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             file_content = fileitem.file.read()
             
             # Procesar el archivo y generar la respuesta
-            response_data = self.process_farmabogota_libro2(file_content, fileitem.filename)
+            response_data = ejecutar_procesamiento('process_farmabogota_libro2', file_content, fileitem.filename,
+                                                   perfilar=self.perfilado_solicitado())
             
             # Enviar respuesta
-            self.send_json_response(response_data)
+            self.send_result_response(response_data)
             
         except Exception as e:
             self.send_json_response({
@@ -467,8 +2418,22 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 'details': 'Verifica que el archivo tenga el formato correcto'
             })
     
+    # Página principal (bytes y variantes comprimidas), construida una sola vez
+    pagina_principal = None
+    
+    @classmethod
+    def obtener_pagina_principal(cls):
+        if cls.pagina_principal is None:
+            cls.pagina_principal = PaginaPrecomprimida(cls.get_html_content())
+        return cls.pagina_principal
+    
     def send_html_app(self):
-        html_content = """
+        self.obtener_pagina_principal().enviar(self)
+    
+    @staticmethod
+    def get_html_content():
+        """Retorna el HTML de la interfaz"""
+        return """
 <!DOCTYPE html>
 <html lang="es">
 <head>
@@ -768,7 +2733,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         
         <div class="loading" id="loading">
             <div class="spinner"></div>
-            <p>🔄 Procesando archivos...</p>
+            <p id="loadingText">🔄 Procesando archivos...</p>
         </div>
         
         <div class="result-section" id="result">
@@ -910,24 +2875,40 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             result.style.display = 'none';
             
             try {
-                let url = '/process';
                 const formData = new FormData();
                 
                 if (modo === 'distrifarma_libro2') {
-                    url = '/process_distrifarma_libro2';
                     formData.append('file', madreFile.files[0]);
+                    formData.append('modo', 'distrifarma');
                 } else {
                     formData.append('madre', madreFile.files[0]);
                     formData.append('ofimatic', ofimaticFile.files[0]);
                     formData.append('modo', modo);
                 }
                 
-                const response = await fetch(url, {
+                // El archivo se procesa en segundo plano; se consulta el estado hasta que termine
+                const response = await fetch('/jobs', {
                     method: 'POST',
                     body: formData
                 });
                 
-                const data = await response.json();
+                let trabajo = await response.json();
+                let data = trabajo;
+                
+                if (trabajo.success) {
+                    const etapas = {
+                        inicio: 'iniciando', lectura: 'leyendo archivos', normalizacion: 'normalizando datos',
+                        relacion: 'relacionando datos', transformacion: 'transformando', escritura: 'generando Excel'
+                    };
+                    while (trabajo.estado === 'en_cola' || trabajo.estado === 'procesando') {
+                        await new Promise(resolve => setTimeout(resolve, 1000));
+                        trabajo = await (await fetch(`/jobs/${trabajo.job_id || trabajo.id}`)).json();
+                        const etapa = trabajo.estado === 'en_cola' ? 'en cola' : (etapas[trabajo.etapa] || 'procesando');
+                        document.getElementById('loadingText').textContent = `🔄 Procesando archivos... (${etapa})`;
+                    }
+                    data = trabajo.resultado || trabajo;
+                }
+                document.getElementById('loadingText').textContent = '🔄 Procesando archivos...';
                 
                 loading.style.display = 'none';
                 result.style.display = 'block';
@@ -935,19 +2916,11 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 if (data.success) {
                     result.className = 'result-section result-success';
                     
-                    // Crear un blob para el archivo Excel
-                    const binaryString = atob(data.excel_data);
-                    const bytes = new Uint8Array(binaryString.length);
-                    for (let i = 0; i < binaryString.length; i++) {
-                        bytes[i] = binaryString.charCodeAt(i);
-                    }
-                    const blob = new Blob([bytes], { type: 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' });
-                    const url = URL.createObjectURL(blob);
-                    
+                    // El servidor guarda el Excel; se descarga directamente desde su URL
                     document.getElementById('resultContent').innerHTML = `
                         <h3>🎉 ¡Proceso completado exitosamente!</h3>
                         <p>${data.message}</p>
-                        <a href="${url}" 
+                        <a href="${data.download_url}" 
                            download="${data.filename}" 
                            class="download-btn">
                            📥 Descargar Archivo Excel con Filtros
@@ -981,178 +2954,233 @@ class MailboxHandler(SimpleHTTPRequestHandler):
 </body>
 </html>
         """
-        
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.send_header('Content-length', len(html_content.encode('utf-8')))
-        self.end_headers()
-        self.wfile.write(html_content.encode('utf-8'))
     
     def process_files(self):
         try:
             # Obtener el tipo de contenido
-            content_type = self.headers['content-type']
+            content_type = self.headers['content-type'] or ''
             if not content_type.startswith('multipart/form-data'):
                 self.send_json_response({'success': False, 'error': 'Tipo de contenido no válido'})
                 return
             
-            # Obtener la longitud del contenido
-            content_length = int(self.headers['content-length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Parsear multipart data (simplificado)
-            boundary = content_type.split('boundary=')[1].encode()
-            parts = post_data.split(b'--' + boundary)
-            
-            files = {}
-            filenames = {}
-            modo = 'normal'  # modo por defecto
-            
-            for part in parts:
-                if b'Content-Disposition' in part:
-                    header_end = part.find(b'\r\n\r\n')
-                    if header_end != -1:
-                        header = part[:header_end].decode('utf-8')
-                        content = part[header_end + 4:]
-                        
-                        # Remover trailing boundary
-                        if content.endswith(b'\r\n'):
-                            content = content[:-2]
-                        
-                        # Extraer el nombre del archivo si existe
-                        if b'filename=' in part:
-                            filename = ''
-                            if 'filename="' in header:
-                                start = header.find('filename="') + 10
-                                end = header.find('"', start)
-                                filename = header[start:end]
-                            
-                            if 'name="madre"' in header:
-                                files['madre'] = content
-                                filenames['madre'] = filename
-                            elif 'name="ofimatic"' in header:
-                                files['ofimatic'] = content
-                                filenames['ofimatic'] = filename
-                        elif 'name="modo"' in header:
-                            # Extraer el valor del modo
-                            modo = content.decode('utf-8').strip()
+            # Leer el formulario por bloques (las partes grandes van a archivos temporales)
+            form = self.leer_formulario()
+            files, filenames = self.leer_archivos_formulario(form)
+            modo = form['modo'].value.strip() if 'modo' in form else 'normal'
+            madre_id = form['madre_id'].value.strip() if 'madre_id' in form else None
+            
+            self.send_result_response(self.ejecutar_modo(modo, files, filenames, madre_id, self.perfilado_solicitado()))
+            
+        except Exception as e:
+            self.send_json_response({
+                'success': False, 
+                'error': f'Error inesperado: {str(e)}',
+                'details': 'Verifica que los archivos tengan el formato correcto'
+            })
+    
+    def leer_archivos_formulario(self, form):
+        """
+        Extrae los archivos 'madre' y 'ofimatic' del formulario ('file' se acepta como 'madre').
+        Los lectores, la caché (hash del contenido) y el pool de procesos trabajan con bytes,
+        así que cada archivo queda una vez en memoria; su archivo temporal se cierra al leerlo.
+        """
+        files = {}
+        filenames = {}
+        for nombre, campo_nombre in (('madre', 'madre'), ('ofimatic', 'ofimatic'), ('madre', 'file')):
+            campo = form.get(campo_nombre)
+            if nombre not in files and campo is not None and campo.filename is not None:
+                files[nombre] = campo.file.read()
+                filenames[nombre] = campo.filename
+                campo.close()
+        return files, filenames
+    
+    def perfilado_solicitado(self):
+        """True si la petición trae la cabecera X-Perfilar con el TOKEN_PERFILES configurado"""
+        import hmac
+        return bool(TOKEN_PERFILES) and hmac.compare_digest(self.headers.get('X-Perfilar') or '', TOKEN_PERFILES)
+    
+    def ejecutar_modo(self, modo, files, filenames, madre_id=None, perfilar=False):
+        """
+        Ejecuta el procesamiento del modo indicado y retorna el dict de resultado.
+        En medellin_libro2 se puede enviar madre_id (o 'ultima') en lugar del archivo madre.
+        Con perfilar el procesamiento se perfila (ver ejecutar_procesamiento).
+        """
+        if madre_id and 'madre' not in files:
+            if modo != 'medellin_libro2' or 'ofimatic' not in files:
+                return {
+                    'success': False,
+                    'error': 'La planilla madre registrada solo se usa en Medellín → Libro2',
+                    'details': 'Envía el archivo ofimatic con modo=medellin_libro2 y madre_id'
+                }
+            return ejecutar_procesamiento(
+                'process_medellin_libro2', None, None, files['ofimatic'], filenames['ofimatic'], madre_id,
+                perfilar=perfilar
+            )
+        
+        if 'madre' not in files:
+            return {
+                'success': False, 
+                'error': 'No se pudo leer el archivo',
+                'details': 'Asegúrate de que el archivo está seleccionado'
+            }
+        
+        # Modos de un solo archivo
+        metodos_un_archivo = {
+            'filtrar_bogota': 'process_filtrar_bogota',
+            'farmabogota': 'process_farmabogota_libro2',
+            'distrifarma': 'process_distrifarma_libro2'
+        }
+        if modo in metodos_un_archivo:
+            return ejecutar_procesamiento(metodos_un_archivo[modo], files['madre'], filenames['madre'],
+                                          perfilar=perfilar)
+        
+        # Modos que relacionan dos planillas
+        if 'ofimatic' not in files:
+            return {
+                'success': False, 
+                'error': 'No se pudieron leer los archivos',
+                'details': 'Asegúrate de que ambos archivos están seleccionados'
+            }
+        metodos_dos_archivos = {
+            'bogota': 'process_bogota_files',
+            'medellin_libro2': 'process_medellin_libro2',
+            'bogota_libro2': 'process_bogota_libro2'
+        }
+        return ejecutar_procesamiento(
+            metodos_dos_archivos.get(modo, 'process_data_files'),
+            files['madre'], filenames['madre'],
+            files['ofimatic'], filenames['ofimatic'],
+            perfilar=perfilar
+        )
+    
+    def create_job(self):
+        """Recibe los archivos, registra un trabajo en segundo plano y responde de inmediato con su ID"""
+        try:
+            form = self.leer_formulario()
+            modo = form['modo'].value.strip() if 'modo' in form else 'normal'
+            if modo not in MODOS_TRABAJO:
+                self.send_json_response({
+                    'success': False,
+                    'error': f'Modo no válido: {modo}',
+                    'details': f'Modos disponibles: {", ".join(MODOS_TRABAJO)}'
+                }, status=400)
+                return
+            
+            files, filenames = self.leer_archivos_formulario(form)
+            madre_id = form['madre_id'].value.strip() if 'madre_id' in form else None
+            perfilar = self.perfilado_solicitado()
+            trabajo = encolar_trabajo(modo, lambda: self.ejecutar_modo(modo, files, filenames, madre_id, perfilar))
+            if trabajo is None:
+                self.send_json_response({
+                    'success': False,
+                    'error': 'Hay demasiados trabajos en proceso',
+                    'details': 'Intenta de nuevo en unos minutos'
+                }, status=503)
+                return
+            
+            self.send_json_response({
+                'success': True,
+                'job_id': trabajo['id'],
+                'estado': trabajo['estado'],
+                'status_url': f"/jobs/{trabajo['id']}"
+            }, status=202)
             
+        except Exception as e:
+            self.send_json_response({
+                'success': False, 
+                'error': f'Error inesperado: {str(e)}',
+                'details': 'Verifica que los archivos tengan el formato correcto'
+            })
+    
+    def register_madre(self):
+        """Registra una planilla madre de Medellín y construye su índice persistente por NIT"""
+        try:
+            form = self.leer_formulario()
+            files, filenames = self.leer_archivos_formulario(form)
             if 'madre' not in files:
                 self.send_json_response({
-                    'success': False, 
+                    'success': False,
                     'error': 'No se pudo leer el archivo',
-                    'details': 'Asegúrate de que el archivo está seleccionado'
-                })
+                    'details': 'Envía la planilla madre en el campo "madre"'
+                }, status=400)
                 return
             
-            # Procesar los archivos según el modo
-            if modo == 'filtrar_bogota':
-                result = self.process_filtrar_bogota(
-                    files['madre'], filenames['madre']
-                )
-            elif modo == 'bogota':
-                if 'ofimatic' not in files:
-                    self.send_json_response({
-                        'success': False, 
-                        'error': 'No se pudieron leer los archivos',
-                        'details': 'Asegúrate de que ambos archivos están seleccionados'
-                    })
-                    return
-                result = self.process_bogota_files(
-                    files['madre'], filenames['madre'],
-                    files['ofimatic'], filenames['ofimatic']
-                )
-            elif modo == 'medellin_libro2':
-                if 'ofimatic' not in files:
-                    self.send_json_response({
-                        'success': False, 
-                        'error': 'No se pudieron leer los archivos',
-                        'details': 'Asegúrate de que ambos archivos están seleccionados'
-                    })
-                    return
-                result = self.process_medellin_libro2(
-                    files['madre'], filenames['madre'],
-                    files['ofimatic'], filenames['ofimatic']
-                )
-            elif modo == 'bogota_libro2':
-                if 'ofimatic' not in files:
-                    self.send_json_response({
-                        'success': False, 
-                        'error': 'No se pudieron leer los archivos',
-                        'details': 'Asegúrate de que ambos archivos están seleccionados'
-                    })
-                    return
-                result = self.process_bogota_libro2(
-                    files['madre'], filenames['madre'],
-                    files['ofimatic'], filenames['ofimatic']
-                )
-            else:
-                if 'ofimatic' not in files:
-                    self.send_json_response({
-                        'success': False, 
-                        'error': 'No se pudieron leer los archivos',
-                        'details': 'Asegúrate de que ambos archivos están seleccionados'
-                    })
-                    return
-                result = self.process_data_files(
-                    files['madre'], filenames['madre'],
-                    files['ofimatic'], filenames['ofimatic']
-                )
-            self.send_json_response(result)
+            df_madre, error = self._leer_madre_medellin(files['madre'], filenames['madre'])
+            if error:
+                self.send_json_response(error, status=400)
+                return
+            
+            info = registrar_madre(df_madre, filenames['madre'])
+            print(f"📇 Planilla madre registrada: {info['madre_id']} ({info['nits']} NITs)")
+            self.send_json_response(dict(info, success=True), status=201)
             
         except Exception as e:
             self.send_json_response({
                 'success': False, 
                 'error': f'Error inesperado: {str(e)}',
-                'details': 'Verifica que los archivos tengan el formato correcto'
+                'details': 'Verifica que el archivo tenga el formato correcto'
             })
     
+    def send_job_status(self, trabajo_id):
+        """Responde con el estado, la etapa y las estadísticas parciales de un trabajo"""
+        trabajo = obtener_trabajo(trabajo_id)
+        if trabajo is None:
+            self.send_json_response({
+                'success': False,
+                'error': 'Trabajo no encontrado',
+                'details': 'El trabajo ya venció o el ID no es válido'
+            }, status=404)
+            return
+        trabajo['success'] = True
+        self.send_json_response(trabajo)
+    
+    def send_profile(self, perfil_id):
+        """Responde con el perfil de un procesamiento perfilado (funciones más costosas y mayores asignaciones)"""
+        perfil = obtener_perfil(perfil_id)
+        if perfil is None:
+            self.send_json_response({
+                'success': False,
+                'error': 'Perfil no encontrado',
+                'details': 'El perfil ya venció, el ID no es válido o el procesamiento no se perfiló'
+            }, status=404)
+            return
+        perfil['success'] = True
+        self.send_json_response(perfil)
+    
     def process_data_files(self, madre_content, madre_filename, ofimatic_content, ofimatic_filename):
         try:
+            reportar_etapa('lectura')
             print(f"🔄 Procesando archivos: {madre_filename} y {ofimatic_filename}")
             
             # Leer planilla madre
             if madre_filename.lower().endswith(('.xlsx', '.xls')):
-                df_madre = leer_excel_inteligente_desde_contenido(madre_content)
+                df_madre = leer_excel_inteligente_desde_contenido(
+                    madre_content, columnas=columnas_de_planilla('normal', 'madre'),
+                    columnas_texto=columnas_texto_de_planilla('normal', 'madre')
+                )
             else:
-                # Para CSV, intentar decodificar con diferentes codificaciones
-                codificaciones = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
-                df_madre = None
-                
-                for encoding in codificaciones:
-                    try:
-                        madre_text = madre_content.decode(encoding)
-                        try:
-                            df_madre = pd.read_csv(StringIO(madre_text), delimiter=';')
-                            print(f"✅ Archivo madre leído con codificación: {encoding} y delimitador ';'")
-                            break
-                        except:
-                            try:
-                                df_madre = pd.read_csv(StringIO(madre_text), delimiter=',')
-                                print(f"✅ Archivo madre leído con codificación: {encoding} y delimitador ','")
-                                break
-                            except:
-                                try:
-                                    df_madre = pd.read_csv(StringIO(madre_text))
-                                    print(f"✅ Archivo madre leído con codificación: {encoding} y delimitador automático")
-                                    break
-                                except:
-                                    continue
-                    except:
-                        continue
-                
-                if df_madre is None:
+                # Para CSV, detectar codificación, delimitador y encabezados y leer una sola vez
+                try:
+                    df_madre = leer_csv_desde_contenido(
+                        madre_content, ['identificationPatient', 'idOrder'],
+                        columnas=columnas_de_planilla('normal', 'madre'),
+                        columnas_texto=columnas_texto_de_planilla('normal', 'madre')
+                    )
+                except Exception as e:
                     return {
                         'success': False,
                         'error': 'No se pudo leer el archivo madre',
-                        'details': 'Verifica que el archivo tenga una codificación válida (UTF-8, Latin-1, etc.)'
+                        'details': f'Verifica que el archivo tenga una codificación válida (UTF-8, Latin-1, etc.): {str(e)}'
                     }
             
             print(f"✅ Planilla madre leída: {len(df_madre)} filas")
             
             # Leer planilla ofimatic usando la función específica
             try:
-                df_ofimatic = leer_archivo_ofimatic_desde_contenido(ofimatic_content, ofimatic_filename)
+                df_ofimatic = leer_archivo_ofimatic_desde_contenido(
+                    ofimatic_content, ofimatic_filename,
+                    columnas_texto=columnas_texto_de_planilla('normal', 'ofimatic')
+                )
             except Exception as e:
                 return {
                     'success': False,
@@ -1163,7 +3191,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             print(f"✅ Planilla ofimatic leída: {len(df_ofimatic)} filas")
             
             # Verificar columnas requeridas
-            required_madre_cols = ['identificationPatient', 'idOrder']
+            required_madre_cols = COLUMNAS_POR_MODO['normal']['madre']['requeridas']
             missing_madre = [col for col in required_madre_cols if col not in df_madre.columns]
             if missing_madre:
                 return {
@@ -1172,7 +3200,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                     'details': f'Columnas disponibles: {list(df_madre.columns)}'
                 }
             
-            required_ofimatic_cols = ['nit', 'Nrodcto']
+            required_ofimatic_cols = COLUMNAS_POR_MODO['normal']['ofimatic']['requeridas']
             missing_ofimatic = [col for col in required_ofimatic_cols if col not in df_ofimatic.columns]
             if missing_ofimatic:
                 return {
@@ -1182,32 +3210,31 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Seleccionar y limpiar columnas
+            reportar_etapa('normalizacion')
             df_madre_reducido = df_madre[['identificationPatient', 'idOrder']].copy()
             df_madre_reducido['identificationPatient'] = df_madre_reducido['identificationPatient'].astype(str)
             df_ofimatic['nit'] = df_ofimatic['nit'].astype(str)
             
+            reportar_etapa('relacion', filas_madre=len(df_madre), filas_ofimatic=len(df_ofimatic))
             print(f"🔗 Procesando datos...")
             
             # En lugar de crear un DataFrame fusionado, editamos directamente el original
             # Crear un diccionario de mapeo nit -> idOrder
             mapeo_nit_idorder = df_madre_reducido.set_index('identificationPatient')['idOrder'].to_dict()
             
-            # Editar directamente el DataFrame de ofimatic
+            # Editar directamente el DataFrame de ofimatic (idOrder ya llega como texto, sin decimales)
             df_ofimatic['idOrder_mapeado'] = df_ofimatic['nit'].map(mapeo_nit_idorder).fillna('')
-            df_ofimatic['idOrder_mapeado'] = df_ofimatic['idOrder_mapeado'].astype(str)
-            
-            # Limpiar idOrder_mapeado para evitar decimales
-            df_ofimatic['idOrder_mapeado'] = df_ofimatic['idOrder_mapeado'].apply(
-                lambda x: str(int(float(x))) if x and x.replace('.','',1).isdigit() else x
-            )
             
             # Actualizar la columna Nrodcto DIRECTAMENTE en el DataFrame original
             df_ofimatic['Nrodcto'] = df_ofimatic['Nrodcto'].astype(str) + '-' + df_ofimatic['idOrder_mapeado']
             
+            relacionadas = int((df_ofimatic['idOrder_mapeado'] != '').sum())
+            
             # Eliminar la columna temporal
             df_ofimatic = df_ofimatic.drop(columns=['idOrder_mapeado'])
             
             # Generar archivo Excel preservando el formato original
+            reportar_etapa('escritura', filas_resultado=len(df_ofimatic), filas_relacionadas=relacionadas)
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
                 df_ofimatic.to_excel(writer, sheet_name='Sheet1', index=False)
@@ -1220,28 +3247,18 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 worksheet.auto_filter.ref = f"A1:{chr(65 + len(df_ofimatic.columns) - 1)}{len(df_ofimatic) + 1}"
                 
                 # Ajustar el ancho de las columnas automáticamente
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)  # Máximo 50 caracteres
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            excel_buffer.seek(0)
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+                ajustar_anchos_columnas(worksheet, df_ofimatic)
+            
+            excel_bytes = excel_buffer.getvalue()
             
             print(f"✅ Proceso completado: {len(df_ofimatic)} filas en el resultado")
             
             return {
                 'success': True,
                 'message': f'Archivo procesado exitosamente. {len(df_ofimatic)} registros actualizados.',
-                'excel_data': excel_data,
-                'filename': 'relaciones_unidas.xlsx'
+                'excel_bytes': excel_bytes,
+                'filename': 'relaciones_unidas.xlsx',
+                'metadatos': {'lectura_madre': df_madre.attrs.get('lectura')}
             }
             
         except Exception as e:
@@ -1257,6 +3274,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         Procesa archivos para el modo Bogotá: relaciona por NIT y actualiza Nrodcto
         """
         try:
+            reportar_etapa('lectura')
             print(f"🔄 [BOGOTÁ] Procesando archivos: {inicial_filename} y {pedidos_filename}")
             
             # Leer planilla inicial de Bogotá
@@ -1283,14 +3301,18 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Relacionar por NIT
+            reportar_etapa('relacion', filas_inicial=len(df_inicial), filas_pedidos=len(df_pedidos))
             print("🔗 Relacionando datos por NIT...")
             df_actualizado = relacionar_por_nit_bogota(df_inicial, df_pedidos)
             
             # Guardar con formato original
+            relacion = df_actualizado.attrs['relacion']
+            reportar_etapa('escritura', filas_resultado=len(df_actualizado),
+                           filas_relacionadas=relacion['por_nit'] + relacion['por_documento'])
             print("💾 Generando archivo Excel con formato original...")
             excel_buffer = guardar_con_formato_bogota(df_actualizado, filas_encabezado)
             
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+            excel_bytes = excel_buffer.getvalue()
             
             print(f"✅ Proceso completado: {len(df_actualizado)} registros en el resultado")
             
@@ -1300,7 +3322,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo procesado exitosamente. {len(df_actualizado)} registros procesados.',
-                'excel_data': excel_data,
+                'excel_bytes': excel_bytes,
                 'filename': f'Planilla_Relacionada_Bogota_{fecha_actual}.xlsx'
             }
             
@@ -1319,6 +3341,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         Filtra la planilla Ofimatic Bogotá para dejar solo los pedidos con Destino = B-BOGOTA
         """
         try:
+            reportar_etapa('lectura')
             print(f"🔄 [FILTRAR BOGOTÁ] Procesando archivo: {archivo_filename}")
             
             # Leer el archivo completo sin procesar
@@ -1344,6 +3367,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                     'details': f'Columnas disponibles: {list(df_datos.columns)}'
                 }
             
+            reportar_etapa('transformacion', filas_entrada=len(df_datos))
             df_filtrado = df_datos[df_datos['Destino'].isin(['B-BOGOTA', 'B-SOACHA'])].copy()
             
             # Contar registros por destino
@@ -1359,10 +3383,11 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Guardar con formato original
+            reportar_etapa('escritura', filas_resultado=len(df_filtrado))
             print("💾 Generando archivo Excel con formato original...")
             excel_buffer = guardar_con_formato_bogota(df_filtrado, filas_encabezado)
             
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+            excel_bytes = excel_buffer.getvalue()
             
             print(f"✅ Proceso completado: {len(df_filtrado)} registros en el resultado")
             
@@ -1372,7 +3397,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo filtrado exitosamente. {len(df_filtrado)} registros ({count_bogota} B-BOGOTA, {count_soacha} B-SOACHA) de {len(df_datos)} totales.',
-                'excel_data': excel_data,
+                'excel_bytes': excel_bytes,
                 'filename': f'Planilla_Filtrada_BOGOTA_SOACHA_{fecha_actual}.xlsx'
             }
             
@@ -1382,97 +3407,103 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             traceback.print_exc()
             return {
                 'success': False,
-                'error': f'Error al filtrar archivo: {str(e)}',
-                'details': 'Verifica que el archivo sea Excel (.xlsx) y tenga la estructura correcta'
+                'error': f'Error al filtrar archivo: {str(e)}',
+                'details': 'Verifica que el archivo sea Excel (.xlsx) y tenga la estructura correcta'
+            }
+    
+    def _leer_madre_medellin(self, madre_content, madre_filename):
+        """
+        Lee la planilla madre de Medellín (CSV o Excel) con los NITs normalizados.
+        Retorna (df_madre, None) o (None, dict de error).
+        """
+        # Leer planilla madre - detectar si es CSV o Excel
+        madre_extension = os.path.splitext(madre_filename)[1].lower()
+        
+        if madre_extension == '.csv':
+            print("📄 Detectado archivo CSV para planilla madre")
+            # Detectar codificación y delimitador con los primeros KB y leer una sola vez
+            try:
+                df_madre = leer_csv_desde_contenido(
+                    madre_content, ['identificationPatient', 'idOrder'],
+                    columnas=columnas_de_planilla('medellin_libro2', 'madre'),
+                    columnas_texto=columnas_texto_de_planilla('medellin_libro2', 'madre')
+                )
+            except Exception as e:
+                return None, {
+                    'success': False,
+                    'error': 'No se pudo leer el archivo CSV de planilla madre',
+                    'details': f'Verifica que el archivo tenga las columnas identificationPatient e idOrder: {str(e)}'
+                }
+        else:
+            # Usar la función existente para Excel
+            df_madre = leer_excel_inteligente_desde_contenido(
+                madre_content, columnas=columnas_de_planilla('medellin_libro2', 'madre'),
+                columnas_texto=columnas_texto_de_planilla('medellin_libro2', 'madre')
+            )
+        
+        print(f"✅ Planilla madre leída: {len(df_madre)} filas")
+        registrar_evento('debug', 'columnas', planilla='madre', columnas=list(df_madre.columns))
+        
+        # Verificar columnas requeridas en planilla madre
+        required_madre_cols = COLUMNAS_POR_MODO['medellin_libro2']['madre']['requeridas']
+        missing_madre = [col for col in required_madre_cols if col not in df_madre.columns]
+        if missing_madre:
+            return None, {
+                'success': False,
+                'error': f'Columnas faltantes en planilla madre: {missing_madre}',
+                'details': f'Columnas disponibles: {list(df_madre.columns)}'
             }
+        
+        # Los NITs ya llegan como texto (sin .0): solo quitar espacios
+        df_madre['identificationPatient'] = df_madre['identificationPatient'].astype(str).str.strip()
+        return df_madre, None
+    
+    def _mapeos_madre_medellin(self, df_madre):
+        """Diccionarios NIT → valor de cada columna de COLUMNAS_INDICE_MADRE (vacío si la madre no la tiene)"""
+        madre_por_nit = df_madre.set_index('identificationPatient')
+        return {
+            columna: madre_por_nit[columna].to_dict() if columna in madre_por_nit.columns else {}
+            for columna in COLUMNAS_INDICE_MADRE
+        }
     
-    def process_medellin_libro2(self, madre_content, madre_filename, ofimatic_content, ofimatic_filename):
+    def process_medellin_libro2(self, madre_content, madre_filename, ofimatic_content, ofimatic_filename, madre_id=None):
         """
         Procesa archivos de Medellín (madre + ofimatic) y los transforma al formato Libro2.xlsx
         Soporta CSV y Excel para la planilla madre
+        Con madre_id se relaciona contra una planilla madre registrada con POST /madre (sin madre_content)
         """
         try:
-            print(f"🔄 [MEDELLÍN → LIBRO2] Procesando archivos: {madre_filename} y {ofimatic_filename}")
-            
-            # Leer planilla madre - detectar si es CSV o Excel
-            madre_extension = os.path.splitext(madre_filename)[1].lower()
-            
-            if madre_extension == '.csv':
-                print("📄 Detectado archivo CSV para planilla madre")
-                # Intentar diferentes codificaciones y delimitadores
-                codificaciones = ['utf-8', 'latin-1', 'iso-8859-1', 'cp1252']
-                delimitadores = [',', ';', '\t']
-                
-                df_madre = None
-                for encoding in codificaciones:
-                    if df_madre is not None:
-                        break
-                    for delim in delimitadores:
-                        try:
-                            texto = madre_content.decode(encoding)
-                            df_test = pd.read_csv(StringIO(texto), delimiter=delim)
-                            
-                            # Verificar si tiene columnas conocidas de madre
-                            if 'identificationPatient' in df_test.columns and 'idOrder' in df_test.columns:
-                                df_madre = df_test
-                                print(f"✅ CSV leído correctamente con encoding={encoding}, delimitador='{delim}'")
-                                break
-                        except Exception as e:
-                            continue
-                
-                if df_madre is None:
-                    return {
-                        'success': False,
-                        'error': 'No se pudo leer el archivo CSV de planilla madre',
-                        'details': 'Verifica que el archivo tenga las columnas identificationPatient e idOrder'
-                    }
+            reportar_etapa('lectura')
+            if madre_id is None:
+                print(f"🔄 [MEDELLÍN → LIBRO2] Procesando archivos: {madre_filename} y {ofimatic_filename}")
+                df_madre, error = self._leer_madre_medellin(madre_content, madre_filename)
+                if error:
+                    return error
             else:
-                # Usar la función existente para Excel
-                df_madre = leer_excel_inteligente_desde_contenido(madre_content)
-            
-            print(f"✅ Planilla madre leída: {len(df_madre)} filas")
-            print(f"   Columnas disponibles: {list(df_madre.columns)}")
+                print(f"🔄 [MEDELLÍN → LIBRO2] Procesando {ofimatic_filename} con la planilla madre registrada '{madre_id}'")
+                df_madre = None
             
             # Leer planilla ofimatic (con estructura especial de 4 filas de encabezado)
-            df_ofimatic = pd.read_excel(BytesIO(ofimatic_content), header=3)
+            df_ofimatic = leer_excel_inteligente_desde_contenido(
+                ofimatic_content, columnas=columnas_de_planilla('medellin_libro2', 'ofimatic'), fila_encabezados=3,
+                columnas_texto=columnas_texto_de_planilla('medellin_libro2', 'ofimatic')
+            )
             print(f"✅ Planilla ofimatic leída: {len(df_ofimatic)} filas")
-            print(f"   Columnas disponibles: {list(df_ofimatic.columns)}")
-            
-            # DEBUG: Inspeccionar columna NomMensajero
-            print("\n🔍 DEBUG: Analizando columna 'NomMensajero'...")
-            for col in df_ofimatic.columns:
-                if 'NomMensajero' in str(col) or 'mensajero' in str(col).lower():
-                    print(f"   Columna encontrada: '{col}'")
-                    print(f"   Tipo: {type(col)}")
-                    print(f"   Repr: {repr(col)}")
-                    if isinstance(col, str):
-                        print(f"   Bytes: {col.encode('utf-8')}")
-                        print(f"   Caracteres:")
-                        for i, char in enumerate(col):
-                            print(f"      [{i}] '{char}' -> U+{ord(char):04X}")
-                    
-                    # Valores únicos
-                    valores = df_ofimatic[col].dropna().unique()[:5]
-                    print(f"   Primeros 5 valores únicos:")
-                    for val in valores:
-                        print(f"      - '{val}'")
-                    break
-            print("🔍 Fin del debug\n")
             
-            # Verificar columnas requeridas en planilla madre
-            required_madre_cols = ['identificationPatient', 'idOrder']
-            optional_madre_cols = ['addressPatient', 'mobilePhonePatient', 'cityNameOrder']
-            missing_madre = [col for col in required_madre_cols if col not in df_madre.columns]
-            if missing_madre:
-                return {
-                    'success': False,
-                    'error': f'Columnas faltantes en planilla madre: {missing_madre}',
-                    'details': f'Columnas disponibles: {list(df_madre.columns)}'
-                }
+            if log_habilitado('debug'):
+                # Inspeccionar la columna NomMensajero (nombres con caracteres invisibles o acentos distintos)
+                columna = next((col for col in df_ofimatic.columns
+                                if 'NomMensajero' in str(col) or 'mensajero' in str(col).lower()), None)
+                registrar_evento(
+                    'debug', 'columna_mensajero',
+                    columnas=list(df_ofimatic.columns),
+                    columna=repr(columna),
+                    caracteres=[f'U+{ord(c):04X}' for c in columna] if isinstance(columna, str) else None,
+                    valores=df_ofimatic[columna].dropna().unique()[:5].tolist() if columna is not None else None
+                )
             
             # Verificar columnas requeridas en planilla ofimatic
-            required_ofimatic_cols = ['nit', 'Nrodcto']
-            optional_ofimatic_cols = ['NomMensajero', 'NOMBRE', 'DIRECCION', 'TEL1', 'TEL2', 'TipoVta', 'Destino']
+            required_ofimatic_cols = COLUMNAS_POR_MODO['medellin_libro2']['ofimatic']['requeridas']
             missing_ofimatic = [col for col in required_ofimatic_cols if col not in df_ofimatic.columns]
             if missing_ofimatic:
                 return {
@@ -1482,54 +3513,50 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Normalizar tipos de datos
-            print("\n🔍 DEBUG: Normalizando NITs...")
-            
-            # Limpiar NITs de la planilla madre: convertir a string, eliminar .0 y espacios
-            df_madre['identificationPatient'] = df_madre['identificationPatient'].apply(
-                lambda x: str(x).replace('.0', '') if pd.notna(x) and str(x).endswith('.0') else str(x)
-            ).str.strip()
-            
-            # Limpiar NITs de la planilla ofimatic: convertir a string, eliminar .0 y espacios
-            df_ofimatic['nit'] = df_ofimatic['nit'].apply(
-                lambda x: str(x).replace('.0', '') if pd.notna(x) and str(x).endswith('.0') else str(x)
-            ).str.strip()
-            
-            # Mostrar ejemplos de NITs
-            print(f"📋 Ejemplos NITs madre: {df_madre['identificationPatient'].head(10).tolist()}")
-            print(f"📋 Ejemplos NITs ofimatic: {df_ofimatic['nit'].head(10).tolist()}")
-            
-            # Verificar NITs en común
-            nits_madre = set(df_madre['identificationPatient'].unique())
-            nits_ofimatic = set(df_ofimatic['nit'].unique())
-            nits_comunes = nits_madre.intersection(nits_ofimatic)
-            
-            print(f"\n📊 Estadísticas de NITs:")
-            print(f"   - Total NITs únicos en madre: {len(nits_madre)}")
-            print(f"   - Total NITs únicos en ofimatic: {len(nits_ofimatic)}")
-            print(f"   - NITs en común: {len(nits_comunes)}")
-            
-            if len(nits_comunes) > 0:
-                print(f"   - Ejemplos de NITs en común: {list(nits_comunes)[:5]}")
-            else:
-                print("\n⚠️ ¡ADVERTENCIA! No hay NITs en común entre las planillas")
-                print(f"   - Primeros 5 NITs madre: {list(nits_madre)[:5]}")
-                print(f"   - Primeros 5 NITs ofimatic: {list(nits_ofimatic)[:5]}")
+            reportar_etapa('normalizacion')
+            df_ofimatic['nit'] = df_ofimatic['nit'].astype(str).str.strip()
+            
+            if log_habilitado('debug'):
+                # Ejemplos y NITs en común entre las planillas (recorre todos los NITs)
+                nits_ofimatic = set(df_ofimatic['nit'].unique())
+                diagnostico = {'ejemplos_ofimatic': df_ofimatic['nit'].head(10).tolist(),
+                               'nits_ofimatic': len(nits_ofimatic)}
+                if df_madre is not None:
+                    nits_madre = set(df_madre['identificationPatient'].unique())
+                    nits_comunes = nits_madre.intersection(nits_ofimatic)
+                    diagnostico.update({
+                        'ejemplos_madre': df_madre['identificationPatient'].head(10).tolist(),
+                        'nits_madre': len(nits_madre),
+                        'nits_comunes': len(nits_comunes),
+                        'ejemplos_comunes': list(nits_comunes)[:5]
+                    })
+                registrar_evento('debug', 'nits_medellin', **diagnostico)
             
             # Paso 1: Relacionar por NIT (igual que en Medellín normal)
             print("\n🔗 Paso 1: Relacionando por NIT...")
-            mapeo_nit_idorder = df_madre.set_index('identificationPatient')['idOrder'].to_dict()
-            
-            # Crear diccionarios de mapeo adicionales desde la planilla madre
-            mapeo_address = {}
-            mapeo_phone = {}
-            mapeo_city = {}
+            if df_madre is not None:
+                reportar_etapa('relacion', filas_madre=len(df_madre), filas_ofimatic=len(df_ofimatic))
+                mapeos = self._mapeos_madre_medellin(df_madre)
+                metadatos = {'lectura_madre': df_madre.attrs.get('lectura')}
+            else:
+                # Solo se consultan en el índice los NITs de este ofimatic
+                encontrado = mapeos_desde_madre(madre_id, df_ofimatic['nit'].unique())
+                if encontrado is None:
+                    return {
+                        'success': False,
+                        'error': f'No existe la planilla madre registrada: {madre_id}',
+                        'details': 'Registra la planilla madre de nuevo con POST /madre (las versiones antiguas se eliminan)'
+                    }
+                info_madre, mapeos = encontrado
+                reportar_etapa('relacion', filas_madre=info_madre['filas'], filas_ofimatic=len(df_ofimatic))
+                print(f"   Planilla madre '{info_madre['madre_id']}' ({info_madre['archivo']}, {info_madre['fecha']}): "
+                      f"{len(mapeos['idOrder'])} NITs en común")
+                metadatos = {'madre': info_madre}
             
-            if 'addressPatient' in df_madre.columns:
-                mapeo_address = df_madre.set_index('identificationPatient')['addressPatient'].to_dict()
-            if 'mobilePhonePatient' in df_madre.columns:
-                mapeo_phone = df_madre.set_index('identificationPatient')['mobilePhonePatient'].to_dict()
-            if 'cityNameOrder' in df_madre.columns:
-                mapeo_city = df_madre.set_index('identificationPatient')['cityNameOrder'].to_dict()
+            mapeo_nit_idorder = mapeos['idOrder']
+            mapeo_address = mapeos['addressPatient']
+            mapeo_phone = mapeos['mobilePhonePatient']
+            mapeo_city = mapeos['cityNameOrder']
             
             # Aplicar mapeos
             df_ofimatic['idOrder_mapeado'] = df_ofimatic['nit'].map(mapeo_nit_idorder).fillna('')
@@ -1537,11 +3564,6 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             df_ofimatic['phonePatient_madre'] = df_ofimatic['nit'].map(mapeo_phone).fillna('')
             df_ofimatic['cityNameOrder_madre'] = df_ofimatic['nit'].map(mapeo_city).fillna('')
             
-            # Limpiar idOrder_mapeado para evitar decimales
-            df_ofimatic['idOrder_mapeado'] = df_ofimatic['idOrder_mapeado'].apply(
-                lambda x: str(int(float(x))) if x and str(x).replace('.','',1).replace('-','',1).isdigit() else str(x)
-            )
-            
             # Actualizar Nrodcto con el formato: Nrodcto-idOrder
             df_ofimatic['Nrodcto_relacionado'] = df_ofimatic.apply(
                 lambda row: f"{row['Nrodcto']}-{row['idOrder_mapeado']}" if row['idOrder_mapeado'] else row['Nrodcto'],
@@ -1561,73 +3583,26 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 print("   3. Que haya NITs coincidentes entre ambas planillas")
             
             # Paso 2: Transformar al formato Libro2.xlsx
+            reportar_etapa('transformacion')
             print("🔄 Paso 2: Transformando al formato Libro2...")
             
-            # Limpiar espacios en NomMensajero
-            if 'NomMensajero' in df_ofimatic.columns:
-                df_ofimatic['NomMensajero'] = df_ofimatic['NomMensajero'].astype(str).str.strip()
-                print(f"   ✅ Columna 'NomMensajero' limpiada de espacios")
-            
-            # Crear DataFrame con estructura de Libro2
-            df_libro2 = pd.DataFrame()
-            
-            # Nombre Vehiculo = NomMensajero (de ofimatic)
-            df_libro2['Nombre Vehiculo'] = df_ofimatic['NomMensajero'] if 'NomMensajero' in df_ofimatic.columns else ''
-            
-            # Título de la Visita = NOMBRE - identificationPatient
-            # Limpiar espacios extras del nombre y normalizar NIT (quitar .0)
-            def crear_titulo_visita(row):
-                nombre = str(row['NOMBRE']).strip() if pd.notna(row['NOMBRE']) else ''
-                # Limpiar espacios múltiples y reemplazar por un solo espacio
-                nombre = ' '.join(nombre.split())
-                
-                # Normalizar NIT: quitar .0 si es flotante
-                nit = row['nit']
-                if pd.notna(nit):
-                    nit_str = str(nit)
-                    # Si termina en .0, quitarlo
-                    if nit_str.endswith('.0'):
-                        nit_str = nit_str[:-2]
-                    nit = nit_str
-                else:
-                    nit = ''
-                
-                return f"{nombre} - {nit}" if nombre and nit else (nombre if nombre else nit)
-            
-            df_libro2['Título de la Visita'] = df_ofimatic.apply(crear_titulo_visita, axis=1)
-            
-            # Dirección = addressPatient de madre (si existe) + ", " + ciudad + ", Antioquia"
-            # Si no hay dirección de madre, usar DIRECCION de ofimatic
-            df_libro2['Dirección'] = df_ofimatic.apply(
-                lambda row: self._construir_direccion(row, mapeo_address, mapeo_city),
-                axis=1
+            # Ciudad = cityNameOrder de madre si el NIT está en ella, si no Destino de ofimatic
+            ciudad_destino = df_ofimatic['Destino'] if 'Destino' in df_ofimatic.columns else ''
+            ciudad_madre = df_ofimatic['nit'].map(mapeo_city)
+            df_ofimatic['ciudad_normalizada'] = normalizar_ciudades(
+                ciudad_madre.where(df_ofimatic['nit'].isin(list(mapeo_city)), ciudad_destino)
             )
             
-            # Latitud y Longitud - vacíos
-            df_libro2['Latitud'] = None
-            df_libro2['Longitud'] = None
-            
-            # ID Referencia = Nrodcto relacionado
-            df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
-            
-            # Notas = TipoVta (de ofimatic)
-            df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
-            
-            # Persona de Contacto - vacío
-            df_libro2['Persona de Contacto'] = None
+            # Dirección base = addressPatient de madre (si existe), si no DIRECCION de ofimatic
+            df_ofimatic['direccion_base'] = self._direcciones_base(df_ofimatic, mapeo_address)
             
-            # Teléfono = mobilePhonePatient de madre si existe, sino TEL1 o TEL2 de ofimatic
-            df_libro2['Teléfono'] = df_ofimatic.apply(
-                lambda row: self._obtener_telefono_medellin(row),
-                axis=1
-            )
-            
-            # Emails - vacío
-            df_libro2['Emails'] = None
+            # Columnas de Libro2 según MAPEOS_LIBRO2['medellin']
+            df_libro2 = construir_libro2(df_ofimatic, 'medellin')
             
             print(f"✅ DataFrame Libro2 creado: {len(df_libro2)} registros")
             
             # Generar archivo Excel
+            reportar_etapa('escritura', filas_resultado=len(df_libro2), filas_relacionadas=int(relacionados_count))
             print("💾 Generando archivo Excel formato Libro2...")
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -1637,20 +3612,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 workbook = writer.book
                 worksheet = writer.sheets['Hoja1']
                 
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value and len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            excel_buffer.seek(0)
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+                ajustar_anchos_columnas(worksheet, df_libro2)
+            
+            excel_bytes = excel_buffer.getvalue()
             
             print(f"✅ Proceso completado: {len(df_libro2)} registros en formato Libro2")
             
@@ -1660,8 +3624,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo transformado exitosamente. {len(df_libro2)} registros en formato Libro2.',
-                'excel_data': excel_data,
-                'filename': f'Libro2_Medellin_{fecha_actual}.xlsx'
+                'excel_bytes': excel_bytes,
+                'filename': f'Libro2_Medellin_{fecha_actual}.xlsx',
+                'metadatos': metadatos
             }
             
         except Exception as e:
@@ -1679,21 +3644,27 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         Procesa archivos de Bogotá (ehlpharma + ofimatic) y los transforma al formato Libro2.xlsx
         """
         try:
+            reportar_etapa('lectura')
             print(f"🔄 [BOGOTÁ → LIBRO2] Procesando archivos: {ehlpharma_filename} y {ofimatic_filename}")
             
             # Leer planilla ehlpharma (similar a madre pero con columnas diferentes)
-            df_ehlpharma = leer_excel_inteligente_desde_contenido(ehlpharma_content)
+            df_ehlpharma = leer_excel_inteligente_desde_contenido(
+                ehlpharma_content, columnas=columnas_de_planilla('bogota_libro2', 'ehlpharma'),
+                columnas_texto=columnas_texto_de_planilla('bogota_libro2', 'ehlpharma')
+            )
             print(f"✅ Planilla ehlpharma leída: {len(df_ehlpharma)} filas")
-            print(f"   Columnas disponibles: {list(df_ehlpharma.columns)}")
+            registrar_evento('debug', 'columnas', planilla='ehlpharma', columnas=list(df_ehlpharma.columns))
             
             # Leer planilla ofimatic (con estructura especial de 4 filas de encabezado)
-            df_ofimatic = pd.read_excel(BytesIO(ofimatic_content), header=3)
+            df_ofimatic = leer_excel_inteligente_desde_contenido(
+                ofimatic_content, columnas=columnas_de_planilla('bogota_libro2', 'ofimatic'), fila_encabezados=3,
+                columnas_texto=columnas_texto_de_planilla('bogota_libro2', 'ofimatic')
+            )
             print(f"✅ Planilla ofimatic leída: {len(df_ofimatic)} filas")
-            print(f"   Columnas disponibles: {list(df_ofimatic.columns)}")
+            registrar_evento('debug', 'columnas', planilla='ofimatic', columnas=list(df_ofimatic.columns))
             
             # Verificar columnas requeridas en planilla ehlpharma
-            required_ehlpharma_cols = ['IDENTIFICACION', 'NUMERO DE PEDIDO', 'DOCUMENTO ASOCIADO']
-            optional_ehlpharma_cols = ['DIRECCION DE ENTREGA', 'CELULAR', 'CIUDAD DE ENTREGA']
+            required_ehlpharma_cols = COLUMNAS_POR_MODO['bogota_libro2']['ehlpharma']['requeridas']
             missing_ehlpharma = [col for col in required_ehlpharma_cols if col not in df_ehlpharma.columns]
             if missing_ehlpharma:
                 return {
@@ -1703,8 +3674,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Verificar columnas requeridas en planilla ofimatic
-            required_ofimatic_cols = ['nit', 'Nrodcto']
-            optional_ofimatic_cols = ['NomMensajero', 'NOMBRE', 'DIRECCION', 'TEL1', 'TEL2', 'TipoVta', 'Destino']
+            required_ofimatic_cols = COLUMNAS_POR_MODO['bogota_libro2']['ofimatic']['requeridas']
             missing_ofimatic = [col for col in required_ofimatic_cols if col not in df_ofimatic.columns]
             if missing_ofimatic:
                 return {
@@ -1714,6 +3684,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 }
             
             # Normalizar tipos de datos
+            reportar_etapa('normalizacion')
             df_ehlpharma['IDENTIFICACION'] = df_ehlpharma['IDENTIFICACION'].astype(str)
             df_ehlpharma['DOCUMENTO ASOCIADO'] = df_ehlpharma['DOCUMENTO ASOCIADO'].apply(
                 lambda x: self._normalizar_documento_asociado(x)
@@ -1726,125 +3697,45 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             )
             
             # Paso 1: Relacionar por NIT Y por DOCUMENTO ASOCIADO
+            reportar_etapa('relacion', filas_ehlpharma=len(df_ehlpharma), filas_ofimatic=len(df_ofimatic))
             print("🔗 Paso 1: Relacionando por NIT y DOCUMENTO ASOCIADO...")
             
-            # Mapeo principal por NIT
-            mapeo_nit_idorder = df_ehlpharma.set_index('IDENTIFICACION')['NUMERO DE PEDIDO'].to_dict()
-            mapeo_nit_documento = df_ehlpharma.set_index('IDENTIFICACION')['DOCUMENTO ASOCIADO'].to_dict()
-            
-            # Mapeo secundario por DOCUMENTO ASOCIADO (para relacionar con Nrodcto)
-            mapeo_documento_idorder = df_ehlpharma.set_index('DOCUMENTO ASOCIADO')['NUMERO DE PEDIDO'].to_dict()
-            # Para obtener el documento asociado original, no necesitamos este mapeo ya que ya está normalizado
-            
-            # Crear diccionarios de mapeo desde ehlpharma
-            # Mapeos por NIT (IDENTIFICACION)
-            mapeo_address_nit = {}
-            mapeo_phone_nit = {}
-            mapeo_city_nit = {}
-            
-            # Mapeos por DOCUMENTO ASOCIADO
-            mapeo_address_doc = {}
-            mapeo_phone_doc = {}
-            mapeo_city_doc = {}
-            
-            if 'DIRECCION DE ENTREGA' in df_ehlpharma.columns:
-                mapeo_address_nit = df_ehlpharma.set_index('IDENTIFICACION')['DIRECCION DE ENTREGA'].to_dict()
-                mapeo_address_doc = df_ehlpharma.set_index('DOCUMENTO ASOCIADO')['DIRECCION DE ENTREGA'].to_dict()
-            if 'CELULAR' in df_ehlpharma.columns:
-                mapeo_phone_nit = df_ehlpharma.set_index('IDENTIFICACION')['CELULAR'].to_dict()
-                mapeo_phone_doc = df_ehlpharma.set_index('DOCUMENTO ASOCIADO')['CELULAR'].to_dict()
-            if 'CIUDAD DE ENTREGA' in df_ehlpharma.columns:
-                mapeo_city_nit = df_ehlpharma.set_index('IDENTIFICACION')['CIUDAD DE ENTREGA'].to_dict()
-                mapeo_city_doc = df_ehlpharma.set_index('DOCUMENTO ASOCIADO')['CIUDAD DE ENTREGA'].to_dict()
-            
-            # Aplicar mapeos - Intentar primero por NIT, luego por DOCUMENTO ASOCIADO
-            def obtener_idorder(row):
-                nit = str(row['nit'])
-                nrodcto_norm = row['Nrodcto_normalizado']
-                
-                # Prioridad 1: Por NIT
-                if nit in mapeo_nit_idorder:
-                    return mapeo_nit_idorder[nit]
-                # Prioridad 2: Por DOCUMENTO ASOCIADO (Nrodcto normalizado)
-                elif nrodcto_norm in mapeo_documento_idorder:
-                    return mapeo_documento_idorder[nrodcto_norm]
-                else:
-                    return ''
-            
-            def obtener_documento_asociado(row):
-                nit = str(row['nit'])
-                nrodcto_norm = row['Nrodcto_normalizado']
-                
-                # Prioridad 1: Por NIT
-                if nit in mapeo_nit_documento:
-                    return mapeo_nit_documento[nit]
-                # Prioridad 2: Por DOCUMENTO ASOCIADO normalizado (usar el mismo valor normalizado)
-                # Si el Nrodcto normalizado coincide con algún documento asociado normalizado
-                elif nrodcto_norm in mapeo_documento_idorder:
-                    # El documento asociado ya está normalizado en el DataFrame
-                    return nrodcto_norm
-                else:
-                    # Si no hay relación, usar el Nrodcto normalizado
-                    return nrodcto_norm
-            
-            def obtener_address_ehlpharma(row):
-                nit = str(row['nit'])
-                nrodcto_norm = row['Nrodcto_normalizado']
-                
-                # Prioridad 1: Por NIT
-                if nit in mapeo_address_nit and mapeo_address_nit[nit]:
-                    return mapeo_address_nit[nit]
-                # Prioridad 2: Por DOCUMENTO ASOCIADO
-                elif nrodcto_norm in mapeo_address_doc and mapeo_address_doc[nrodcto_norm]:
-                    return mapeo_address_doc[nrodcto_norm]
-                else:
-                    return ''
-            
-            def obtener_phone_ehlpharma(row):
-                nit = str(row['nit'])
-                nrodcto_norm = row['Nrodcto_normalizado']
-                
-                # Prioridad 1: Por NIT
-                if nit in mapeo_phone_nit and mapeo_phone_nit[nit]:
-                    return mapeo_phone_nit[nit]
-                # Prioridad 2: Por DOCUMENTO ASOCIADO
-                elif nrodcto_norm in mapeo_phone_doc and mapeo_phone_doc[nrodcto_norm]:
-                    return mapeo_phone_doc[nrodcto_norm]
-                else:
-                    return ''
-            
-            def obtener_city_ehlpharma(row):
-                nit = str(row['nit'])
-                nrodcto_norm = row['Nrodcto_normalizado']
-                
-                # Prioridad 1: Por NIT
-                if nit in mapeo_city_nit and mapeo_city_nit[nit]:
-                    return mapeo_city_nit[nit]
-                # Prioridad 2: Por DOCUMENTO ASOCIADO
-                elif nrodcto_norm in mapeo_city_doc and mapeo_city_doc[nrodcto_norm]:
-                    return mapeo_city_doc[nrodcto_norm]
+            # Resolver una sola vez, para cada fila de ofimatic, la fila de ehlpharma que le corresponde
+            # (si un NIT o documento se repite en ehlpharma, gana la última fila)
+            fila_por_nit, fila_por_documento = self._resolver_filas_ehlpharma(df_ofimatic, df_ehlpharma)
+            tiene_nit = fila_por_nit >= 0
+            
+            # Prioridad 1: Por NIT. Prioridad 2: Por DOCUMENTO ASOCIADO (Nrodcto normalizado)
+            id_order = np.full(len(df_ofimatic), '', dtype=object)
+            pedidos = df_ehlpharma['NUMERO DE PEDIDO'].to_numpy(dtype=object)
+            por_documento = ~tiene_nit & (fila_por_documento >= 0)
+            id_order[tiene_nit] = pedidos[fila_por_nit[tiene_nit]]
+            id_order[por_documento] = pedidos[fila_por_documento[por_documento]]
+            df_ofimatic['idOrder_mapeado'] = id_order
+            
+            # Documento asociado: el de ehlpharma si se relacionó por NIT, si no el Nrodcto normalizado
+            documento = df_ofimatic['Nrodcto_normalizado'].to_numpy(dtype=object).copy()
+            documentos = df_ehlpharma['DOCUMENTO ASOCIADO'].to_numpy(dtype=object)
+            documento[tiene_nit] = documentos[fila_por_nit[tiene_nit]]
+            df_ofimatic['documento_asociado_mapeado'] = documento
+            
+            # Dirección, teléfono y ciudad de ehlpharma en un solo recorrido por columna
+            columnas_ehlpharma = {
+                'address_ehlpharma': 'DIRECCION DE ENTREGA',
+                'phone_ehlpharma': 'CELULAR',
+                'city_ehlpharma': 'CIUDAD DE ENTREGA'
+            }
+            for destino, origen in columnas_ehlpharma.items():
+                if origen in df_ehlpharma.columns:
+                    df_ofimatic[destino] = self._tomar_valor_ehlpharma(
+                        df_ehlpharma[origen], fila_por_nit, fila_por_documento
+                    )
                 else:
-                    return ''
-            
-            df_ofimatic['idOrder_mapeado'] = df_ofimatic.apply(obtener_idorder, axis=1)
-            df_ofimatic['documento_asociado_mapeado'] = df_ofimatic.apply(obtener_documento_asociado, axis=1)
-            df_ofimatic['address_ehlpharma'] = df_ofimatic.apply(obtener_address_ehlpharma, axis=1)
-            df_ofimatic['phone_ehlpharma'] = df_ofimatic.apply(obtener_phone_ehlpharma, axis=1)
-            df_ofimatic['city_ehlpharma'] = df_ofimatic.apply(obtener_city_ehlpharma, axis=1)
-            
-            # Limpiar idOrder_mapeado para evitar decimales y NaN
-            def limpiar_idorder(x):
-                if not x or pd.isna(x) or str(x).strip() == '' or str(x).lower() == 'nan':
-                    return ''
-                try:
-                    if str(x).replace('.','',1).replace('-','',1).isdigit():
-                        return str(int(float(x)))
-                    else:
-                        return str(x)
-                except:
-                    return ''
+                    df_ofimatic[destino] = ''
             
-            df_ofimatic['idOrder_mapeado'] = df_ofimatic['idOrder_mapeado'].apply(limpiar_idorder)
+            # NUMERO DE PEDIDO ya llega como texto sin decimales: solo descartar vacíos y NaN
+            id_order = df_ofimatic['idOrder_mapeado'].fillna('').astype(str)
+            df_ofimatic['idOrder_mapeado'] = id_order.where(id_order.str.strip() != '', '')
             
             # Construir ID Referencia final: DOCUMENTO_ASOCIADO-NUMERO_DE_PEDIDO
             # Solo si idOrder_mapeado tiene un valor válido (no vacío, no nan)
@@ -1860,51 +3751,26 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             
             df_ofimatic['Nrodcto_relacionado'] = df_ofimatic.apply(construir_id_referencia, axis=1)
             
-            print(f"✅ Relacionados: {(df_ofimatic['idOrder_mapeado'] != '').sum()} de {len(df_ofimatic)} registros")
+            relacionadas = int((df_ofimatic['idOrder_mapeado'] != '').sum())
+            print(f"✅ Relacionados: {relacionadas} de {len(df_ofimatic)} registros")
             
             # Paso 2: Transformar al formato Libro2.xlsx
+            reportar_etapa('transformacion')
             print("🔄 Paso 2: Transformando al formato Libro2...")
             
-            # Crear DataFrame con estructura de Libro2
-            df_libro2 = pd.DataFrame()
-            
-            # Nombre Vehiculo = NomMensajero (de ofimatic)
-            df_libro2['Nombre Vehiculo'] = df_ofimatic['NomMensajero'] if 'NomMensajero' in df_ofimatic.columns else ''
-            
-            # Título de la Visita = NOMBRE (de ofimatic)
-            df_libro2['Título de la Visita'] = df_ofimatic['NOMBRE'] if 'NOMBRE' in df_ofimatic.columns else ''
-            
-            # Dirección = Dirección de ehlpharma + ", " + ciudad + ", Cundinamarca"
-            df_libro2['Dirección'] = df_ofimatic.apply(
-                lambda row: self._construir_direccion_bogota(row),
-                axis=1
-            )
-            
-            # Latitud y Longitud - vacíos
-            df_libro2['Latitud'] = None
-            df_libro2['Longitud'] = None
-            
-            # ID Referencia = Nrodcto relacionado
-            df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
-            
-            # Notas = TipoVta (de ofimatic)
-            df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
-            
-            # Persona de Contacto - vacío
-            df_libro2['Persona de Contacto'] = None
+            # Ciudad extraída y normalizada una vez por valor distinto
+            df_ofimatic['ciudad_normalizada'] = self._extraer_ciudades_bogota(df_ofimatic)
             
-            # Teléfono = De ehlpharma si existe, sino TEL1 o TEL2 de ofimatic
-            df_libro2['Teléfono'] = df_ofimatic.apply(
-                lambda row: self._obtener_telefono(row),
-                axis=1
-            )
+            # Dirección base = Dirección de ehlpharma u ofimatic según la relación
+            df_ofimatic['direccion_base'] = self._direcciones_base_bogota(df_ofimatic)
             
-            # Emails - vacío
-            df_libro2['Emails'] = None
+            # Columnas de Libro2 según MAPEOS_LIBRO2['bogota']
+            df_libro2 = construir_libro2(df_ofimatic, 'bogota')
             
             print(f"✅ DataFrame Libro2 creado: {len(df_libro2)} registros")
             
             # Generar archivo Excel
+            reportar_etapa('escritura', filas_resultado=len(df_libro2), filas_relacionadas=relacionadas)
             print("💾 Generando archivo Excel formato Libro2...")
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -1914,20 +3780,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 workbook = writer.book
                 worksheet = writer.sheets['Hoja1']
                 
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value and len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            excel_buffer.seek(0)
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+                ajustar_anchos_columnas(worksheet, df_libro2)
+            
+            excel_bytes = excel_buffer.getvalue()
             
             print(f"✅ Proceso completado: {len(df_libro2)} registros en formato Libro2")
             
@@ -1937,8 +3792,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo transformado exitosamente. {len(df_libro2)} registros en formato Libro2 Bogotá.',
-                'excel_data': excel_data,
-                'filename': f'Libro2_Bogota_{fecha_actual}.xlsx'
+                'excel_bytes': excel_bytes,
+                'filename': f'Libro2_Bogota_{fecha_actual}.xlsx',
+                'metadatos': {'lectura_ehlpharma': df_ehlpharma.attrs.get('lectura')}
             }
             
         except Exception as e:
@@ -1951,6 +3807,46 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 'details': 'Verifica que los archivos tengan las columnas correctas'
             }
     
+    def _resolver_filas_ehlpharma(self, df_ofimatic, df_ehlpharma):
+        """
+        Para cada fila de ofimatic retorna la posición de la fila de ehlpharma que le corresponde
+        por NIT (nit == IDENTIFICACION) y por documento (Nrodcto_normalizado == DOCUMENTO ASOCIADO).
+        Retorna dos arreglos de posiciones; -1 indica que no hay relación.
+        Si la clave se repite en ehlpharma gana la última fila (igual que un diccionario).
+        """
+        posiciones = np.arange(len(df_ehlpharma))
+        
+        posicion_por_nit = pd.Series(posiciones, index=df_ehlpharma['IDENTIFICACION'].to_numpy())
+        posicion_por_nit = posicion_por_nit[~posicion_por_nit.index.duplicated(keep='last')]
+        
+        posicion_por_documento = pd.Series(posiciones, index=df_ehlpharma['DOCUMENTO ASOCIADO'].to_numpy())
+        posicion_por_documento = posicion_por_documento[~posicion_por_documento.index.duplicated(keep='last')]
+        
+        fila_por_nit = df_ofimatic['nit'].map(posicion_por_nit).fillna(-1).to_numpy(dtype='int64')
+        fila_por_documento = df_ofimatic['Nrodcto_normalizado'].map(posicion_por_documento).fillna(-1).to_numpy(dtype='int64')
+        
+        return fila_por_nit, fila_por_documento
+    
+    def _tomar_valor_ehlpharma(self, columna, fila_por_nit, fila_por_documento):
+        """
+        Toma los valores de una columna de ehlpharma para cada fila de ofimatic:
+        prioridad 1 la fila relacionada por NIT, prioridad 2 la relacionada por documento.
+        Igual que en la búsqueda por diccionario, se descartan los valores vacíos ('', 0, None)
+        """
+        resultado = np.full(len(fila_por_nit), '', dtype=object)
+        valores = columna.to_numpy(dtype=object)
+        if len(valores) == 0:
+            return resultado
+        con_valor = valores.astype(bool)
+        
+        usar_nit = (fila_por_nit >= 0) & con_valor[fila_por_nit]
+        usar_documento = ~usar_nit & (fila_por_documento >= 0) & con_valor[fila_por_documento]
+        
+        resultado[usar_nit] = valores[fila_por_nit[usar_nit]]
+        resultado[usar_documento] = valores[fila_por_documento[usar_documento]]
+        
+        return resultado
+    
     def _normalizar_documento_asociado(self, documento):
         """
         Normaliza el DOCUMENTO ASOCIADO de ehlpharma para facilitar la relación:
@@ -1968,248 +3864,71 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         
         return documento_str
     
-    def _normalizar_ciudad(self, ciudad):
-        """
-        Normaliza el nombre de la ciudad:
-        - Elimina tildes y caracteres especiales
-        - Convierte a MAYÚSCULAS
-        """
-        if not ciudad or pd.isna(ciudad):
-            return ''
-        
-        ciudad_str = str(ciudad).strip()
-        
-        # Mapeo de caracteres con tilde a sin tilde
-        tildes = {
-            'á': 'a', 'é': 'e', 'í': 'i', 'ó': 'o', 'ú': 'u',
-            'Á': 'A', 'É': 'E', 'Í': 'I', 'Ó': 'O', 'Ú': 'U',
-            'ñ': 'n', 'Ñ': 'N',
-            'ü': 'u', 'Ü': 'U'
-        }
-        
-        # Reemplazar caracteres con tilde
-        for con_tilde, sin_tilde in tildes.items():
-            ciudad_str = ciudad_str.replace(con_tilde, sin_tilde)
-        
-        # Convertir a mayúsculas
-        return ciudad_str.upper()
-    
-    def _construir_direccion(self, row, mapeo_address, mapeo_city):
+    def _direcciones_base(self, df_ofimatic, mapeo_address):
         """
-        Construye la dirección en formato: direccion, ciudad, Antioquia
+        Dirección de cada fila sin ciudad ni departamento (el kernel 'direccion' de MAPEOS_LIBRO2 los agrega)
         Prioriza la dirección de la planilla madre, si no existe usa la de ofimatic
         """
-        nit = str(row['nit'])
-        ciudad_raw = mapeo_city.get(nit, row.get('Destino', ''))
-        
-        # Normalizar ciudad (sin tildes, en MAYÚSCULAS)
-        ciudad = self._normalizar_ciudad(ciudad_raw)
+        # Prioridad 1: Dirección de planilla madre (si el NIT está y el valor no es vacío)
+        direccion_madre = df_ofimatic['nit'].map(mapeo_address)
+        usar_madre = df_ofimatic['nit'].isin(list(mapeo_address)) & direccion_madre.to_numpy(dtype=object).astype(bool)
         
-        # Prioridad 1: Dirección de planilla madre
-        if nit in mapeo_address and mapeo_address[nit]:
-            direccion_base = str(mapeo_address[nit]).strip()
         # Prioridad 2: Dirección de planilla ofimatic
-        elif 'DIRECCION' in row and pd.notna(row['DIRECCION']):
-            direccion_base = str(row['DIRECCION']).strip()
+        if 'DIRECCION' in df_ofimatic.columns:
+            direccion_ofimatic = _texto_sin_espacios(df_ofimatic['DIRECCION']).where(df_ofimatic['DIRECCION'].notna(), '')
         else:
-            direccion_base = ''
-        
-        # Agregar coma al final de la dirección si no está vacía
-        if direccion_base and not direccion_base.endswith(','):
-            direccion_base += ','
-        
-        # Construir dirección completa: "direccion, ciudad, Antioquia"
-        if direccion_base and ciudad:
-            return f"{direccion_base} {ciudad}, Antioquia"
-        elif direccion_base:
-            return f"{direccion_base} Antioquia"
-        elif ciudad:
-            return f"{ciudad}, Antioquia"
-        else:
-            return "Antioquia"
-    
-    def _obtener_telefono_medellin(self, row):
-        """
-        Obtiene el teléfono para Medellín priorizando el de la planilla madre (phonePatient_madre)
-        Limpia decimales (.0) y valida que no sean números inválidos como 000
-        Si TEL1 es inválido, prueba con TEL2 antes de descartar
-        """
-        def limpiar_telefono(telefono):
-            """Limpia y valida el teléfono"""
-            if pd.isna(telefono):
-                return None
-            
-            telefono_str = str(telefono).strip()
-            
-            # Eliminar .0 al final si existe
-            if telefono_str.endswith('.0'):
-                telefono_str = telefono_str[:-2]
-            
-            # Convertir a int y luego a str si es un número flotante
-            try:
-                if '.' in str(telefono):
-                    telefono_str = str(int(float(telefono)))
-            except:
-                pass
-            
-            # Validar que no sea vacío, nan, none, o inválido
-            if not telefono_str or telefono_str.lower() in ['nan', 'none', '']:
-                return None
-            
-            # Validar que no sea solo ceros (000, 0000, etc.)
-            if telefono_str.replace('0', '') == '':
-                return None
-            
-            return telefono_str
-        
-        # Prioridad 1: Teléfono de planilla madre (columna phonePatient_madre)
-        if 'phonePatient_madre' in row and row['phonePatient_madre']:
-            telefono = limpiar_telefono(row['phonePatient_madre'])
-            if telefono:
-                return telefono
-        
-        # Prioridad 2: TEL1 de planilla ofimatic
-        tel1_valido = None
-        if 'TEL1' in row and pd.notna(row['TEL1']):
-            tel1_valido = limpiar_telefono(row['TEL1'])
+            direccion_ofimatic = pd.Series('', index=df_ofimatic.index)
         
-        # Prioridad 3: TEL2 de planilla ofimatic
-        tel2_valido = None
-        if 'TEL2' in row and pd.notna(row['TEL2']):
-            tel2_valido = limpiar_telefono(row['TEL2'])
-        
-        # Si TEL1 es válido, usarlo
-        if tel1_valido:
-            return tel1_valido
-        
-        # Si TEL1 no es válido pero TEL2 sí, usar TEL2
-        if tel2_valido:
-            return tel2_valido
-        
-        return None
+        return _texto_sin_espacios(direccion_madre).where(usar_madre, direccion_ofimatic)
     
-    def _obtener_telefono(self, row):
+    def _direcciones_base_bogota(self, df_ofimatic):
         """
-        Obtiene el teléfono priorizando el de la planilla ehlpharma (desde phone_ehlpharma)
-        Limpia decimales (.0) y valida que no sean números inválidos como 000
-        Si TEL1 es inválido, prueba con TEL2 antes de descartar
+        Dirección de cada fila para Bogotá, sin ciudad ni departamento (los agrega el kernel 'direccion'):
+        - Si hay relación (idOrder_mapeado válido): Usa dirección de Helpharma (address_ehlpharma)
+        - Si no hay relación: Usa dirección de Ofimatic
+        - Si tampoco está en Ofimatic pero hay dirección en Helpharma, la usa
         """
-        def limpiar_telefono(telefono):
-            """Limpia y valida el teléfono"""
-            if pd.isna(telefono):
-                return None
-            
-            telefono_str = str(telefono).strip()
-            
-            # Eliminar .0 al final si existe
-            if telefono_str.endswith('.0'):
-                telefono_str = telefono_str[:-2]
-            
-            # Convertir a int y luego a str si es un número flotante
-            try:
-                if '.' in str(telefono):
-                    telefono_str = str(int(float(telefono)))
-            except:
-                pass
-            
-            # Validar que no sea vacío, nan, none, o inválido
-            if not telefono_str or telefono_str.lower() in ['nan', 'none', '']:
-                return None
-            
-            # Validar que no sea solo ceros (000, 0000, etc.)
-            if telefono_str.replace('0', '') == '':
-                return None
-            
-            return telefono_str
-        
-        # Prioridad 1: Teléfono de planilla ehlpharma (columna phone_ehlpharma)
-        if 'phone_ehlpharma' in row and row['phone_ehlpharma']:
-            telefono = limpiar_telefono(row['phone_ehlpharma'])
-            if telefono:
-                return telefono
-        
-        # Prioridad 2: TEL1 de planilla ofimatic
-        tel1_valido = None
-        if 'TEL1' in row and pd.notna(row['TEL1']):
-            tel1_valido = limpiar_telefono(row['TEL1'])
+        vacia = pd.Series('', index=df_ofimatic.index)
         
-        # Prioridad 3: TEL2 de planilla ofimatic
-        tel2_valido = None
-        if 'TEL2' in row and pd.notna(row['TEL2']):
-            tel2_valido = limpiar_telefono(row['TEL2'])
+        id_order = df_ofimatic.get('idOrder_mapeado', vacia)
+        id_order_texto = _texto_sin_espacios(id_order)
+        tiene_relacion = (id_order.to_numpy(dtype=object).astype(bool)
+                          & (id_order_texto != '') & (id_order.astype(str).str.lower() != 'nan'))
         
-        # Si TEL1 es válido, usarlo
-        if tel1_valido:
-            return tel1_valido
+        direccion_ehlpharma = df_ofimatic.get('address_ehlpharma', vacia)
+        texto_ehlpharma = _texto_sin_espacios(direccion_ehlpharma)
+        con_ehlpharma = direccion_ehlpharma.to_numpy(dtype=object).astype(bool) & (texto_ehlpharma != '')
         
-        # Si TEL1 no es válido pero TEL2 sí, usar TEL2
-        if tel2_valido:
-            return tel2_valido
+        direccion_ofimatic = df_ofimatic['DIRECCION'] if 'DIRECCION' in df_ofimatic.columns else vacia
+        texto_ofimatic = _texto_sin_espacios(direccion_ofimatic)
+        con_ofimatic = direccion_ofimatic.notna() & (texto_ofimatic != '')
         
-        return None
-    
-    def _construir_direccion_bogota(self, row):
-        """
-        Construye la dirección para Bogotá en formato: direccion, ciudad, Cundinamarca
-        - Si hay relación (idOrder_mapeado válido): Usa dirección de Helpharma (address_ehlpharma)
-        - Si no hay relación: Usa dirección de Ofimatic
-        - Extrae ciudad de "Zipaquirá-Cundinamarca-Colombia" → "ZIPAQUIRA"
-        - Extrae ciudad de "B-CIUDAD" → "CIUDAD" 
-        - Normaliza tildes y convierte a MAYÚSCULAS
-        """
-        tiene_relacion = row.get('idOrder_mapeado', '') and str(row.get('idOrder_mapeado', '')).strip() != '' and str(row.get('idOrder_mapeado', '')).lower() != 'nan'
-        
-        # Obtener ciudad de ehlpharma (CIUDAD DE ENTREGA) - columna city_ehlpharma
-        ciudad_ehlpharma = row.get('city_ehlpharma', '')
-        
-        # Obtener ciudad de ofimatic (Destino con formato "B-CIUDAD")
-        ciudad_ofimatic = row.get('Destino', '')
-        
-        # Procesar ciudad
-        ciudad = self._extraer_ciudad_bogota(ciudad_ehlpharma, ciudad_ofimatic)
-        
-        # Prioridad 1: Si hay relación, usar dirección de Helpharma (address_ehlpharma)
-        if tiene_relacion and 'address_ehlpharma' in row and row['address_ehlpharma'] and str(row['address_ehlpharma']).strip() != '':
-            direccion_base = str(row['address_ehlpharma']).strip()
-        # Prioridad 2: Si no hay relación, usar dirección de Ofimatic
-        elif 'DIRECCION' in row and pd.notna(row['DIRECCION']) and str(row['DIRECCION']).strip() != '':
-            direccion_base = str(row['DIRECCION']).strip()
-        # Prioridad 3: Si tampoco está en Ofimatic pero hay dirección en Helpharma, usarla
-        elif 'address_ehlpharma' in row and row['address_ehlpharma'] and str(row['address_ehlpharma']).strip() != '':
-            direccion_base = str(row['address_ehlpharma']).strip()
-        else:
-            direccion_base = ''
-        
-        # Agregar coma al final de la dirección si no está vacía
-        if direccion_base and not direccion_base.endswith(','):
-            direccion_base += ','
-        
-        # Construir dirección completa: "direccion, ciudad, Cundinamarca"
-        if direccion_base and ciudad:
-            return f"{direccion_base} {ciudad}, Cundinamarca"
-        elif direccion_base:
-            return f"{direccion_base} Cundinamarca"
-        elif ciudad:
-            return f"{ciudad}, Cundinamarca"
-        else:
-            return "Cundinamarca"
+        # Prioridad 1: Helpharma si hay relación. Prioridad 2: Ofimatic. Prioridad 3: Helpharma
+        direccion_base = np.select(
+            [tiene_relacion & con_ehlpharma, con_ofimatic, con_ehlpharma],
+            [texto_ehlpharma, texto_ofimatic, texto_ehlpharma],
+            default=''
+        )
+        return pd.Series(direccion_base, index=df_ofimatic.index, dtype=object)
 
     def process_farmabogota_libro2(self, farmabogota_content, farmabogota_filename):
         """
         Procesa archivo de farmabogota y lo transforma al formato Libro2.xlsx
         """
         try:
+            reportar_etapa('lectura')
             print(f"🔄 [FARMABOGOTA → LIBRO2] Procesando archivo: {farmabogota_filename}")
             
             # Leer archivo farmabogota
-            df_farmabogota = leer_excel_inteligente_desde_contenido(farmabogota_content)
+            df_farmabogota = leer_excel_inteligente_desde_contenido(
+                farmabogota_content, columnas=columnas_de_planilla('farmabogota', 'farmabogota'),
+                columnas_texto=columnas_texto_de_planilla('farmabogota', 'farmabogota')
+            )
             print(f"✅ Archivo farmabogota leído: {len(df_farmabogota)} filas")
-            print(f"   Columnas disponibles: {list(df_farmabogota.columns)}")
+            registrar_evento('debug', 'columnas', planilla='farmabogota', columnas=list(df_farmabogota.columns))
             
             # Verificar columnas requeridas
-            required_cols = ['NUMERO DE PEDIDO', 'PACIENTE', 'IDENTIFICACION', 
-                           'CIUDAD DE ENTREGA', 'DIRECCION DE ENTREGA', 'CELULAR',
-                           'DOCUMENTO ASOCIADO']
+            required_cols = COLUMNAS_POR_MODO['farmabogota']['farmabogota']['requeridas']
                            
             missing_cols = [col for col in required_cols if col not in df_farmabogota.columns]
             if missing_cols:
@@ -2219,49 +3938,14 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                     'details': f'Columnas disponibles: {list(df_farmabogota.columns)}'
                 }
                 
-            # Crear DataFrame con estructura de Libro2
-            df_libro2 = pd.DataFrame()
-            
-            # Nombre Vehículo - vacío por ahora
-            df_libro2['Nombre Vehiculo'] = ''
-            
-            # Título de la Visita = PACIENTE
-            df_libro2['Título de la Visita'] = df_farmabogota['PACIENTE']
-            
-            # Dirección = DIRECCION DE ENTREGA + CIUDAD DE ENTREGA
-            df_libro2['Dirección'] = df_farmabogota.apply(
-                lambda row: f"{row['DIRECCION DE ENTREGA']}, {row['CIUDAD DE ENTREGA']}",
-                axis=1
-            )
-            
-            # Latitud y Longitud - vacíos por ahora
-            df_libro2['Latitud'] = None
-            df_libro2['Longitud'] = None
-            
-            # ID Referencia = DOCUMENTO ASOCIADO-NUMERO DE PEDIDO
-            df_libro2['ID Referencia'] = df_farmabogota.apply(
-                lambda row: f"{row['DOCUMENTO ASOCIADO']}-{row['NUMERO DE PEDIDO']}" 
-                          if pd.notna(row['NUMERO DE PEDIDO']) else row['DOCUMENTO ASOCIADO'],
-                axis=1
-            )
-            
-            # Notas - vacío
-            df_libro2['Notas'] = ''
-            
-            # Persona de Contacto - vacío
-            df_libro2['Persona de Contacto'] = None
-            
-            # Teléfono = CELULAR (limpiar .0 y validar)
-            df_libro2['Teléfono'] = df_farmabogota['CELULAR'].apply(
-                lambda x: str(int(float(x))) if pd.notna(x) and str(x).replace('0', '') != '' else None
-            )
-            
-            # Emails - vacío
-            df_libro2['Emails'] = None
+            reportar_etapa('transformacion', filas_entrada=len(df_farmabogota))
+            # Columnas de Libro2 según MAPEOS_LIBRO2['farmabogota']
+            df_libro2 = construir_libro2(df_farmabogota, 'farmabogota')
             
             print(f"✅ DataFrame Libro2 creado: {len(df_libro2)} registros")
             
             # Generar archivo Excel
+            reportar_etapa('escritura', filas_resultado=len(df_libro2))
             print("💾 Generando archivo Excel formato Libro2...")
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -2271,20 +3955,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 workbook = writer.book
                 worksheet = writer.sheets['Hoja1']
                 
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value and len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            excel_buffer.seek(0)
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+                ajustar_anchos_columnas(worksheet, df_libro2)
+            
+            excel_bytes = excel_buffer.getvalue()
             
             from datetime import datetime
             fecha_actual = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -2292,8 +3965,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo transformado exitosamente. {len(df_libro2)} registros en formato Libro2.',
-                'excel_data': excel_data,
-                'filename': f'Libro2_FarmaBogota_{fecha_actual}.xlsx'
+                'excel_bytes': excel_bytes,
+                'filename': f'Libro2_FarmaBogota_{fecha_actual}.xlsx',
+                'metadatos': {'lectura_farmabogota': df_farmabogota.attrs.get('lectura')}
             }
             
         except Exception as e:
@@ -2313,6 +3987,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         - Quita las columnas CEDULA e INTEGRADOS
         """
         try:
+            reportar_etapa('lectura')
             print(f"🔄 [DISTRIFARMA → LIBRO2] Procesando archivo: {distrifarma_filename}")
             
             # PASO 1: Detectar si el archivo tiene encabezados en la primera fila
@@ -2336,7 +4011,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 print("   📋 Detectado formato Carmen de Viboral (con encabezados)")
                 df_distrifarma = pd.read_excel(BytesIO(distrifarma_content), header=0)
                 print(f"✅ Archivo leído: {len(df_distrifarma)} filas")
-                print(f"   Columnas detectadas: {list(df_distrifarma.columns)}")
+                registrar_evento('debug', 'columnas', planilla='distrifarma', columnas=list(df_distrifarma.columns))
                 
                 # Normalizar nombres de columnas: convertir a formato estándar con primera letra en mayúscula
                 # Mapeo de variantes a nombres estándar
@@ -2384,9 +4059,11 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 print("   📋 Detectado formato antiguo (sin encabezados en primera fila)")
                 df_distrifarma = pd.read_excel(BytesIO(distrifarma_content), header=None)
                 print(f"✅ Archivo distrifarma leído: {len(df_distrifarma)} filas")
-                print(f"   Primeras 5 filas sin procesar:")
-                for idx in range(min(5, len(df_distrifarma))):
-                    print(f"      Fila {idx}: {df_distrifarma.iloc[idx].tolist()[:8]}")  # Solo primeras 8 columnas
+                if log_habilitado('debug'):
+                    # Primeras 5 filas sin procesar, solo las primeras 8 columnas
+                    muestra = df_distrifarma.iloc[:5, :8].astype(object)
+                    registrar_evento('debug', 'filas_iniciales', planilla='distrifarma',
+                                     filas=muestra.where(muestra.notna(), None).values.tolist())
                 
                 # Encontrar la fila donde empiezan los datos reales
                 fila_inicio_datos = 0
@@ -2435,136 +4112,28 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                     final_column_names = column_names
                 
                 df_distrifarma.columns = final_column_names
-                print(f"   Columnas asignadas: {list(df_distrifarma.columns)}")
-            
-            # Mostrar ejemplo de datos procesados
-            columnas_mostrar = [col for col in ['Persona de Contacto', 'CEDULA', 'ID Referencia', 'Teléfono'] 
-                               if col in df_distrifarma.columns]
-            if columnas_mostrar:
-                print(f"   Ejemplo de datos procesados:")
-                print(f"      {df_distrifarma[columnas_mostrar].head(3).to_string()}")
-            
-            # Crear función para extraer municipio del campo "Titulo de la Visita" original
-            def extraer_municipio(titulo_visita):
-                """
-                Extrae el municipio del campo titulo de la visita
-                Ejemplos:
-                - "La Estrella-Antioquia-Colombia" → "La Estrella"
-                - "La Estrella" → "La Estrella"
-                - "Medellín-Antioquia-Colombia" → "Medellín"
-                """
-                if pd.isna(titulo_visita):
-                    return ''
-                
-                titulo_str = str(titulo_visita).strip()
-                
-                # Si contiene guiones, tomar solo la primera parte (antes del primer guion)
-                if '-' in titulo_str:
-                    municipio = titulo_str.split('-')[0].strip()
-                else:
-                    municipio = titulo_str
-                
-                return municipio
-            
-            # Crear DataFrame con estructura de Libro2
-            df_libro2 = pd.DataFrame()
-            
-            # Nombre Vehículo - conservar valor original (solo limpiar espacios)
-            if 'Nombre Vehiculo' in df_distrifarma.columns:
-                df_libro2['Nombre Vehiculo'] = df_distrifarma['Nombre Vehiculo'].astype(str).str.strip()
-            else:
-                df_libro2['Nombre Vehiculo'] = ''
-            
-            # Título de la Visita
-            # Formato antiguo: Persona de Contacto - CEDULA
-            # Formato Carmen: Persona de Contacto - Teléfono (si no hay CEDULA)
-            if 'CEDULA' in df_distrifarma.columns and 'Persona de Contacto' in df_distrifarma.columns:
-                # Formato antiguo con CEDULA
-                df_libro2['Título de la Visita'] = df_distrifarma.apply(
-                    lambda row: f"{row['Persona de Contacto']} - {row['CEDULA']}" 
-                              if pd.notna(row['Persona de Contacto']) and pd.notna(row['CEDULA'])
-                              else (str(row['Persona de Contacto']) if pd.notna(row['Persona de Contacto']) else ''),
-                    axis=1
-                )
-            elif 'Persona de Contacto' in df_distrifarma.columns and 'Teléfono' in df_distrifarma.columns:
-                # Formato Carmen: usar Persona de Contacto - Teléfono
-                df_libro2['Título de la Visita'] = df_distrifarma.apply(
-                    lambda row: f"{row['Persona de Contacto']} - {row['Teléfono']}" 
-                              if pd.notna(row['Persona de Contacto']) and pd.notna(row['Teléfono'])
-                              else (str(row['Persona de Contacto']) if pd.notna(row['Persona de Contacto']) else ''),
-                    axis=1
-                )
-            else:
-                # Fallback: solo Persona de Contacto
-                df_libro2['Título de la Visita'] = df_distrifarma['Persona de Contacto'] if 'Persona de Contacto' in df_distrifarma.columns else ''
-            
-            # Dirección - agregar municipio al final
-            # Combinar dirección original + ", " + municipio extraído del titulo de la visita
-            if 'Titulo de la Visita' in df_distrifarma.columns:
-                df_libro2['Dirección'] = df_distrifarma.apply(
-                    lambda row: f"{row['Dirección']}, {extraer_municipio(row['Titulo de la Visita'])}" 
-                              if pd.notna(row['Dirección']) and extraer_municipio(row['Titulo de la Visita'])
-                              else str(row['Dirección']) if pd.notna(row['Dirección']) else '',
-                    axis=1
-                )
-            else:
-                df_libro2['Dirección'] = df_distrifarma['Dirección']
-            
-            # Latitud y Longitud - mantener si existen
-            df_libro2['Latitud'] = df_distrifarma['Latitud'] if 'Latitud' in df_distrifarma.columns else None
-            df_libro2['Longitud'] = df_distrifarma['Longitud'] if 'Longitud' in df_distrifarma.columns else None
-            
-            # ID Referencia - Lógica especial:
-            # Si el ID contiene letras Y números, usar solo el ID original (sin prefijo)
-            # Si el ID es solo números, agregar prefijo "Diswifarma-"
-            def procesar_id_referencia(id_ref):
-                if pd.isna(id_ref):
-                    return 'Diswifarma'
-                
-                id_str = str(id_ref).strip()
-                
-                # Verificar si contiene letras
-                tiene_letras = any(c.isalpha() for c in id_str)
-                tiene_numeros = any(c.isdigit() for c in id_str)
-                
-                # Si tiene letras y números, usar solo el ID original (sin prefijo)
-                if tiene_letras and tiene_numeros:
-                    return id_str
-                # Si es solo números, agregar prefijo
-                else:
-                    return f"Diswifarma-{id_str}"
-            
-            df_libro2['ID Referencia'] = df_distrifarma['ID Referencia'].apply(procesar_id_referencia)
-            
-            # Notas = INTEGRADOS si existe, sino usar campo Notas original, sino vacío
-            if 'INTEGRADOS' in df_distrifarma.columns:
-                df_libro2['Notas'] = df_distrifarma['INTEGRADOS']
-            elif 'Notas' in df_distrifarma.columns:
-                df_libro2['Notas'] = df_distrifarma['Notas']
-            else:
-                df_libro2['Notas'] = ''
-            
-            # Persona de Contacto - mantener original (sin CEDULA)
-            df_libro2['Persona de Contacto'] = df_distrifarma['Persona de Contacto']
+                registrar_evento('debug', 'columnas', planilla='distrifarma', columnas=list(df_distrifarma.columns))
             
-            # Teléfono - mantener si existe
-            df_libro2['Teléfono'] = df_distrifarma['Teléfono'] if 'Teléfono' in df_distrifarma.columns else None
+            if log_habilitado('debug'):
+                # Ejemplo de datos leídos
+                columnas_mostrar = [col for col in ['Persona de Contacto', 'CEDULA', 'ID Referencia', 'Teléfono']
+                                   if col in df_distrifarma.columns]
+                muestra = df_distrifarma[columnas_mostrar].head(3).astype(object)
+                registrar_evento('debug', 'ejemplo_datos', planilla='distrifarma',
+                                 filas=muestra.where(muestra.notna(), None).to_dict('records'))
             
-            # Emails - mantener si existe
-            df_libro2['Emails'] = df_distrifarma['Emails'] if 'Emails' in df_distrifarma.columns else None
-            
-            # NOTA: No incluimos las columnas CEDULA ni INTEGRADOS en el resultado final
+            reportar_etapa('transformacion', filas_entrada=len(df_distrifarma))
+            # Columnas de Libro2 según MAPEOS_LIBRO2['distrifarma'] (no incluye CEDULA ni INTEGRADOS)
+            df_libro2 = construir_libro2(df_distrifarma, 'distrifarma')
             
             print(f"✅ DataFrame Libro2 creado: {len(df_libro2)} registros")
-            print(f"   Columnas en Libro2: {list(df_libro2.columns)}")
-            print(f"   Ejemplo de datos procesados:")
-            for idx in range(min(3, len(df_libro2))):
-                print(f"      {idx+1}. Vehículo: {df_libro2.iloc[idx]['Nombre Vehiculo']}")
-                print(f"         Título: {df_libro2.iloc[idx]['Título de la Visita']}")
-                print(f"         Dirección: {df_libro2.iloc[idx]['Dirección']}")
-                print(f"         ID Ref: {df_libro2.iloc[idx]['ID Referencia']}")
+            if log_habilitado('debug'):
+                registrar_evento('debug', 'ejemplo_datos', planilla='libro2', filas=df_libro2[
+                    ['Nombre Vehiculo', 'Título de la Visita', 'Dirección', 'ID Referencia']
+                ].head(3).to_dict('records'))
             
             # Generar archivo Excel
+            reportar_etapa('escritura', filas_resultado=len(df_libro2))
             print("💾 Generando archivo Excel formato Libro2...")
             excel_buffer = BytesIO()
             with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
@@ -2574,20 +4143,9 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 workbook = writer.book
                 worksheet = writer.sheets['Hoja1']
                 
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value and len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = min(max_length + 2, 50)
-                    worksheet.column_dimensions[column_letter].width = adjusted_width
-            
-            excel_buffer.seek(0)
-            excel_data = base64.b64encode(excel_buffer.read()).decode('utf-8')
+                ajustar_anchos_columnas(worksheet, df_libro2)
+            
+            excel_bytes = excel_buffer.getvalue()
             
             from datetime import datetime
             fecha_actual = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -2595,7 +4153,7 @@ class MailboxHandler(SimpleHTTPRequestHandler):
             return {
                 'success': True,
                 'message': f'Archivo transformado exitosamente. {len(df_libro2)} registros en formato Libro2.',
-                'excel_data': excel_data,
+                'excel_bytes': excel_bytes,
                 'filename': f'Libro2_Distrifarma_{fecha_actual}.xlsx'
             }
             
@@ -2607,9 +4165,10 @@ class MailboxHandler(SimpleHTTPRequestHandler):
                 'details': 'Verifica que el archivo tenga las columnas correctas'
             }
     
-    def _extraer_ciudad_bogota(self, ciudad_ehlpharma, ciudad_ofimatic):
+    def _extraer_ciudades_bogota(self, df_ofimatic):
         """
-        Extrae y normaliza el nombre de la ciudad para Bogotá
+        Extrae y normaliza el nombre de la ciudad para Bogotá (city_ehlpharma, si no Destino de ofimatic).
+        Cada valor distinto se procesa una sola vez.
         
         Casos:
         - "Zipaquirá-Cundinamarca-Colombia" → "ZIPAQUIRA"
@@ -2618,41 +4177,237 @@ class MailboxHandler(SimpleHTTPRequestHandler):
         - "B-BOGOTA" → "BOGOTA"
         - "B-SOACHA" → "SOACHA"
         """
-        ciudad = ''
-        
-        # Prioridad 1: Ciudad de ehlpharma
-        if ciudad_ehlpharma and pd.notna(ciudad_ehlpharma):
-            ciudad_str = str(ciudad_ehlpharma).strip()
-            
+        def ciudad_ehlpharma(valor):
+            if not valor or pd.isna(valor):
+                return ''
+            ciudad_str = str(valor).strip()
             # Caso: "Zipaquirá-Cundinamarca-Colombia"
             if '-' in ciudad_str:
-                ciudad = ciudad_str.split('-')[0].strip()
-            # Caso: "BOGOTÁ. D.C." o "ZIPAQUIRÁ"
-            else:
-                # Eliminar ". D.C." si existe
-                ciudad = ciudad_str.replace('. D.C.', '').replace('.D.C.', '').strip()
+                return ciudad_str.split('-')[0].strip()
+            # Caso: "BOGOTÁ. D.C." o "ZIPAQUIRÁ": eliminar ". D.C." si existe
+            return ciudad_str.replace('. D.C.', '').replace('.D.C.', '').strip()
         
-        # Prioridad 2: Ciudad de ofimatic (formato "B-CIUDAD")
-        if not ciudad and ciudad_ofimatic and pd.notna(ciudad_ofimatic):
-            ciudad_str = str(ciudad_ofimatic).strip()
-            
+        def ciudad_ofimatic(valor):
+            if not valor or pd.isna(valor):
+                return ''
+            ciudad_str = str(valor).strip()
             # Caso: "B-BOGOTA", "B-SOACHA"
-            if ciudad_str.startswith('B-'):
-                ciudad = ciudad_str[2:].strip()  # Quitar "B-"
-            else:
-                ciudad = ciudad_str
+            return ciudad_str[2:].strip() if ciudad_str.startswith('B-') else ciudad_str
+        
+        vacia = pd.Series('', index=df_ofimatic.index)
+        # Prioridad 1: Ciudad de ehlpharma. Prioridad 2: Ciudad de ofimatic (formato "B-CIUDAD")
+        ciudad = aplicar_por_valor_unico(df_ofimatic.get('city_ehlpharma', vacia), ciudad_ehlpharma)
+        ciudad_destino = aplicar_por_valor_unico(df_ofimatic.get('Destino', vacia), ciudad_ofimatic)
+        ciudad = ciudad.where(ciudad != '', ciudad_destino)
         
         # Normalizar: sin tildes y en MAYÚSCULAS
-        return self._normalizar_ciudad(ciudad)
+        return normalizar_ciudades(ciudad)
     
-    def send_json_response(self, data):
-        json_data = json.dumps(data, ensure_ascii=False)
+    def send_result_response(self, data):
+        """Guarda el Excel generado y responde solo con el ID de descarga y las estadísticas"""
+        self.send_json_response(publicar_resultado(data))
+    
+    def send_result_file(self, resultado_id):
+        """Envía el Excel guardado por partes, sin cargarlo completo en memoria"""
+        import shutil
+        
+        resultado = obtener_resultado(resultado_id)
+        if resultado is None:
+            self.send_json_response({
+                'success': False,
+                'error': 'Resultado no encontrado',
+                'details': 'El archivo ya venció o el enlace no es válido. Procesa los archivos de nuevo.'
+            }, status=404)
+            return
+        
+        ruta, nombre_archivo = resultado
+        nombre_ascii = nombre_archivo.encode('ascii', 'replace').decode('ascii').replace('"', '')
+        with open(ruta, 'rb') as f:
+            self.send_response(200)
+            self.send_header('Content-type', TIPO_CONTENIDO_XLSX)
+            self.send_header('Content-length', os.fstat(f.fileno()).st_size)
+            self.send_header(
+                'Content-Disposition',
+                f'attachment; filename="{nombre_ascii}"; filename*=UTF-8\'\'{urllib.parse.quote(nombre_archivo)}'
+            )
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+    
+    def send_metrics(self):
+        """Responde con las métricas del proceso en el formato de texto de Prometheus"""
+        contenido = metricas.exposicion().encode('utf-8')
         self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-length', len(contenido))
+        self.end_headers()
+        self.wfile.write(contenido)
+    
+    def send_json_response(self, data, status=200):
+        json_data = json.dumps(data, ensure_ascii=False)
+        self.send_response(status)
         self.send_header('Content-type', 'application/json; charset=utf-8')
         self.send_header('Content-length', len(json_data.encode('utf-8')))
         self.end_headers()
         self.wfile.write(json_data.encode('utf-8'))
 
+# Modos de servidor: 'hilos' (un hilo por petición, con un máximo de workers),
+# 'procesos' (pre-fork: varios procesos aceptan del mismo socket) o 'simple' (un solo hilo)
+MODO_SERVIDOR_POR_DEFECTO = 'hilos'
+
+
+def _workers_por_defecto(modo):
+    """Número de workers si no se define NUM_WORKERS"""
+    cpus = os.cpu_count() or 1
+    return cpus if modo == 'procesos' else max(16, cpus * 4)
+
+
+# Conexiones aceptadas que esperan un hilo libre; con la espera llena se responde 503
+MAX_CONEXIONES_EN_ESPERA = int(os.environ.get('MAX_CONEXIONES_EN_ESPERA', 64))
+
+RESPUESTA_SERVIDOR_OCUPADO = json.dumps({
+    'success': False,
+    'error': 'El servidor está ocupado',
+    'details': 'Intenta de nuevo en unos segundos'
+}, ensure_ascii=False).encode('utf-8')
+
+
+class ServidorConHilos(HTTPServer):
+    """
+    Servidor HTTP que atiende cada petición en un hilo de un pool acotado.
+    Una transformación lenta ocupa un solo hilo y no bloquea la página ni otras subidas.
+    Como mucho hay workers + MAX_CONEXIONES_EN_ESPERA conexiones dentro del servidor.
+    """
+    def __init__(self, server_address, handler_class, workers, max_en_espera=MAX_CONEXIONES_EN_ESPERA):
+        from concurrent.futures import ThreadPoolExecutor
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='mailbox-worker')
+        self.cupos = threading.BoundedSemaphore(workers + max_en_espera)
+        super().__init__(server_address, handler_class)
+    
+    def process_request(self, request, client_address):
+        if not self.cupos.acquire(blocking=False):
+            self._rechazar(request)
+            return
+        try:
+            self.pool.submit(self._atender_peticion, request, client_address)
+        except RuntimeError:
+            # El pool ya se cerró (servidor terminando)
+            self.cupos.release()
+            self.shutdown_request(request)
+    
+    def _atender_peticion(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.cupos.release()
+    
+    def _rechazar(self, request):
+        """Responde 503 sin leer la petición y cierra la conexión"""
+        try:
+            request.settimeout(1)
+            request.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\n'
+                b'Content-Type: application/json; charset=utf-8\r\n'
+                b'Retry-After: 5\r\n'
+                b'Connection: close\r\n'
+                + f'Content-Length: {len(RESPUESTA_SERVIDOR_OCUPADO)}\r\n\r\n'.encode('ascii')
+                + RESPUESTA_SERVIDOR_OCUPADO
+            )
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+    
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _servir_con_procesos(httpd, workers):
+    """
+    Pre-fork: el proceso principal abre el socket y crea 'workers' procesos hijos que
+    aceptan conexiones del mismo socket. Cada hijo atiende una petición a la vez, así
+    un libro lento solo ocupa su propio proceso. Si un hijo termina se lanza otro.
+    """
+    import signal
+    global PROCESOS_CPU
+    
+    # Cada worker crea su propio pool de procesos: se reparte PROCESOS_CPU entre los workers
+    # para no lanzar workers × PROCESOS_CPU intérpretes (con menos de uno por worker, sin pool)
+    if PROCESOS_CPU > 0:
+        PROCESOS_CPU //= workers
+        print(f"⚙️ Pool de procesos por worker: {PROCESOS_CPU or 'desactivado'}")
+    
+    hijos = set()
+    
+    def lanzar_hijo():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            codigo = 0
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                print(f"❌ Error en worker {os.getpid()}: {e}")
+                codigo = 1
+            finally:
+                os._exit(codigo)
+        hijos.add(pid)
+    
+    def terminar(signum, frame):
+        raise KeyboardInterrupt
+    
+    signal.signal(signal.SIGTERM, terminar)
+    
+    for _ in range(workers):
+        lanzar_hijo()
+    print(f"👷 {workers} procesos worker iniciados: {sorted(hijos)}")
+    
+    try:
+        while True:
+            pid, estado = os.wait()
+            if pid in hijos:
+                hijos.discard(pid)
+                print(f"⚠️ Worker {pid} terminó (estado {estado}), iniciando uno nuevo")
+                lanzar_hijo()
+    finally:
+        for pid in hijos:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        httpd.server_close()
+
+
+def crear_servidor(server_address, modo=None, workers=None):
+    """
+    Crea el servidor HTTP según el modo configurado.
+    El modo y el número de workers se leen de MODO_SERVIDOR y NUM_WORKERS si no se indican.
+    Retorna (servidor, modo, workers)
+    """
+    modo = (modo or os.environ.get('MODO_SERVIDOR', MODO_SERVIDOR_POR_DEFECTO)).strip().lower()
+    if modo not in ('hilos', 'procesos', 'simple'):
+        print(f"⚠️ MODO_SERVIDOR desconocido '{modo}', usando '{MODO_SERVIDOR_POR_DEFECTO}'")
+        modo = MODO_SERVIDOR_POR_DEFECTO
+    if modo == 'procesos' and not hasattr(os, 'fork'):
+        print("⚠️ El modo 'procesos' requiere os.fork (no disponible en Windows), usando 'hilos'")
+        modo = 'hilos'
+    
+    workers = int(workers or os.environ.get('NUM_WORKERS', 0) or _workers_por_defecto(modo))
+    
+    if modo == 'hilos':
+        return ServidorConHilos(server_address, MailboxHandler, workers), modo, workers
+    if modo == 'simple':
+        return HTTPServer(server_address, MailboxHandler), modo, 1
+    return HTTPServer(server_address, MailboxHandler), modo, workers
+
+
 def start_server(port=8080):
     """Inicia el servidor web local o en Render"""
     try:
@@ -2666,11 +4421,15 @@ def start_server(port=8080):
         host = '0.0.0.0' if is_production else 'localhost'
         server_address = (host, port)
         
-        httpd = HTTPServer(server_address, MailboxHandler)
+        httpd, modo, workers = crear_servidor(server_address)
+        
+        # Construir la página principal antes de aceptar peticiones (en pre-fork la heredan los workers)
+        MailboxHandler.obtener_pagina_principal()
         
         print(f"🚀 Iniciando servidor en http://{host}:{port}")
         print("📂 Directorio actual:", os.getcwd())
         print(f"🌍 Modo: {'Producción (Render)' if is_production else 'Desarrollo (Local)'}")
+        print(f"🧵 Servidor: {modo} ({workers} workers)")
         print("✅ Servidor iniciado correctamente")
         
         # Solo abrir navegador en modo desarrollo (local)
@@ -2698,11 +4457,15 @@ def start_server(port=8080):
             print(f"🌐 Puerto: {port}")
             print("="*50 + "\n")
         
-        httpd.serve_forever()
+        if modo == 'procesos':
+            _servir_con_procesos(httpd, workers)
+        else:
+            httpd.serve_forever()
         
     except KeyboardInterrupt:
         print("\n🛑 Cerrando servidor...")
-        httpd.shutdown()
+        if modo != 'procesos':
+            httpd.shutdown()
         print("👋 ¡Hasta pronto!")
     except Exception as e:
         print(f"❌ Error al iniciar el servidor: {e}")
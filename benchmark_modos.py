@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Benchmark de extremo a extremo de cada modo de procesamiento
+
+Genera planillas sintéticas (generador_planillas.py) de varios tamaños y ejecuta con ellas:
+- cada MailboxHandler.process_* de app_web.py que procesa archivos (Normal, Bogotá, Filtrar Bogotá,
+  Medellín → Libro2 con madre xlsx y csv, Bogotá → Libro2, FarmaBogota, Distrifarma Carmen y antiguo)
+- los scripts independientes: app_relacionar_bogota.py y los process_* de app_desktop.py
+  (las apps Tkinter no se incluyen: abren una ventana al importarlas)
+
+Por cada etapa (lectura, normalizacion, relacion, transformacion, escritura, codificacion) mide el
+tiempo real, el tiempo de CPU y el pico de memoria. Las etapas de app_web salen de reportar_etapa;
+codificacion es publicar_resultado + el JSON de la respuesta. El tiempo es el mínimo de
+--repeticiones corridas; la memoria se mide aparte con tracemalloc (que hace más lento el código).
+
+Los resultados se guardan en JSON. Con --linea-base se comparan contra un JSON anterior y el
+script termina con error si alguna etapa empeora más que --umbral.
+
+Uso:
+    python benchmark_modos.py                                   # 1000 y 10000 filas, todos los casos
+    python benchmark_modos.py --tamanos 1000 100000 --casos medellin_libro2 bogota
+    python benchmark_modos.py --salida linea_base.json
+    python benchmark_modos.py --linea-base linea_base.json --umbral 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# La caché de planillas haría que todas las repeticiones después de la primera no lean nada
+os.environ.setdefault('MAX_BYTES_CACHE_PLANILLAS', '0')
+
+import pandas as pd
+
+import app_web
+from generador_planillas import generar_planillas
+
+
+ETAPAS = ['lectura', 'normalizacion', 'relacion', 'transformacion', 'escritura', 'codificacion']
+
+# Etapas más rápidas que esto en la línea base no se comparan (el ruido supera la diferencia)
+SEGUNDOS_MINIMOS_COMPARACION = 0.05
+MB_MINIMOS_COMPARACION = 5
+
+
+class MedidorEtapas:
+    """
+    Observador de reportar_etapa: cada llamada cierra la etapa anterior y abre la siguiente.
+    Acumula tiempo real, CPU y (si tracemalloc está activo) el pico de memoria de cada etapa.
+    """
+
+    def __init__(self):
+        self.etapas = {}
+        self._actual = None
+
+    def __call__(self, etapa, estadisticas=None):
+        self._cerrar()
+        self._actual = (etapa, time.perf_counter(), time.process_time())
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def _cerrar(self):
+        if self._actual is None:
+            return
+        etapa, inicio, inicio_cpu = self._actual
+        medida = self.etapas.setdefault(etapa, {'segundos': 0.0, 'cpu_segundos': 0.0})
+        medida['segundos'] += time.perf_counter() - inicio
+        medida['cpu_segundos'] += time.process_time() - inicio_cpu
+        if tracemalloc.is_tracing():
+            pico_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            medida['memoria_pico_mb'] = max(medida.get('memoria_pico_mb', 0), pico_mb)
+        self._actual = None
+
+    def terminar(self):
+        self._cerrar()
+        return self.etapas
+
+
+def _handler_web():
+    return app_web.MailboxHandler.__new__(app_web.MailboxHandler)
+
+
+def _codificar(medir, resultado):
+    """Etapa de codificación: lo que hace el servidor con el resultado antes de responder"""
+    medir('codificacion')
+    resultado = app_web.publicar_resultado(dict(resultado))
+    json.dumps(resultado, ensure_ascii=False)
+    return resultado
+
+
+def _caso_web(metodo, *planillas):
+    """Caso que llama a MailboxHandler.<metodo>(contenido, nombre, ...) con las planillas indicadas"""
+    def ejecutar(archivos, medir):
+        argumentos = []
+        for nombre in planillas:
+            argumentos += [archivos[nombre], nombre]
+        with app_web.observar_etapas(medir):
+            resultado = getattr(_handler_web(), metodo)(*argumentos)
+        if not resultado.get('success'):
+            raise RuntimeError(f"{metodo}: {resultado.get('error')} {resultado.get('details', '')}")
+        return _codificar(medir, resultado)
+    return ejecutar
+
+
+def _caso_relacionar_bogota(archivos, medir):
+    """app_relacionar_bogota.py: lee las planillas desde disco, relaciona y guarda con formato"""
+    import app_relacionar_bogota
+    with tempfile.TemporaryDirectory() as directorio:
+        rutas = {}
+        for nombre in ('ofimatic.xlsx', 'ehlpharma.xlsx'):
+            rutas[nombre] = os.path.join(directorio, nombre)
+            with open(rutas[nombre], 'wb') as f:
+                f.write(archivos[nombre])
+        medir('lectura')
+        df_inicial, filas_encabezado, _ = app_relacionar_bogota.leer_planilla_inicial(rutas['ofimatic.xlsx'])
+        df_pedidos = app_relacionar_bogota.leer_planilla_pedidos(rutas['ehlpharma.xlsx'])
+        medir('relacion')
+        df_actualizado = app_relacionar_bogota.relacionar_por_nit(df_inicial, df_pedidos)
+        medir('escritura')
+        app_relacionar_bogota.guardar_con_formato(df_actualizado, filas_encabezado,
+                                                  os.path.join(directorio, 'salida.xlsx'))
+    return {'success': True}
+
+
+def _caso_escritorio(metodo, *planillas):
+    """process_* de app_desktop.py: no reporta etapas, se mide completo (incluye el base64)"""
+    def ejecutar(archivos, medir):
+        import app_desktop
+        argumentos = []
+        for nombre in planillas:
+            argumentos += [archivos[nombre], nombre]
+        medir('total')
+        resultado = getattr(app_desktop.MailboxDesktopHandler, metodo)(None, *argumentos)
+        if not resultado.get('success'):
+            raise RuntimeError(f"{metodo}: {resultado.get('error')}")
+        return resultado
+    return ejecutar
+
+
+CASOS = {
+    'normal': _caso_web('process_data_files', 'madre.xlsx', 'ofimatic.xlsx'),
+    'normal_csv': _caso_web('process_data_files', 'madre.csv', 'ofimatic.xlsx'),
+    'bogota': _caso_web('process_bogota_files', 'ofimatic.xlsx', 'ehlpharma.xlsx'),
+    'filtrar_bogota': _caso_web('process_filtrar_bogota', 'ofimatic.xlsx'),
+    'medellin_libro2': _caso_web('process_medellin_libro2', 'madre.xlsx', 'ofimatic.xlsx'),
+    'medellin_libro2_csv': _caso_web('process_medellin_libro2', 'madre.csv', 'ofimatic.xlsx'),
+    'bogota_libro2': _caso_web('process_bogota_libro2', 'ehlpharma.xlsx', 'ofimatic.xlsx'),
+    'farmabogota': _caso_web('process_farmabogota_libro2', 'farmabogota.xlsx'),
+    'distrifarma_carmen': _caso_web('process_distrifarma_libro2', 'distrifarma_carmen.xlsx'),
+    'distrifarma_antiguo': _caso_web('process_distrifarma_libro2', 'distrifarma_antiguo.xlsx'),
+    'script_relacionar_bogota': _caso_relacionar_bogota,
+    'escritorio_medellin_libro2': _caso_escritorio('process_medellin_libro2', 'madre.xlsx', 'ofimatic.xlsx'),
+    'escritorio_bogota_libro2': _caso_escritorio('process_bogota_libro2', 'ehlpharma.xlsx', 'ofimatic.xlsx'),
+    'escritorio_distrifarma': _caso_escritorio('process_distrifarma_libro2', 'distrifarma_antiguo.xlsx'),
+}
+
+
+def medir_caso(caso, archivos, repeticiones, con_memoria):
+    """Corre el caso 'repeticiones' veces (mínimo por etapa) y una más con tracemalloc para la memoria"""
+    mejores = {}
+    for _ in range(repeticiones):
+        medidor = MedidorEtapas()
+        with contextlib.redirect_stdout(io.StringIO()):
+            CASOS[caso](archivos, medidor)
+        for etapa, medida in medidor.terminar().items():
+            mejor = mejores.setdefault(etapa, dict(medida))
+            mejor['segundos'] = min(mejor['segundos'], medida['segundos'])
+            mejor['cpu_segundos'] = min(mejor['cpu_segundos'], medida['cpu_segundos'])
+
+    if con_memoria:
+        medidor = MedidorEtapas()
+        tracemalloc.start()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                CASOS[caso](archivos, medidor)
+            etapas_memoria = medidor.terminar()
+        finally:
+            tracemalloc.stop()
+        for etapa, medida in etapas_memoria.items():
+            if etapa in mejores:
+                mejores[etapa]['memoria_pico_mb'] = round(medida['memoria_pico_mb'], 2)
+
+    orden = ETAPAS + ['total']
+    etapas = {etapa: {clave: round(valor, 4) for clave, valor in mejores[etapa].items()}
+              for etapa in sorted(mejores, key=lambda e: orden.index(e) if e in orden else len(orden))}
+    total = {
+        'segundos': round(sum(m['segundos'] for m in etapas.values()), 4),
+        'cpu_segundos': round(sum(m['cpu_segundos'] for m in etapas.values()), 4),
+    }
+    if con_memoria:
+        total['memoria_pico_mb'] = max(m.get('memoria_pico_mb', 0) for m in etapas.values())
+    return {'etapas': etapas, 'total': total}
+
+
+def comparar(resultados, linea_base, umbral):
+    """Retorna la lista de regresiones (etapas que empeoran más que el umbral frente a la línea base)"""
+    regresiones = []
+    for caso, por_tamano in resultados['resultados'].items():
+        for tamano, medida in por_tamano.items():
+            base = linea_base.get('resultados', {}).get(caso, {}).get(tamano)
+            if base is None:
+                continue
+            for etapa, actual in list(medida['etapas'].items()) + [('total', medida['total'])]:
+                anterior = base['total'] if etapa == 'total' else base['etapas'].get(etapa)
+                if anterior is None:
+                    continue
+                for metrica, minimo in (('segundos', SEGUNDOS_MINIMOS_COMPARACION),
+                                        ('cpu_segundos', SEGUNDOS_MINIMOS_COMPARACION),
+                                        ('memoria_pico_mb', MB_MINIMOS_COMPARACION)):
+                    if metrica not in actual or metrica not in anterior or anterior[metrica] < minimo:
+                        continue
+                    cambio = actual[metrica] / anterior[metrica] - 1
+                    if cambio > umbral:
+                        regresiones.append({'caso': caso, 'filas': tamano, 'etapa': etapa, 'metrica': metrica,
+                                            'antes': anterior[metrica], 'ahora': actual[metrica],
+                                            'cambio': round(cambio, 3)})
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark por etapa de cada modo de procesamiento')
+    parser.add_argument('--tamanos', type=int, nargs='+', default=[1000, 10000], help='Filas de las planillas')
+    parser.add_argument('--casos', nargs='+', default=list(CASOS), choices=list(CASOS))
+    parser.add_argument('--repeticiones', type=int, default=3, help='Corridas por caso (se toma el mínimo)')
+    parser.add_argument('--sin-memoria', action='store_true', help='No medir memoria (evita la corrida con tracemalloc)')
+    parser.add_argument('--salida', default='benchmark_modos.json', help='Archivo JSON de resultados')
+    parser.add_argument('--linea-base', help='JSON de una corrida anterior para comparar')
+    parser.add_argument('--umbral', type=float, default=0.2, help='Empeoramiento tolerado (0.2 = 20%%)')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    resultados = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'plataforma': platform.platform(),
+        'parametros': {'repeticiones': args.repeticiones, 'semilla': args.semilla, 'memoria': not args.sin_memoria},
+        'resultados': {caso: {} for caso in args.casos},
+    }
+
+    for filas in args.tamanos:
+        print(f"📄 Generando planillas sintéticas de {filas} filas...")
+        archivos = generar_planillas(filas, semilla=args.semilla)
+        for caso in args.casos:
+            medida = medir_caso(caso, archivos, args.repeticiones, not args.sin_memoria)
+            resultados['resultados'][caso][str(filas)] = medida
+            detalle = '  '.join(f"{etapa}={m['segundos']:.3f}s" for etapa, m in medida['etapas'].items())
+            memoria = f"  pico={medida['total']['memoria_pico_mb']:.0f}MB" if 'memoria_pico_mb' in medida['total'] else ''
+            print(f"   {caso:<27} {medida['total']['segundos']:>8.3f} s{memoria}  ({detalle})")
+
+    with open(args.salida, 'w', encoding='utf-8') as f:
+        json.dump(resultados, f, ensure_ascii=False, indent=2)
+    print(f"💾 Resultados guardados en {args.salida}")
+
+    if args.linea_base:
+        with open(args.linea_base, encoding='utf-8') as f:
+            linea_base = json.load(f)
+        regresiones = comparar(resultados, linea_base, args.umbral)
+        if regresiones:
+            print(f"❌ {len(regresiones)} regresiones frente a {args.linea_base} (umbral {args.umbral:.0%}):")
+            for r in regresiones:
+                print(f"   {r['caso']} ({r['filas']} filas) {r['etapa']}.{r['metrica']}: "
+                      f"{r['antes']} → {r['ahora']} (+{r['cambio']:.0%})")
+            sys.exit(1)
+        print(f"✅ Sin regresiones frente a {args.linea_base} (umbral {args.umbral:.0%})")
+
+
+if __name__ == '__main__':
+    main()
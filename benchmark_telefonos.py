@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la limpieza de teléfonos de app_web.py
+
+Compara la limpieza fila por fila (apply + limpiar_telefono con la cascada
+madre/ehlpharma → TEL1 → TEL2) contra la regla 'coalescer' de MAPEOS_LIBRO2,
+verifica que el resultado sea idéntico y muestra los tiempos.
+
+Uso:
+    python benchmark_telefonos.py               # 100000 filas
+    python benchmark_telefonos.py --filas 500000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+import app_web
+
+
+# Valores que aparecen en las planillas reales: texto, floats con .0, vacíos, ceros y basura
+VALORES = [
+    '3001234567', ' 3109876543 ', '3001234567.0', '000', '0', '', 'nan', 'None', '604 4445566',
+    '12.5', 'sin teléfono', np.nan, None, 3001234567, 3001234567.0, 0
+]
+
+
+def generar_columnas(filas, semilla=0):
+    rng = np.random.default_rng(semilla)
+    valores = np.array(VALORES, dtype=object)
+    # La mayoría son teléfonos válidos distintos, como en una planilla real
+    def columna():
+        datos = valores[rng.integers(0, len(valores), filas)]
+        validos = rng.random(filas) < 0.7
+        datos[validos] = (3000000000 + rng.integers(0, 99999999, validos.sum())).astype(str)
+        return pd.Series(datos)
+    return pd.DataFrame({'phonePatient_madre': columna(), 'TEL1': columna(), 'TEL2': columna()})
+
+
+def telefono_por_fila(row):
+    """Cascada original: teléfono de la madre → TEL1 → TEL2, limpiando cada valor"""
+    if row['phonePatient_madre']:
+        telefono = app_web.limpiar_telefono(row['phonePatient_madre'])
+        if telefono:
+            return telefono
+    tel1 = app_web.limpiar_telefono(row['TEL1']) if pd.notna(row['TEL1']) else None
+    tel2 = app_web.limpiar_telefono(row['TEL2']) if pd.notna(row['TEL2']) else None
+    return tel1 or tel2 or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de limpieza de teléfonos')
+    parser.add_argument('--filas', type=int, default=100000, help='Filas de la planilla sintética')
+    args = parser.parse_args()
+
+    print(f"📄 Generando {args.filas} filas sintéticas...")
+    df = generar_columnas(args.filas)
+    # Misma regla que usa Medellín → Libro2 para la columna Teléfono
+    _, telefonos = app_web.compilar_regla_libro2(app_web.MAPEOS_LIBRO2['medellin']['Teléfono'])
+
+    inicio = time.perf_counter()
+    por_fila = df.apply(telefono_por_fila, axis=1)
+    segundos_fila = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    vectorizado = telefonos(df)
+    segundos_vector = time.perf_counter() - inicio
+
+    iguales = por_fila.tolist() == vectorizado.tolist()
+    print(f"{'Método':<14} {'Tiempo (s)':>11}")
+    print(f"{'Fila por fila':<14} {segundos_fila:>11.3f}")
+    print(f"{'Vectorizado':<14} {segundos_vector:>11.3f}")
+    print(f"📈 {segundos_fila / segundos_vector:.1f}x más rápido")
+    print("✅ Resultados idénticos" if iguales else "❌ Los resultados son distintos")
+    if not iguales:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+"""
+Generador de planillas sintéticas para pruebas de carga y de escala de app_web.py
+
+No se pueden compartir datos reales de pacientes, así que este módulo produce planillas
+con la misma estructura que las reales (de 1.000 a 1.000.000 de filas):
+
+- madre.xlsx / madre.csv           Planilla madre Helpharma (Normal y Medellín → Libro2)
+- ofimatic.xlsx                    Ofimatic con 3 filas de preámbulo y encabezados en la fila 4 (header=3);
+                                   también sirve como planilla inicial de Bogotá y para Filtrar Bogotá
+- ehlpharma.xlsx                   Pedidos Ehlpharma (Bogotá y Bogotá → Libro2)
+- farmabogota.xlsx                 FarmaBogota → Libro2
+- distrifarma_carmen.xlsx          Distrifarma formato Carmen de Viboral (con encabezados)
+- distrifarma_antiguo.xlsx         Distrifarma formato antiguo (sin encabezados, filas vacías al inicio)
+
+Parámetros para recorrer todas las ramas del código de relación:
+- solapamiento:            fracción de los NITs de ofimatic que aparecen en la madre y en ehlpharma
+- tasa_duplicados:         fracción de filas que repiten un NIT ya usado (pacientes con varios pedidos)
+- tasa_nits_float:         fracción de NITs escritos como "123.0" (exportados desde una columna float)
+- tasa_ciudades_con_tilde: fracción de ciudades escritas con tildes ("Medellín", "Itagüí", "Bogotá")
+
+Uso:
+    python generador_planillas.py --filas 100000
+    python generador_planillas.py --filas 1000000 --solapamiento 0.5 --directorio /tmp/planillas
+    python generador_planillas.py --filas 5000 --planillas madre.csv ofimatic.xlsx
+
+Desde Python:
+    from generador_planillas import generar_planillas
+    archivos = generar_planillas(20000, solapamiento=0.9)   # {'madre.xlsx': bytes, ...}
+"""
+import argparse
+import os
+import time
+import zipfile
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+
+PLANILLAS = ['madre.xlsx', 'madre.csv', 'ofimatic.xlsx', 'ehlpharma.xlsx', 'farmabogota.xlsx',
+             'distrifarma_carmen.xlsx', 'distrifarma_antiguo.xlsx']
+
+# Excel admite 1.048.576 filas por hoja (incluye encabezados y preámbulo)
+MAX_FILAS = 1000000
+
+NOMBRES = ['JUAN', 'MARÍA', 'JOSÉ', 'LUZ', 'ANDRÉS', 'CARLOS', 'ANA', 'SOFÍA', 'JESÚS', 'NATALIA',
+           'LUIS', 'MÓNICA', 'HÉCTOR', 'PAOLA', 'RAMÓN', 'DIANA']
+APELLIDOS = ['GÓMEZ', 'RODRÍGUEZ', 'PÉREZ', 'MARTÍNEZ', 'LÓPEZ', 'GARCÍA', 'MUÑOZ', 'HERNÁNDEZ',
+             'RAMÍREZ', 'SÁNCHEZ', 'CASTAÑO', 'ZAPATA', 'OSORIO', 'QUIÑONES']
+MENSAJEROS = ['CARLOS MOTO 1', 'PEDRO RUTA SUR', 'YEISON NORTE', 'ANDRÉS CENTRO', 'MENSAJERO 5']
+TIPOS_VIA = ['CL', 'CR', 'AV', 'DG', 'TV', 'Calle', 'Carrera']
+
+# (con tilde, sin tilde): la madre y ehlpharma escriben las ciudades de las dos formas
+CIUDADES_ANTIOQUIA = [('Medellín', 'MEDELLIN'), ('Itagüí', 'ITAGUI'), ('Envigado', 'ENVIGADO'),
+                      ('Bello', 'BELLO'), ('Sabaneta', 'SABANETA'), ('La Estrella', 'LA ESTRELLA'),
+                      ('El Carmen de Viboral', 'EL CARMEN DE VIBORAL'), ('Rionegro', 'RIONEGRO')]
+CIUDADES_CUNDINAMARCA = [('Bogotá. D.C.', 'BOGOTA D.C.'), ('Soacha', 'SOACHA'), ('Chía', 'CHIA'),
+                         ('Zipaquirá-Cundinamarca-Colombia', 'ZIPAQUIRA-CUNDINAMARCA-COLOMBIA'),
+                         ('Facatativá', 'FACATATIVA'), ('Mosquera', 'MOSQUERA')]
+DESTINOS_OFIMATIC = ['B-BOGOTA', 'B-SOACHA', 'B-CHÍA', 'MEDELLIN', 'ITAGUI', 'ENVIGADO', None]
+
+
+def _elegir(rng, valores, filas):
+    """Valores elegidos al azar (admite listas con None y textos de distinto largo)"""
+    return np.array(valores, dtype=object)[rng.integers(0, len(valores), filas)]
+
+
+def _con_vacios(rng, valores, tasa):
+    """Deja vacía (None) una fracción de los valores"""
+    valores = np.asarray(valores, dtype=object).copy()
+    valores[rng.random(len(valores)) < tasa] = None
+    return valores
+
+
+def _nombres(rng, filas):
+    nombres = _elegir(rng, NOMBRES, filas)
+    apellidos = _elegir(rng, APELLIDOS, filas)
+    segundos = _elegir(rng, APELLIDOS, filas)
+    # Algunos con espacios de más, como llegan de ofimatic
+    relleno = _elegir(rng, [' ', ' ', ' ', '  '], filas)
+    return nombres + relleno + apellidos + ' ' + segundos
+
+
+def _direcciones(rng, filas):
+    via = _elegir(rng, TIPOS_VIA, filas)
+    numeros = rng.integers(1, 120, (3, filas)).astype(str).astype(object)
+    return via + ' ' + numeros[0] + ' # ' + numeros[1] + '-' + numeros[2]
+
+
+def _ciudades(rng, ciudades, filas, tasa_con_tilde):
+    """Ciudades escritas con tilde en una fracción de las filas y en mayúsculas sin tilde en el resto"""
+    indices = rng.integers(0, len(ciudades), filas)
+    con_tilde = np.array([c for c, _ in ciudades], dtype=object)[indices]
+    sin_tilde = np.array([s for _, s in ciudades], dtype=object)[indices]
+    return np.where(rng.random(filas) < tasa_con_tilde, con_tilde, sin_tilde)
+
+
+def _telefonos(rng, filas):
+    """Celulares válidos en su mayoría, más fijos, floats con .0, ceros y vacíos"""
+    celulares = 3000000000 + rng.integers(0, 509999999, filas)
+    valores = celulares.astype(object)
+    tipo = rng.random(filas)
+    valores[tipo > 0.70] = (6040000000 + rng.integers(0, 9999999, (tipo > 0.70).sum())).astype(object)
+    como_float = (tipo > 0.80) & (tipo <= 0.88)
+    valores[como_float] = [f'{valor}.0' for valor in celulares[como_float]]
+    valores[(tipo > 0.88) & (tipo <= 0.92)] = '000'
+    valores[(tipo > 0.92) & (tipo <= 0.94)] = 0
+    valores[tipo > 0.94] = None
+    return valores
+
+
+def _formato_nits(rng, nits, tasa_nits_float):
+    """
+    Escribe los NITs como en las planillas reales: números, texto y "123.0" (columna float exportada).
+    Algunos textos llevan espacios alrededor.
+    """
+    valores = nits.astype(object)
+    tipo = rng.random(len(nits))
+    como_float = tipo < tasa_nits_float
+    valores[como_float] = [f'{nit}.0' for nit in nits[como_float]]
+    como_texto = ~como_float & (tipo > 0.6)
+    valores[como_texto] = nits[como_texto].astype(str).astype(object)
+    con_espacios = ~como_float & (tipo > 0.95)
+    valores[con_espacios] = [f' {nit} ' for nit in nits[con_espacios]]
+    return valores
+
+
+def _repetir_algunos(rng, valores, tasa_duplicados):
+    """Reemplaza una fracción de los valores por otro valor ya presente (duplicados)"""
+    valores = valores.copy()
+    duplicados = np.flatnonzero(rng.random(len(valores)) < tasa_duplicados)
+    if len(duplicados):
+        valores[duplicados] = valores[rng.integers(0, len(valores), len(duplicados))]
+    return valores
+
+
+def _nits_relacionados(rng, nits_ofimatic, filas, solapamiento, tasa_duplicados, base_ajenos):
+    """
+    NITs de una planilla que se relaciona con ofimatic: contiene la fracción 'solapamiento' de los
+    NITs distintos de ofimatic y se completa hasta 'filas' con NITs que no están en ofimatic
+    """
+    distintos = np.unique(nits_ofimatic)
+    comunes = distintos[rng.random(len(distintos)) < solapamiento][:filas]
+    ajenos = base_ajenos + np.arange(filas - len(comunes), dtype=np.int64) * 13
+    nits = np.concatenate([comunes, ajenos])
+    return _repetir_algunos(rng, rng.permutation(nits), tasa_duplicados)
+
+
+def _primer_documento_por_nit(df_ofimatic):
+    """Nrodcto de la primera fila de ofimatic de cada NIT (para relacionar por DOCUMENTO ASOCIADO)"""
+    primeras = df_ofimatic.drop_duplicates('nit_numero')
+    return pd.Series(primeras['Nrodcto'].to_numpy(), index=primeras['nit_numero'].to_numpy())
+
+
+def generar_datos_ofimatic(rng, filas, tasa_duplicados=0.05, tasa_nits_float=0.1):
+    """Filas de la planilla ofimatic. La columna nit_numero (el NIT sin formato) no se escribe"""
+    nits = 10000000 + np.arange(filas, dtype=np.int64) * 37 + rng.integers(0, 37, filas)
+    nits = _repetir_algunos(rng, rng.permutation(nits), tasa_duplicados)
+    documentos = 100000 + np.arange(filas)
+    return pd.DataFrame({
+        'nit_numero': nits,
+        'nit': _formato_nits(rng, nits, tasa_nits_float),
+        'Nrodcto': np.char.add('BG-', documentos.astype(str)).astype(object),
+        'NomMensajero': _con_vacios(rng, _elegir(rng, MENSAJEROS + [' ' + MENSAJEROS[0] + ' '], filas), 0.05),
+        'NOMBRE': _con_vacios(rng, _nombres(rng, filas), 0.01),
+        'DIRECCION': _con_vacios(rng, _direcciones(rng, filas), 0.1),
+        'TEL1': _telefonos(rng, filas),
+        'TEL2': _con_vacios(rng, _telefonos(rng, filas), 0.6),
+        'TipoVta': _elegir(rng, ['CONTADO', 'CREDITO', 'EVENTO'], filas),
+        'Destino': _elegir(rng, DESTINOS_OFIMATIC, filas),
+        'Vendedor': _elegir(rng, ['V01', 'V02', 'V03'], filas),
+    })
+
+
+def generar_datos_madre(rng, df_ofimatic, filas, solapamiento=0.8, tasa_duplicados=0.05,
+                        tasa_nits_float=0.1, tasa_ciudades_con_tilde=0.5):
+    """Filas de la planilla madre Helpharma relacionadas con ofimatic"""
+    nits = _nits_relacionados(rng, df_ofimatic['nit_numero'].to_numpy(), filas, solapamiento,
+                              tasa_duplicados, base_ajenos=2000000000)
+    return pd.DataFrame({
+        'idOrder': _con_vacios(rng, 900000 + np.arange(filas), 0.03),
+        'authorizationNumber': np.char.add('AUT', np.arange(filas).astype(str)).astype(object),
+        'typeOrder': _elegir(rng, ['DOMICILIO', 'ENTREGA'], filas),
+        'identificationPatient': _formato_nits(rng, nits, tasa_nits_float),
+        'namePatient': _nombres(rng, filas),
+        'addressPatient': _con_vacios(rng, _direcciones(rng, filas), 0.05),
+        'mobilePhonePatient': _telefonos(rng, filas),
+        'cityNameOrder': _con_vacios(rng, _ciudades(rng, CIUDADES_ANTIOQUIA, filas, tasa_ciudades_con_tilde), 0.02),
+    })
+
+
+def generar_datos_ehlpharma(rng, df_ofimatic, filas, solapamiento=0.8, tasa_duplicados=0.05,
+                            tasa_nits_float=0.1, tasa_ciudades_con_tilde=0.5):
+    """
+    Filas de pedidos Ehlpharma relacionadas con ofimatic. En un 10% de las filas de NITs comunes
+    la IDENTIFICACION viene vacía y solo se puede relacionar por DOCUMENTO ASOCIADO
+    (el Nrodcto de ofimatic escrito como "bg123456" o "BG 123456")
+    """
+    nits = _nits_relacionados(rng, df_ofimatic['nit_numero'].to_numpy(), filas, solapamiento,
+                              tasa_duplicados, base_ajenos=3000000000)
+    documentos = _primer_documento_por_nit(df_ofimatic).reindex(nits).to_numpy(dtype=object)
+    comunes = pd.notna(documentos)
+    ajenos = ~comunes
+    documentos[ajenos] = [f'ZZ-{i}' for i in range(ajenos.sum())]
+    variante = rng.random(filas)
+    minusculas = comunes & (variante < 0.3)
+    documentos[minusculas] = [doc.lower().replace('-', '') for doc in documentos[minusculas]]
+    con_espacio = comunes & (variante > 0.8)
+    documentos[con_espacio] = [doc.replace('-', ' ') for doc in documentos[con_espacio]]
+
+    identificacion = _formato_nits(rng, nits, tasa_nits_float)
+    identificacion[comunes & (rng.random(filas) < 0.1)] = None
+    return pd.DataFrame({
+        'NUMERO DE PEDIDO': _con_vacios(rng, 70000000 + np.arange(filas), 0.03),
+        'IDENTIFICACION': identificacion,
+        'PACIENTE': _nombres(rng, filas),
+        'DOCUMENTO ASOCIADO': documentos,
+        'DIRECCION DE ENTREGA': _con_vacios(rng, _direcciones(rng, filas), 0.05),
+        'CIUDAD DE ENTREGA': _ciudades(rng, CIUDADES_CUNDINAMARCA, filas, tasa_ciudades_con_tilde),
+        'CELULAR': _telefonos(rng, filas),
+        'ESTADO': _elegir(rng, ['DESPACHADO', 'PENDIENTE'], filas),
+    })
+
+
+def generar_datos_farmabogota(rng, filas, tasa_ciudades_con_tilde=0.5):
+    """Filas de FarmaBogota (no se relacionan con otra planilla)"""
+    return pd.DataFrame({
+        'NUMERO DE PEDIDO': _con_vacios(rng, 50000000 + np.arange(filas), 0.03),
+        'IDENTIFICACION': 20000000 + rng.integers(0, 900000000, filas),
+        'PACIENTE': _nombres(rng, filas),
+        'DOCUMENTO ASOCIADO': np.char.add('FB-', (300000 + np.arange(filas)).astype(str)).astype(object),
+        'DIRECCION DE ENTREGA': _direcciones(rng, filas),
+        'CIUDAD DE ENTREGA': _ciudades(rng, CIUDADES_CUNDINAMARCA, filas, tasa_ciudades_con_tilde),
+        'CELULAR': _telefonos(rng, filas),
+        'FECHA': _elegir(rng, ['2025-01-15', '2025-01-16', '2025-01-17'], filas),
+    })
+
+
+def generar_datos_distrifarma(rng, filas, formato='carmen', tasa_ciudades_con_tilde=0.5):
+    """
+    Filas de Distrifarma. 'carmen': con encabezados (en minúsculas y sin tilde algunos, como llegan);
+    'antiguo': las 8 columnas sin encabezados
+    """
+    municipios = _ciudades(rng, CIUDADES_ANTIOQUIA, filas, tasa_ciudades_con_tilde)
+    sufijo = _elegir(rng, ['-Antioquia-Colombia', '-Antioquia', ''], filas)
+    # IDs solo numéricos (llevan prefijo Diswifarma-) y con letras y números (se dejan igual)
+    ids = np.where(rng.random(filas) < 0.7, (40000 + np.arange(filas)).astype(str),
+                   np.char.add('FE', (40000 + np.arange(filas)).astype(str))).astype(object)
+    datos = {
+        'Nombre Vehiculo': _elegir(rng, ['VH-01 ', 'VH-02', ' VH-03'], filas),
+        'Titulo de la Visita': _con_vacios(rng, municipios + sufijo, 0.02),
+        'Dirección': _con_vacios(rng, _direcciones(rng, filas), 0.02),
+        'ID Referencia': _con_vacios(rng, ids, 0.02),
+        'Persona de Contacto': _con_vacios(rng, _nombres(rng, filas), 0.02),
+    }
+    if formato == 'antiguo':
+        datos['CEDULA'] = _con_vacios(rng, (30000000 + rng.integers(0, 900000000, filas)).astype(object), 0.05)
+        datos['Teléfono'] = _telefonos(rng, filas)
+        datos['INTEGRADOS'] = _elegir(rng, ['SI', 'NO', None], filas)
+        return pd.DataFrame(datos)
+
+    datos['Teléfono'] = _telefonos(rng, filas)
+    datos['Latitud'] = None
+    datos['Longitud'] = None
+    datos['Notas'] = _elegir(rng, ['Entregar en portería', None], filas)
+    datos['Emails'] = None
+    datos['CUOTA'] = _elegir(rng, [0, 5000, None], filas)
+    df = pd.DataFrame(datos)
+    # Encabezados como llegan en el formato Carmen (se normalizan al leer)
+    return df.rename(columns={'Dirección': 'direccion', 'Teléfono': 'telefono', 'Titulo de la Visita': 'titulo de la visita'})
+
+
+# Partes fijas del paquete .xlsx (una sola hoja, sin estilos propios)
+_XLSX_PARTES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+        'officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Hoja1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+        'worksheet" Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+        'styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/styles.xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="1"><fill><patternFill patternType="none"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs><cellXfs count="1"><xf/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    ),
+}
+
+# Filas que se convierten a XML de una vez (acota la memoria con 1M de filas)
+FILAS_POR_BLOQUE_XLSX = 50000
+
+
+def _celdas_xml(valores):
+    """XML de las celdas de una columna: números como valor, textos en línea y vacíos como <c/>"""
+    celdas = []
+    for valor in valores:
+        if valor is None or valor != valor:
+            celdas.append('<c/>')
+        elif isinstance(valor, str):
+            celdas.append('<c t="inlineStr"><is><t xml:space="preserve">' + escape(valor) + '</t></is></c>')
+        else:
+            celdas.append('<c><v>' + str(valor) + '</v></c>')
+    return celdas
+
+
+def escribir_xlsx(df, preambulo=(), con_encabezados=True):
+    """
+    Escribe el DataFrame en un Excel de una hoja. El XML de la hoja se arma por columnas y por bloques
+    en lugar de celda por celda con openpyxl (que tarda minutos con un millón de filas)
+    """
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as paquete:
+        for nombre, contenido in _XLSX_PARTES.items():
+            paquete.writestr(nombre, contenido)
+        with paquete.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as hoja:
+            hoja.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                       b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            filas_iniciales = [list(fila) for fila in preambulo]
+            if con_encabezados:
+                filas_iniciales.append(list(df.columns))
+            for fila in filas_iniciales:
+                hoja.write(('<row>' + ''.join(_celdas_xml(fila)) + '</row>').encode('utf-8'))
+            columnas = [df[columna].to_numpy(dtype=object) for columna in df.columns]
+            for inicio in range(0, len(df), FILAS_POR_BLOQUE_XLSX):
+                bloque = [_celdas_xml(columna[inicio:inicio + FILAS_POR_BLOQUE_XLSX]) for columna in columnas]
+                hoja.write(''.join('<row>' + ''.join(celdas) + '</row>' for celdas in zip(*bloque)).encode('utf-8'))
+            hoja.write(b'</sheetData></worksheet>')
+    return buffer.getvalue()
+
+
+def escribir_csv(df, separador=';', codificacion='latin-1'):
+    """Escribe el DataFrame como CSV exportado desde Excel en Windows (punto y coma, Latin-1)"""
+    return df.to_csv(index=False, sep=separador).encode(codificacion, errors='replace')
+
+
+def generar_planillas(filas, solapamiento=0.8, tasa_duplicados=0.05, tasa_nits_float=0.1,
+                      tasa_ciudades_con_tilde=0.5, semilla=0, planillas=None):
+    """
+    Genera las planillas sintéticas indicadas (por defecto todas las de PLANILLAS) con 'filas' filas
+    cada una. Retorna {nombre de archivo: contenido en bytes}
+    """
+    if not 1 <= filas <= MAX_FILAS:
+        raise ValueError(f'filas debe estar entre 1 y {MAX_FILAS}')
+    for nombre, tasa in [('solapamiento', solapamiento), ('tasa_duplicados', tasa_duplicados),
+                         ('tasa_nits_float', tasa_nits_float), ('tasa_ciudades_con_tilde', tasa_ciudades_con_tilde)]:
+        if not 0 <= tasa <= 1:
+            raise ValueError(f'{nombre} debe estar entre 0 y 1')
+    planillas = planillas or PLANILLAS
+    desconocidas = [nombre for nombre in planillas if nombre not in PLANILLAS]
+    if desconocidas:
+        raise ValueError(f'Planillas desconocidas: {desconocidas}. Disponibles: {PLANILLAS}')
+
+    rng = np.random.default_rng(semilla)
+    archivos = {}
+    df_ofimatic = generar_datos_ofimatic(rng, filas, tasa_duplicados, tasa_nits_float)
+
+    if 'ofimatic.xlsx' in planillas:
+        preambulo = [['RELACIÓN DE DESPACHOS - OFIMATIC'], ['Generado: planilla sintética'], []]
+        archivos['ofimatic.xlsx'] = escribir_xlsx(df_ofimatic.drop(columns='nit_numero'), preambulo)
+
+    if 'madre.xlsx' in planillas or 'madre.csv' in planillas:
+        df_madre = generar_datos_madre(rng, df_ofimatic, filas, solapamiento, tasa_duplicados,
+                                       tasa_nits_float, tasa_ciudades_con_tilde)
+        if 'madre.xlsx' in planillas:
+            archivos['madre.xlsx'] = escribir_xlsx(df_madre, [['Reporte de órdenes Helpharma'], []])
+        if 'madre.csv' in planillas:
+            archivos['madre.csv'] = escribir_csv(df_madre)
+
+    if 'ehlpharma.xlsx' in planillas:
+        df_ehlpharma = generar_datos_ehlpharma(rng, df_ofimatic, filas, solapamiento, tasa_duplicados,
+                                               tasa_nits_float, tasa_ciudades_con_tilde)
+        archivos['ehlpharma.xlsx'] = escribir_xlsx(df_ehlpharma)
+
+    if 'farmabogota.xlsx' in planillas:
+        df_farmabogota = generar_datos_farmabogota(rng, filas, tasa_ciudades_con_tilde)
+        archivos['farmabogota.xlsx'] = escribir_xlsx(df_farmabogota, [['FARMABOGOTA - PEDIDOS'], []])
+
+    if 'distrifarma_carmen.xlsx' in planillas:
+        archivos['distrifarma_carmen.xlsx'] = escribir_xlsx(
+            generar_datos_distrifarma(rng, filas, 'carmen', tasa_ciudades_con_tilde)
+        )
+
+    if 'distrifarma_antiguo.xlsx' in planillas:
+        archivos['distrifarma_antiguo.xlsx'] = escribir_xlsx(
+            generar_datos_distrifarma(rng, filas, 'antiguo', tasa_ciudades_con_tilde),
+            preambulo=[[None], [None]], con_encabezados=False
+        )
+
+    return {nombre: archivos[nombre] for nombre in planillas}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generador de planillas sintéticas')
+    parser.add_argument('--filas', type=int, default=10000, help=f'Filas por planilla (1 a {MAX_FILAS})')
+    parser.add_argument('--directorio', default='planillas_sinteticas', help='Carpeta de salida')
+    parser.add_argument('--solapamiento', type=float, default=0.8,
+                        help='Fracción de NITs de ofimatic presentes en madre y ehlpharma')
+    parser.add_argument('--tasa-duplicados', type=float, default=0.05, help='Fracción de NITs repetidos')
+    parser.add_argument('--tasa-nits-float', type=float, default=0.1, help='Fracción de NITs escritos como "123.0"')
+    parser.add_argument('--tasa-ciudades-con-tilde', type=float, default=0.5,
+                        help='Fracción de ciudades escritas con tilde')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--planillas', nargs='+', default=PLANILLAS, choices=PLANILLAS)
+    args = parser.parse_args()
+
+    print(f"📄 Generando {len(args.planillas)} planillas de {args.filas} filas...")
+    inicio = time.perf_counter()
+    archivos = generar_planillas(
+        args.filas, solapamiento=args.solapamiento, tasa_duplicados=args.tasa_duplicados,
+        tasa_nits_float=args.tasa_nits_float, tasa_ciudades_con_tilde=args.tasa_ciudades_con_tilde,
+        semilla=args.semilla, planillas=args.planillas
+    )
+
+    os.makedirs(args.directorio, exist_ok=True)
+    for nombre, contenido in archivos.items():
+        with open(os.path.join(args.directorio, nombre), 'wb') as f:
+            f.write(contenido)
+        print(f"   💾 {nombre:<26} {len(contenido) / 1024 / 1024:>8.1f} MB")
+    print(f"✅ Planillas guardadas en {args.directorio} ({time.perf_counter() - inicio:.1f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga para app_web.py
+
+Levanta el servidor en cada modo (simple, hilos, procesos), envía varias subidas
+Medellín → Libro2 al mismo tiempo y mide el rendimiento y la latencia de la página
+principal mientras las subidas se procesan.
+
+Uso:
+    python prueba_carga.py                      # 8 subidas concurrentes, 20000 filas
+    python prueba_carga.py --concurrentes 8 --filas 50000 --modos hilos procesos
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+from generador_planillas import generar_planillas
+
+
+def generar_archivos(filas):
+    """Genera una planilla madre y una ofimatic sintéticas (en memoria)"""
+    archivos = generar_planillas(filas, planillas=['madre.xlsx', 'ofimatic.xlsx'])
+    return archivos['madre.xlsx'], archivos['ofimatic.xlsx']
+
+
+def codificar_multipart(campos, archivos):
+    """Codifica campos y archivos como multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    partes = []
+    for nombre, valor in campos.items():
+        partes.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{nombre}"\r\n\r\n{valor}\r\n'.encode('utf-8')
+        )
+    for nombre, (nombre_archivo, contenido) in archivos.items():
+        partes.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{nombre}"; filename="{nombre_archivo}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + contenido + b'\r\n'
+        )
+    partes.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(partes), f'multipart/form-data; boundary={boundary}'
+
+
+def puerto_libre():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def esperar_servidor(url, timeout=30):
+    limite = time.time() + timeout
+    while time.time() < limite:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def probar_modo(modo, workers, concurrentes, cuerpo, tipo_contenido):
+    """Ejecuta la prueba contra un servidor en el modo indicado y retorna las métricas"""
+    puerto = puerto_libre()
+    entorno = dict(os.environ, PORT=str(puerto), RENDER='true', MODO_SERVIDOR=modo)
+    if workers:
+        entorno['NUM_WORKERS'] = str(workers)
+
+    servidor = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_web.py')],
+        env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{puerto}'
+
+    try:
+        if not esperar_servidor(url + '/'):
+            raise RuntimeError(f'El servidor en modo {modo} no respondió')
+
+        latencias = []
+        errores = []
+
+        def subir():
+            inicio = time.perf_counter()
+            try:
+                peticion = urllib.request.Request(url + '/process', data=cuerpo, method='POST',
+                                                  headers={'Content-Type': tipo_contenido})
+                respuesta = urllib.request.urlopen(peticion, timeout=600).read()
+                if b'"success": true' not in respuesta:
+                    errores.append(respuesta[:200])
+            except Exception as e:
+                errores.append(str(e))
+            latencias.append(time.perf_counter() - inicio)
+
+        hilos = [threading.Thread(target=subir) for _ in range(concurrentes)]
+        inicio = time.perf_counter()
+        for hilo in hilos:
+            hilo.start()
+
+        # Medir cuánto tarda la página principal mientras se procesan las subidas
+        time.sleep(0.5)
+        inicio_pagina = time.perf_counter()
+        urllib.request.urlopen(url + '/', timeout=600).read()
+        latencia_pagina = time.perf_counter() - inicio_pagina
+
+        for hilo in hilos:
+            hilo.join()
+        total = time.perf_counter() - inicio
+
+        return {
+            'modo': modo,
+            'total': total,
+            'por_minuto': concurrentes / total * 60,
+            'latencia_media': sum(latencias) / len(latencias),
+            'latencia_pagina': latencia_pagina,
+            'errores': len(errores)
+        }
+    finally:
+        servidor.terminate()
+        servidor.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga de app_web.py')
+    parser.add_argument('--concurrentes', type=int, default=8, help='Subidas simultáneas')
+    parser.add_argument('--filas', type=int, default=20000, help='Filas de las planillas sintéticas')
+    parser.add_argument('--workers', type=int, default=0, help='NUM_WORKERS (0 = valor por defecto)')
+    parser.add_argument('--modos', nargs='+', default=['simple', 'hilos', 'procesos'])
+    args = parser.parse_args()
+
+    print(f"📄 Generando planillas sintéticas de {args.filas} filas...")
+    madre, ofimatic = generar_archivos(args.filas)
+    cuerpo, tipo_contenido = codificar_multipart(
+        {'modo': 'medellin_libro2'},
+        {'madre': ('madre.xlsx', madre), 'ofimatic': ('ofimatic.xlsx', ofimatic)}
+    )
+
+    resultados = []
+    for modo in args.modos:
+        print(f"🚀 Probando modo '{modo}' con {args.concurrentes} subidas concurrentes...")
+        resultados.append(probar_modo(modo, args.workers, args.concurrentes, cuerpo, tipo_contenido))
+
+    print()
+    print(f"{'Modo':<10} {'Total (s)':>10} {'Subidas/min':>12} {'Latencia (s)':>13} {'Página (s)':>11} {'Errores':>8}")
+    for r in resultados:
+        print(f"{r['modo']:<10} {r['total']:>10.2f} {r['por_minuto']:>12.1f} {r['latencia_media']:>13.2f} "
+              f"{r['latencia_pagina']:>11.2f} {r['errores']:>8}")
+
+    base = next((r for r in resultados if r['modo'] == 'simple'), None)
+    if base:
+        for r in resultados:
+            if r is not base:
+                print(f"📈 {r['modo']}: {base['total'] / r['total']:.1f}x el rendimiento del modo simple")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para comprobar que el motor de mapeo a Libro2 (MAPEOS_LIBRO2 / construir_libro2) produce
+lo mismo que la construcción fila por fila que reemplazó, para las cuatro fuentes
+(medellin, bogota, farmabogota y distrifarma) sobre planillas de generador_planillas.
+
+Las funciones libro2_anterior_* son la versión anterior copiada tal cual; se aplican al mismo
+DataFrame ya relacionado que recibe construir_libro2 dentro de cada process_*.
+"""
+import contextlib
+import io
+
+import numpy as np
+import pandas as pd
+
+import app_web
+from app_web import LIBRO2_COLUMNAS, construir_direcciones, construir_libro2, limpiar_telefonos
+from generador_planillas import generar_planillas
+
+FILAS = 2000
+
+
+# ----------------------------------------------------------------------------
+# Versión anterior (fila por fila) de cada fuente
+# ----------------------------------------------------------------------------
+
+def telefonos_anteriores(df_ofimatic, columna_prioritaria):
+    """Teléfono de la planilla relacionada, luego TEL1 y luego TEL2 de ofimatic"""
+    vacia = pd.Series(np.nan, index=df_ofimatic.index, dtype=object)
+    prioritario = df_ofimatic.get(columna_prioritaria, vacia)
+    con_valor = prioritario.to_numpy(dtype=object).astype(bool)
+    columnas = [
+        limpiar_telefonos(prioritario.where(con_valor, np.nan)),
+        limpiar_telefonos(df_ofimatic.get('TEL1', vacia)),
+        limpiar_telefonos(df_ofimatic.get('TEL2', vacia)),
+    ]
+    resultado = columnas[0].to_numpy(dtype=object).copy()
+    for columna in columnas[1:]:
+        faltantes = pd.isna(resultado)
+        resultado[faltantes] = columna.to_numpy(dtype=object)[faltantes]
+    return pd.Series(resultado, index=df_ofimatic.index)
+
+
+def libro2_anterior_medellin(df_ofimatic):
+    df_libro2 = pd.DataFrame(index=df_ofimatic.index)
+    nom_mensajero = df_ofimatic['NomMensajero'].astype(str).str.strip() if 'NomMensajero' in df_ofimatic.columns else ''
+    df_libro2['Nombre Vehiculo'] = nom_mensajero
+
+    def crear_titulo_visita(row):
+        nombre = str(row['NOMBRE']).strip() if pd.notna(row['NOMBRE']) else ''
+        nombre = ' '.join(nombre.split())
+        nit = row['nit']
+        return f"{nombre} - {nit}" if nombre and nit else (nombre if nombre else nit)
+
+    df_libro2['Título de la Visita'] = df_ofimatic.apply(crear_titulo_visita, axis=1)
+    df_libro2['Dirección'] = construir_direcciones(df_ofimatic['direccion_base'],
+                                                   df_ofimatic['ciudad_normalizada'], 'Antioquia')
+    df_libro2['Latitud'] = None
+    df_libro2['Longitud'] = None
+    df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
+    df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
+    df_libro2['Persona de Contacto'] = None
+    df_libro2['Teléfono'] = telefonos_anteriores(df_ofimatic, 'phonePatient_madre')
+    df_libro2['Emails'] = None
+    return df_libro2
+
+
+def libro2_anterior_bogota(df_ofimatic):
+    df_libro2 = pd.DataFrame(index=df_ofimatic.index)
+    df_libro2['Nombre Vehiculo'] = df_ofimatic['NomMensajero'] if 'NomMensajero' in df_ofimatic.columns else ''
+    df_libro2['Título de la Visita'] = df_ofimatic['NOMBRE'] if 'NOMBRE' in df_ofimatic.columns else ''
+    df_libro2['Dirección'] = construir_direcciones(df_ofimatic['direccion_base'],
+                                                   df_ofimatic['ciudad_normalizada'], 'Cundinamarca')
+    df_libro2['Latitud'] = None
+    df_libro2['Longitud'] = None
+    df_libro2['ID Referencia'] = df_ofimatic['Nrodcto_relacionado']
+    df_libro2['Notas'] = df_ofimatic['TipoVta'] if 'TipoVta' in df_ofimatic.columns else ''
+    df_libro2['Persona de Contacto'] = None
+    df_libro2['Teléfono'] = telefonos_anteriores(df_ofimatic, 'phone_ehlpharma')
+    df_libro2['Emails'] = None
+    return df_libro2
+
+
+def libro2_anterior_farmabogota(df_farmabogota):
+    df_libro2 = pd.DataFrame(index=df_farmabogota.index)
+    df_libro2['Nombre Vehiculo'] = ''
+    df_libro2['Título de la Visita'] = df_farmabogota['PACIENTE']
+    df_libro2['Dirección'] = df_farmabogota.apply(
+        lambda row: f"{row['DIRECCION DE ENTREGA']}, {row['CIUDAD DE ENTREGA']}",
+        axis=1
+    )
+    df_libro2['Latitud'] = None
+    df_libro2['Longitud'] = None
+    df_libro2['ID Referencia'] = df_farmabogota.apply(
+        lambda row: f"{row['DOCUMENTO ASOCIADO']}-{row['NUMERO DE PEDIDO']}"
+                  if pd.notna(row['NUMERO DE PEDIDO']) else row['DOCUMENTO ASOCIADO'],
+        axis=1
+    )
+    df_libro2['Notas'] = ''
+    df_libro2['Persona de Contacto'] = None
+    df_libro2['Teléfono'] = limpiar_telefonos(df_farmabogota['CELULAR'])
+    df_libro2['Emails'] = None
+    return df_libro2
+
+
+def libro2_anterior_distrifarma(df_distrifarma):
+    def extraer_municipio(titulo_visita):
+        if pd.isna(titulo_visita):
+            return ''
+        titulo_str = str(titulo_visita).strip()
+        return titulo_str.split('-')[0].strip() if '-' in titulo_str else titulo_str
+
+    def procesar_id_referencia(id_ref):
+        if pd.isna(id_ref):
+            return 'Diswifarma'
+        id_str = str(id_ref).strip()
+        if any(c.isalpha() for c in id_str) and any(c.isdigit() for c in id_str):
+            return id_str
+        return f"Diswifarma-{id_str}"
+
+    columnas = df_distrifarma.columns
+    df_libro2 = pd.DataFrame(index=df_distrifarma.index)
+    df_libro2['Nombre Vehiculo'] = (df_distrifarma['Nombre Vehiculo'].astype(str).str.strip()
+                                    if 'Nombre Vehiculo' in columnas else '')
+
+    if 'CEDULA' in columnas and 'Persona de Contacto' in columnas:
+        segunda = 'CEDULA'
+    elif 'Persona de Contacto' in columnas and 'Teléfono' in columnas:
+        segunda = 'Teléfono'
+    else:
+        segunda = None
+    if segunda is not None:
+        df_libro2['Título de la Visita'] = df_distrifarma.apply(
+            lambda row: f"{row['Persona de Contacto']} - {row[segunda]}"
+                      if pd.notna(row['Persona de Contacto']) and pd.notna(row[segunda])
+                      else (str(row['Persona de Contacto']) if pd.notna(row['Persona de Contacto']) else ''),
+            axis=1
+        )
+    else:
+        df_libro2['Título de la Visita'] = df_distrifarma['Persona de Contacto'] if 'Persona de Contacto' in columnas else ''
+
+    if 'Titulo de la Visita' in columnas:
+        df_libro2['Dirección'] = df_distrifarma.apply(
+            lambda row: f"{row['Dirección']}, {extraer_municipio(row['Titulo de la Visita'])}"
+                      if pd.notna(row['Dirección']) and extraer_municipio(row['Titulo de la Visita'])
+                      else str(row['Dirección']) if pd.notna(row['Dirección']) else '',
+            axis=1
+        )
+    else:
+        df_libro2['Dirección'] = df_distrifarma['Dirección']
+
+    df_libro2['Latitud'] = df_distrifarma['Latitud'] if 'Latitud' in columnas else None
+    df_libro2['Longitud'] = df_distrifarma['Longitud'] if 'Longitud' in columnas else None
+    df_libro2['ID Referencia'] = df_distrifarma['ID Referencia'].apply(procesar_id_referencia)
+    if 'INTEGRADOS' in columnas:
+        df_libro2['Notas'] = df_distrifarma['INTEGRADOS']
+    elif 'Notas' in columnas:
+        df_libro2['Notas'] = df_distrifarma['Notas']
+    else:
+        df_libro2['Notas'] = ''
+    df_libro2['Persona de Contacto'] = df_distrifarma['Persona de Contacto']
+    df_libro2['Teléfono'] = df_distrifarma['Teléfono'] if 'Teléfono' in columnas else None
+    df_libro2['Emails'] = df_distrifarma['Emails'] if 'Emails' in columnas else None
+    return df_libro2
+
+
+LIBRO2_ANTERIOR = {
+    'medellin': libro2_anterior_medellin,
+    'bogota': libro2_anterior_bogota,
+    'farmabogota': libro2_anterior_farmabogota,
+    'distrifarma': libro2_anterior_distrifarma,
+}
+
+
+# ----------------------------------------------------------------------------
+# Comparación
+# ----------------------------------------------------------------------------
+
+def iguales(a, b):
+    """Mismo valor y tipo; None y NaN cuentan como iguales"""
+    if isinstance(a, str) or isinstance(b, str):
+        return a == b
+    if pd.isna(a) and pd.isna(b):
+        return True
+    return type(a) is type(b) and a == b
+
+
+def diferencias(anterior, nuevo):
+    """[(columna, fila, valor anterior, valor nuevo)] de las celdas distintas"""
+    assert list(nuevo.columns) == LIBRO2_COLUMNAS, list(nuevo.columns)
+    assert len(anterior) == len(nuevo)
+    distintas = []
+    for columna in LIBRO2_COLUMNAS:
+        for fila, (a, b) in enumerate(zip(anterior[columna].tolist(), nuevo[columna].tolist())):
+            if not iguales(a, b):
+                distintas.append((columna, fila, a, b))
+    return distintas
+
+
+def libro2_de_cada_procesamiento(procesar):
+    """
+    Ejecuta procesar(handler) y retorna [(fuente, DataFrame relacionado, Libro2 nuevo)]
+    de cada llamada a construir_libro2
+    """
+    llamadas = []
+
+    def construir_y_registrar(df, mapeo):
+        df_libro2 = construir_libro2(df, mapeo)
+        llamadas.append((mapeo, df.copy(), df_libro2))
+        return df_libro2
+
+    handler = app_web.MailboxHandler.__new__(app_web.MailboxHandler)
+    app_web.construir_libro2 = construir_y_registrar
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            resultado = procesar(handler)
+    finally:
+        app_web.construir_libro2 = construir_libro2
+    assert resultado['success'], resultado.get('error')
+    return llamadas
+
+
+def test_libro2_igual_a_la_version_anterior():
+    archivos = generar_planillas(FILAS)
+    procesamientos = [
+        lambda h: h.process_medellin_libro2(archivos['madre.xlsx'], 'madre.xlsx',
+                                            archivos['ofimatic.xlsx'], 'ofimatic.xlsx'),
+        lambda h: h.process_medellin_libro2(archivos['madre.csv'], 'madre.csv',
+                                            archivos['ofimatic.xlsx'], 'ofimatic.xlsx'),
+        lambda h: h.process_bogota_libro2(archivos['ehlpharma.xlsx'], 'ehlpharma.xlsx',
+                                          archivos['ofimatic.xlsx'], 'ofimatic.xlsx'),
+        lambda h: h.process_farmabogota_libro2(archivos['farmabogota.xlsx'], 'farmabogota.xlsx'),
+        lambda h: h.process_distrifarma_libro2(archivos['distrifarma_carmen.xlsx'], 'distrifarma_carmen.xlsx'),
+        lambda h: h.process_distrifarma_libro2(archivos['distrifarma_antiguo.xlsx'], 'distrifarma_antiguo.xlsx'),
+    ]
+
+    fuentes = set()
+    for procesar in procesamientos:
+        for fuente, df, df_libro2 in libro2_de_cada_procesamiento(procesar):
+            fuentes.add(fuente)
+            anterior = LIBRO2_ANTERIOR[fuente](df)
+            distintas = diferencias(anterior, df_libro2)
+            assert not distintas, f"{fuente}: {len(distintas)} celdas distintas, p. ej. {distintas[:5]}"
+    assert fuentes == set(LIBRO2_ANTERIOR), fuentes
+
+
+def test_farmabogota_sin_documento_queda_vacio():
+    # Cambio documentado del motor: sin DOCUMENTO ASOCIADO el ID queda vacío (antes 'nan-<pedido>')
+    df = pd.DataFrame({
+        'PACIENTE': ['ANA', 'LUIS'],
+        'DIRECCION DE ENTREGA': ['CL 1', 'CR 2'],
+        'CIUDAD DE ENTREGA': ['Soacha', 'Chía'],
+        'DOCUMENTO ASOCIADO': [np.nan, 'FB-1'],
+        'NUMERO DE PEDIDO': [50000001, 50000002],
+        'CELULAR': [3001234567, None],
+    })
+    ids = construir_libro2(df, 'farmabogota')['ID Referencia'].tolist()
+    assert pd.isna(ids[0]), ids
+    assert ids[1] == 'FB-1-50000002', ids
+
+
+if __name__ == "__main__":
+    print("="*60)
+    print("PRUEBA DEL MOTOR DE MAPEO A LIBRO2")
+    print("="*60)
+    for prueba in (test_libro2_igual_a_la_version_anterior, test_farmabogota_sin_documento_queda_vacio):
+        prueba()
+        print(f"✅ {prueba.__name__}")
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para probar el modo Normal (process_data_files) con identificadores vacíos:
+un NIT vacío en la madre o en el ofimatic no debe volver float el resto de la columna
+("101" frente a "101.0") y dejar sin relacionar las filas que sí tienen NIT.
+"""
+import contextlib
+import io
+from io import BytesIO
+
+import pandas as pd
+
+import app_web
+
+
+def contenido_xlsx(df):
+    buffer = BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def procesar_normal(madre, nombre_madre, ofimatic, nombre_ofimatic):
+    handler = app_web.MailboxHandler.__new__(app_web.MailboxHandler)
+    with contextlib.redirect_stdout(io.StringIO()):
+        resultado = handler.process_data_files(madre, nombre_madre, ofimatic, nombre_ofimatic)
+    assert resultado['success'], resultado.get('error')
+    return pd.read_excel(BytesIO(resultado['excel_bytes']))
+
+
+def test_nits_vacios_en_ambas_planillas():
+    df_madre = pd.DataFrame({'identificationPatient': [101, None, 103], 'idOrder': [9, 7, 8]})
+    df_ofimatic = pd.DataFrame({'nit': [101, None, 103], 'Nrodcto': ['A', 'B', 'C'], 'NOMBRE': ['x', 'y', 'z']})
+
+    formatos = [
+        (contenido_xlsx(df_madre), 'madre.xlsx', contenido_xlsx(df_ofimatic), 'ofimatic.xlsx'),
+        (df_madre.to_csv(index=False).encode(), 'madre.csv', df_ofimatic.to_csv(index=False).encode(), 'ofimatic.csv'),
+    ]
+    for archivos in formatos:
+        resultado = procesar_normal(*archivos)
+        assert resultado['Nrodcto'].tolist() == ['A-9', 'B-7', 'C-8'], (archivos[1], resultado['Nrodcto'].tolist())
+
+
+def test_nit_vacio_solo_en_ofimatic():
+    df_madre = pd.DataFrame({'identificationPatient': [101, 102, 103], 'idOrder': [9, 7, 8]})
+    df_ofimatic = pd.DataFrame({'nit': [101, None, 103], 'Nrodcto': ['A', 'B', 'C']})
+
+    resultado = procesar_normal(contenido_xlsx(df_madre), 'madre.xlsx', contenido_xlsx(df_ofimatic), 'ofimatic.xlsx')
+    assert resultado['Nrodcto'].tolist() == ['A-9', 'B-', 'C-8'], resultado['Nrodcto'].tolist()
+
+
+if __name__ == "__main__":
+    print("="*60)
+    print("PRUEBA DEL MODO NORMAL CON NITs VACÍOS")
+    print("="*60)
+    for prueba in (test_nits_vacios_en_ambas_planillas, test_nit_vacio_solo_en_ofimatic):
+        prueba()
+        print(f"✅ {prueba.__name__}")
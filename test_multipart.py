@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para probar la lectura de formularios multipart por bloques (leer_formulario_multipart)
+"""
+import io
+
+import app_web
+from app_web import leer_formulario_multipart
+
+
+class LectorPorBloques(io.BytesIO):
+    """rfile que entrega como máximo `tamano` bytes por lectura"""
+    def __init__(self, datos, tamano):
+        super().__init__(datos)
+        self.tamano = tamano
+
+    def read(self, n=-1):
+        return super().read(self.tamano if n < 0 else min(n, self.tamano))
+
+
+def armar_cuerpo(boundary, partes):
+    """partes: lista de (nombre, nombre_archivo o None, contenido en bytes)"""
+    cuerpo = b'preambulo ignorado\r\n'
+    for nombre, nombre_archivo, contenido in partes:
+        disposicion = f'form-data; name="{nombre}"'
+        if nombre_archivo is not None:
+            disposicion += f'; filename="{nombre_archivo}"'
+        cuerpo += b'--' + boundary + b'\r\n'
+        cuerpo += f'Content-Disposition: {disposicion}\r\n\r\n'.encode('utf-8')
+        cuerpo += contenido + b'\r\n'
+    return cuerpo + b'--' + boundary + b'--\r\nepilogo'
+
+
+def encabezados(content_type, cuerpo):
+    return {'Content-Type': content_type, 'Content-Length': str(len(cuerpo))}
+
+
+def test_boundary_partido_entre_lecturas():
+    boundary = b'----LimiteDePrueba7MA4YWxk'
+    # El contenido casi repite el delimitador para forzar coincidencias parciales
+    madre = b'inicio\r\n--' + boundary[:-1] + b'x\r\n' + bytes(range(256)) * 40 + b'\r\n-'
+    ofimatic = b'\r\n--' + boundary[:10]
+    cuerpo = armar_cuerpo(boundary, [
+        ('modo', None, 'medellín_libro2'.encode('utf-8')),
+        ('madre', 'madre.xlsx', madre),
+        ('ofimatic', 'ofimatic.xlsx', ofimatic),
+    ])
+    tipo = 'multipart/form-data; boundary=' + boundary.decode()
+
+    for tamano in (1, 3, 7, len(boundary) + 1, 4096):
+        rfile = LectorPorBloques(cuerpo, tamano)
+        form = leer_formulario_multipart(rfile, encabezados(tipo, cuerpo))
+        try:
+            assert form['modo'].value == 'medellín_libro2'
+            assert form['madre'].filename == 'madre.xlsx'
+            assert form['madre'].file.read() == madre
+            assert form['ofimatic'].value == ofimatic
+            # El epílogo también se consume
+            assert rfile.read() == b''
+        finally:
+            app_web.cerrar_formulario(form)
+        assert all(campo.file.closed for campo in form.values())
+
+
+def test_boundary_entre_comillas():
+    boundary = b'limite con espacios:y=signos'
+    cuerpo = armar_cuerpo(boundary, [('file', 'datos.xlsx', b'contenido')])
+    tipo = 'multipart/form-data; charset=utf-8; boundary="' + boundary.decode() + '"'
+
+    form = leer_formulario_multipart(LectorPorBloques(cuerpo, 5), encabezados(tipo, cuerpo))
+    try:
+        assert form['file'].value == b'contenido'
+    finally:
+        app_web.cerrar_formulario(form)
+
+
+def test_cuerpo_truncado_cierra_las_partes():
+    boundary = b'LimiteTruncado'
+    cuerpo = armar_cuerpo(boundary, [
+        ('madre', 'madre.xlsx', b'a' * 5000),
+        ('ofimatic', 'ofimatic.xlsx', b'b' * 5000),
+    ])
+    tipo = 'multipart/form-data; boundary=' + boundary.decode()
+    # Se corta dentro de la segunda parte, pero se anuncia el largo completo
+    truncado = cuerpo[:cuerpo.index(b'b' * 100) + 100]
+
+    archivos_creados = []
+    spooled_original = app_web.tempfile.SpooledTemporaryFile
+
+    def spooled_registrado(*args, **kwargs):
+        archivo = spooled_original(*args, **kwargs)
+        archivos_creados.append(archivo)
+        return archivo
+
+    app_web.tempfile.SpooledTemporaryFile = spooled_registrado
+    try:
+        try:
+            leer_formulario_multipart(LectorPorBloques(truncado, 512), encabezados(tipo, cuerpo))
+        except ValueError as e:
+            assert 'incompleto' in str(e)
+        else:
+            raise AssertionError('Se esperaba ValueError con un cuerpo truncado')
+    finally:
+        app_web.tempfile.SpooledTemporaryFile = spooled_original
+
+    assert len(archivos_creados) == 2
+    assert all(archivo.closed for archivo in archivos_creados)
+
+
+if __name__ == "__main__":
+    print("="*60)
+    print("PRUEBA DE LECTURA DE FORMULARIOS MULTIPART")
+    print("="*60)
+    for prueba in (test_boundary_partido_entre_lecturas, test_boundary_entre_comillas,
+                   test_cuerpo_truncado_cierra_las_partes):
+        prueba()
+        print(f"✅ {prueba.__name__}")
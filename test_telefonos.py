@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Script para probar la limpieza de teléfonos (limpiar_telefono / limpiar_telefonos)
+y el Teléfono de FarmaBogotá → Libro2
+"""
+import numpy as np
+import pandas as pd
+
+from app_web import construir_libro2, limpiar_telefono, limpiar_telefonos
+
+
+def test_limpiar_telefonos_igual_a_limpiar_telefono():
+    valores = [0.0, 3001234567.0, '0', None, 0, np.nan, ' 3109876543 ', '000', 'nan', '310-555', 1.5, 3001234567]
+    for serie in (pd.Series(valores, dtype=object), pd.Series([0.0, 3001234567.0, np.nan, 12.0])):
+        esperado = [limpiar_telefono(valor) for valor in serie]
+        assert limpiar_telefonos(serie).tolist() == esperado, (serie.tolist(), esperado)
+
+
+def test_farmabogota_celular_solo_ceros_queda_vacio():
+    # Cambio de comportamiento: antes el float 0.0 de CELULAR salía como "0"
+    # (se revisaba "0.0" en lugar de "0"); ahora cualquier número de solo ceros queda vacío
+    df = pd.DataFrame({
+        'PACIENTE': ['ANA', 'LUIS', 'SOFÍA', 'JUAN', 'LUZ'],
+        'DIRECCION DE ENTREGA': ['CL 1'] * 5,
+        'CIUDAD DE ENTREGA': ['Soacha'] * 5,
+        'DOCUMENTO ASOCIADO': ['FB-1', 'FB-2', 'FB-3', 'FB-4', 'FB-5'],
+        'NUMERO DE PEDIDO': ['1', '2', '3', '4', '5'],
+        'CELULAR': pd.Series([0.0, 3001234567.0, '0', None, 0], dtype=object),
+    })
+    telefonos = construir_libro2(df, 'farmabogota')['Teléfono'].tolist()
+    assert telefonos == [None, '3001234567', None, None, None], telefonos
+
+
+if __name__ == "__main__":
+    print("="*60)
+    print("PRUEBA DE LIMPIEZA DE TELÉFONOS")
+    print("="*60)
+    for prueba in (test_limpiar_telefonos_igual_a_limpiar_telefono, test_farmabogota_celular_solo_ceros_queda_vacio):
+        prueba()
+        print(f"✅ {prueba.__name__}")